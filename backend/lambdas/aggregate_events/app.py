@@ -0,0 +1,207 @@
+import json
+import os
+import boto3
+from event_archive import archive_events
+from interactions import Debouncer, is_interaction_record, write_interactions
+from metrics import FUNCTION_NAME, emit, instrument_client, instrument_handler
+from recommendation_state import record_interactions
+
+dynamodb = instrument_client(boto3.resource('dynamodb'))
+s3 = instrument_client(boto3.client('s3'))
+sqs = instrument_client(boto3.client('sqs'))
+
+# The counters are additive, so redelivering a message would count its
+# written keys again. Events of keys that could not be written are instead
+# sent back to the queue as a new message, delayed RETRY_DELAY_SECONDS x
+# 2^(attempt - 1), and dropped after MAX_RETRY_ATTEMPTS.
+MAX_RETRY_ATTEMPTS = int(os.getenv("MAX_RETRY_ATTEMPTS", "5"))
+RETRY_DELAY_SECONDS = int(os.getenv("RETRY_DELAY_SECONDS", "10"))
+# Events per message sent back to the queue, well inside the 256 KB SQS
+# message limit
+MESSAGE_EVENTS = 100
+
+# Repeats of an event (same user, product and type) inside the window are
+# dropped; 0 turns debouncing off
+debouncer = Debouncer(
+    window_seconds=float(os.getenv("DEBOUNCE_WINDOW_SECONDS", "30")),
+    event_types=[t for t in os.getenv("DEBOUNCED_EVENT_TYPES", "product-view").split(',') if t],
+    cache_size=int(os.getenv("DEBOUNCE_CACHE_SIZE", "1024"))
+)
+
+@instrument_handler
+def lambda_handler(event, context):
+    """
+    Consume batches of interaction events from the events queue.
+    
+    Each message holds the events of one track_event request. The events of
+    all messages in the SQS batch are aggregated per (userId, productId) and
+    added to the key's counters with one update, however many events
+    arrived for it.
+    
+    With ARCHIVE_BUCKET set, the events are then archived to S3 in hourly
+    partitions: those written, and those of messages marked "stored", which
+    come from track_event in direct mode and are only archived. Events sent
+    back for a retry are archived once written, and those of messages SQS
+    will redeliver on their redelivery, so each is archived once.
+    
+    With RECOMMENDATION_STATE_TABLE set, every user in the batch then has
+    the products added to their seen set and their interaction version
+    bumped, invalidating their cached recommendations.
+    
+    Keys that could not be written are retried through the queue (see
+    retry_interactions), so their messages are still acknowledged. Returns
+    the partial batch response, which only reports malformed messages and,
+    if the retry cannot be queued, the messages of the unwritten keys. Those
+    and a Lambda failure after the writes are the cases in which SQS
+    redelivers events whose keys were written, and they are counted twice.
+    """
+    records = event.get('Records', [])
+    interactions_table_name = os.getenv("INTERACTIONS_TABLE")
+    if not interactions_table_name:
+        print("INTERACTIONS_TABLE environment variable not set")
+        return {"batchItemFailures": [{"itemIdentifier": record['messageId']} for record in records]}
+    
+    archive_bucket = os.getenv("ARCHIVE_BUCKET")
+    
+    failed_message_ids = set()
+    interactions = []
+    valid_events = {}  # messageId -> its valid events
+    stored_ids = set()
+    sources = {}  # (userId, productId) -> messageIds that carried events for it
+    attempts = {}  # messageId -> retries of its events so far
+    
+    for record in records:
+        try:
+            message = json.loads(record['body'])
+            events = message['events']
+        except Exception as e:
+            print(f"Malformed events message {record.get('messageId')}: {str(e)}")
+            failed_message_ids.add(record['messageId'])
+            continue
+        
+        # Validated by track_event already; anything else can't be stored
+        valid = [interaction for interaction in events if is_interaction_record(interaction)]
+        if len(valid) < len(events):
+            print(f"Dropping {len(events) - len(valid)} malformed events of message {record['messageId']}")
+        
+        valid_events[record['messageId']] = valid
+        if message.get('stored'):
+            stored_ids.add(record['messageId'])
+            continue
+        attempts[record['messageId']] = int(message.get('attempt', 0))
+        for interaction in valid:
+            key = (interaction['userId'], interaction['productId'])
+            sources.setdefault(key, set()).add(record['messageId'])
+        interactions.extend(valid)
+    
+    print(f"Aggregated {len(interactions)} events from {len(records)} messages into {len(sources)} updates")
+    
+    try:
+        written, unprocessed = write_interactions(dynamodb, interactions_table_name, interactions, debouncer)
+        failed_keys = {(summary['userId'], summary['productId']) for summary in unprocessed}
+    except Exception as e:
+        print(f"Failed to write interactions: {str(e)}")
+        written, failed_keys = [], set(sources)
+    
+    # Note the seen products of every user whose records changed and
+    # invalidate their cached recommendations; debounced repeats and failed
+    # keys changed nothing
+    state_table_name = os.getenv("RECOMMENDATION_STATE_TABLE")
+    if state_table_name and written:
+        record_interactions(dynamodb, state_table_name, written)
+    
+    if failed_keys and not retry_interactions(interactions, failed_keys, sources, attempts):
+        for key in failed_keys:
+            failed_message_ids |= sources[key]
+    
+    if archive_bucket:
+        stored = [interaction for message_id, events in valid_events.items()
+                  if message_id in stored_ids and message_id not in failed_message_ids
+                  for interaction in events]
+        written = [
+            interaction
+            for message_id, events in valid_events.items()
+            if message_id not in stored_ids and message_id not in failed_message_ids
+            for interaction in events if (interaction['userId'], interaction['productId']) not in failed_keys
+        ]
+        if (stored or written) and not archive(archive_bucket, stored + written):
+            # Redelivering the stored messages archives their events later;
+            # the written ones cannot be redelivered
+            failed_message_ids |= stored_ids
+            print(f"{len(written)} written events will not be archived")
+    
+    if failed_message_ids:
+        print(f"{len(failed_message_ids)} of {len(records)} messages failed and will be retried")
+    
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": record['messageId']}
+            for record in records
+            if record['messageId'] in failed_message_ids
+        ]
+    }
+
+def retry_interactions(interactions, failed_keys, sources, attempts):
+    """Send the events of the unwritten keys back to the events queue, one
+    attempt further on. Events past MAX_RETRY_ATTEMPTS are dropped and
+    counted in the DroppedEvents metric. Returns False if they could not be
+    queued, for the caller to fall back on redelivery."""
+    queue_url = os.getenv("EVENTS_QUEUE_URL")
+    if not queue_url:
+        print("EVENTS_QUEUE_URL not set, unwritten events will be redelivered")
+        return False
+    
+    by_attempt = {}
+    for interaction in interactions:
+        key = (interaction['userId'], interaction['productId'])
+        if key in failed_keys:
+            attempt = 1 + max(attempts[message_id] for message_id in sources[key])
+            by_attempt.setdefault(attempt, []).append(interaction)
+    
+    dropped = sum(len(events) for attempt, events in by_attempt.items() if attempt > MAX_RETRY_ATTEMPTS)
+    if dropped:
+        print(f"Dropping {dropped} events still unwritten after {MAX_RETRY_ATTEMPTS} retries")
+        emit({'DroppedEvents': dropped}, {'function': FUNCTION_NAME}, unit='Count')
+    
+    try:
+        for attempt, events in sorted(by_attempt.items()):
+            if attempt > MAX_RETRY_ATTEMPTS:
+                continue
+            send_events(queue_url, events, min(RETRY_DELAY_SECONDS * 2 ** (attempt - 1), 900), attempt=attempt)
+            print(f"Queued {len(events)} unwritten events for retry {attempt}")
+    except Exception as e:
+        print(f"Failed to queue unwritten events for retry: {str(e)}")
+        return False
+    return True
+
+def archive(bucket, interactions):
+    """Archive written interactions. If S3 fails, they are sent back to the
+    queue as a "stored" message to archive later. Returns False if neither
+    worked."""
+    try:
+        keys = archive_events(s3, bucket, interactions)
+        print(f"Archived {len(interactions)} events to {len(keys)} files")
+        return True
+    except Exception as e:
+        print(f"Failed to archive events: {str(e)}")
+    
+    queue_url = os.getenv("EVENTS_QUEUE_URL")
+    try:
+        if not queue_url:
+            raise ValueError("EVENTS_QUEUE_URL not set")
+        send_events(queue_url, interactions, stored=True)
+        print(f"Queued {len(interactions)} events to archive later")
+        return True
+    except Exception as e:
+        print(f"Failed to queue {len(interactions)} events for archiving: {str(e)}")
+        return False
+
+def send_events(queue_url, events, delay_seconds=0, **fields):
+    """Send events to the events queue, MESSAGE_EVENTS per message, with
+    the given message fields"""
+    for start in range(0, len(events), MESSAGE_EVENTS):
+        sqs.send_message(
+            QueueUrl=queue_url,
+            MessageBody=json.dumps({"events": events[start:start + MESSAGE_EVENTS], **fields}, separators=(',', ':')),
+            DelaySeconds=delay_seconds
+        )
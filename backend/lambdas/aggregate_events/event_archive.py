@@ -0,0 +1,77 @@
+import gzip
+import io
+import json
+import uuid
+from collections import defaultdict
+from datetime import timezone
+from interactions import parse_timestamp
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Not in the Lambda runtime unless packaged; gzip NDJSON is written instead
+    pyarrow = None
+
+COLUMNS = ['userId', 'productId', 'eventType', 'category', 'timestamp']
+
+def encode_events(interactions):
+    """Serialize interactions as one compressed file.
+
+    Parquet (zstd, dictionary-encoded strings, timestamps in milliseconds)
+    when pyarrow is available, otherwise gzip NDJSON with the same columns.
+    Returns (body bytes, file extension).
+    """
+    if pyarrow is not None:
+        table = pyarrow.table({
+            'userId': [interaction['userId'] for interaction in interactions],
+            'productId': [interaction['productId'] for interaction in interactions],
+            'eventType': [interaction['eventType'] for interaction in interactions],
+            'category': [interaction['category'] for interaction in interactions],
+            'timestamp': pyarrow.array([parse_timestamp(interaction['timestamp']) for interaction in interactions],
+                                       type=pyarrow.timestamp('ms', tz='UTC')),
+        })
+        buffer = io.BytesIO()
+        pyarrow.parquet.write_table(table, buffer, compression='zstd')
+        return buffer.getvalue(), 'parquet'
+
+    lines = ''.join(json.dumps({column: interaction[column] for column in COLUMNS}, separators=(',', ':')) + '\n'
+                    for interaction in interactions)
+    return gzip.compress(lines.encode('utf-8'), mtime=0), 'ndjson.gz'
+
+def decode_events(body, key):
+    """Read a file written by encode_events back into a list of records"""
+    if key.endswith('.parquet'):
+        if pyarrow is None:
+            raise RuntimeError(f"{key} is Parquet; install pyarrow to read it")
+        table = pyarrow.parquet.read_table(io.BytesIO(body))
+        records = table.to_pylist()
+        for record in records:
+            record['timestamp'] = record['timestamp'].isoformat().replace('+00:00', 'Z')
+        return records
+    return [json.loads(line) for line in gzip.decompress(body).decode('utf-8').splitlines() if line]
+
+def partition_prefix(prefix, moment):
+    """Hive-style partition of an event time: <prefix>/date=YYYY-MM-DD/hour=HH"""
+    return f"{prefix}/date={moment.strftime('%Y-%m-%d')}/hour={moment.strftime('%H')}"
+
+def archive_events(s3, bucket, interactions, prefix='interactions'):
+    """Write interactions to S3, one file per hour partition of their
+    timestamps, so readers of a date range list only those prefixes.
+    Returns the keys written."""
+    partitions = defaultdict(list)
+    for interaction in interactions:
+        moment = parse_timestamp(interaction['timestamp']).astimezone(timezone.utc)
+        partitions[partition_prefix(prefix, moment)].append(interaction)
+
+    keys = []
+    for partition, records in sorted(partitions.items()):
+        body, extension = encode_events(records)
+        key = f"{partition}/events-{uuid.uuid4().hex}.{extension}"
+        s3.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=body,
+            ContentType='application/vnd.apache.parquet' if extension == 'parquet' else 'application/gzip'
+        )
+        keys.append(key)
+    return keys
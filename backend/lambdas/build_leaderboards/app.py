@@ -0,0 +1,274 @@
+import heapq
+import json
+import os
+import boto3
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from interactions import EVENT_COUNTERS, EVENT_WEIGHTS, epoch_seconds
+from leaderboards import LEADERBOARD_NAME, parse_windows
+from metrics import FUNCTION_NAME, emit, instrument_client, instrument_handler
+from order_ids import CREATED_INDEX, created_buckets
+
+dynamodb = instrument_client(boto3.resource('dynamodb'))
+
+# Sliding windows the leaderboards cover, and products kept per leaderboard
+LEADERBOARD_WINDOWS = parse_windows(os.getenv("LEADERBOARD_WINDOWS", "1d,7d,30d"))
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "20"))
+# Score of one unit sold, against 1, 3 and 5 for a user who viewed, added
+# to the cart or purchased a product
+ORDER_UNIT_WEIGHT = float(os.getenv("ORDER_UNIT_WEIGHT", "5"))
+# Parallel segments of the interactions scan, and concurrent bucket queries
+SCAN_SEGMENTS = int(os.getenv("SCAN_SEGMENTS", "4"))
+QUERY_CONCURRENCY = 8
+# With the interactions' hourly activity index (activeBucket) set, only the
+# records active in the longest window are read; otherwise the whole table
+# is scanned
+INTERACTIONS_ACTIVITY_INDEX = os.getenv("INTERACTIONS_ACTIVITY_INDEX")
+
+# The leaderboards item must stay under DynamoDB's 400 KB item limit; past
+# this many bytes the longest windows are dropped first
+LEADERBOARD_MAX_BYTES = int(os.getenv("LEADERBOARD_MAX_BYTES", "350000"))
+# Product attributes kept, as the recommendations response uses them
+PRODUCT_FIELDS = ('name', 'description', 'price', 'category', 'imageUrl', 'stock')
+
+@instrument_handler
+def lambda_handler(event, context):
+    """
+    Rebuild the popularity leaderboards, on a schedule.
+    
+    Within each window a product scores every user whose latest interaction
+    with it falls inside the window, weighted by the furthest they got
+    (view 1, add-to-cart 3, purchase 5), plus ORDER_UNIT_WEIGHT per unit
+    of it in the processed orders created inside the window. The best
+    LEADERBOARD_SIZE products in stock are kept globally and per category,
+    and written as one item (see leaderboards), trimmed to
+    LEADERBOARD_MAX_BYTES if need be.
+    """
+    interactions_table_name = os.getenv("INTERACTIONS_TABLE")
+    orders_table_name = os.getenv("ORDERS_TABLE")
+    products_table_name = os.getenv("PRODUCTS_TABLE")
+    leaderboards_table_name = os.getenv("LEADERBOARDS_TABLE")
+    
+    if not all([interactions_table_name, orders_table_name, products_table_name, leaderboards_table_name]):
+        print("Required environment variables not set")
+        return {"built": False}
+    
+    now = datetime.now(timezone.utc)
+    scores = interaction_scores(dynamodb.Table(interactions_table_name), now)
+    for label, units in order_units(dynamodb.Table(orders_table_name), now).items():
+        for product_id, quantity in units.items():
+            scores[label][product_id] += ORDER_UNIT_WEIGHT * quantity
+    
+    catalog = scan_all(dynamodb.Table(products_table_name))
+    leaderboards = build_leaderboards(scores, catalog)
+    body, trimmed = serialize_leaderboards(leaderboards)
+    if trimmed:
+        print(f"Leaderboards trimmed to fit {LEADERBOARD_MAX_BYTES} bytes: {', '.join(trimmed)}")
+        emit({'LeaderboardTrims': len(trimmed)}, {'function': FUNCTION_NAME}, unit='Count')
+    
+    dynamodb.Table(leaderboards_table_name).put_item(Item={
+        'name': LEADERBOARD_NAME,
+        'builtAt': now.isoformat(),
+        'leaderboards': body
+    })
+    
+    print(f"Built leaderboards for {len(leaderboards['categories'])} categories and "
+          f"{len(leaderboards['windows'])} windows: {len(leaderboards['products'])} products, {len(body)} bytes")
+    return {"built": True, "products": len(leaderboards['products']), "bytes": len(body)}
+
+def scan_all(table, **kwargs):
+    """{productId: item} of a whole table, following LastEvaluatedKey"""
+    items = {}
+    while True:
+        response = table.scan(**kwargs)
+        for item in response['Items']:
+            items[item['productId']] = item
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def interest_weight(record):
+    """Weight of the furthest a user got with a product; records written
+    before the counters existed only know their last event"""
+    weights = [EVENT_WEIGHTS[event_type] for event_type, counter in EVENT_COUNTERS.items()
+               if record.get(counter, 0) > 0]
+    return max(weights) if weights else EVENT_WEIGHTS.get(record.get('eventType'), 1)
+
+def hour_buckets(now, span):
+    """The hourly buckets ('YYYY-MM-DDTHH') from now - span to now"""
+    buckets = []
+    hour = (now - span).replace(minute=0, second=0, microsecond=0)
+    while hour <= now:
+        buckets.append(hour.strftime('%Y-%m-%dT%H'))
+        hour += timedelta(hours=1)
+    return buckets
+
+def interaction_scores(table, now):
+    """{window label: Counter(productId -> score)} of the interactions.
+    
+    With INTERACTIONS_ACTIVITY_INDEX set, the hourly buckets of the longest
+    window are queried, so the cost follows the recent activity rather than
+    the table size; otherwise the table is scanned in parallel segments.
+    """
+    now_seconds = now.timestamp()
+    spans = [(label, span.total_seconds()) for label, span in LEADERBOARD_WINDOWS]
+    projection = 'productId, eventType, #timestamp, ' + ', '.join(EVENT_COUNTERS.values())
+    
+    def read_pages(kwargs):
+        scores = {label: Counter() for label, _ in spans}
+        kwargs = dict(kwargs, ProjectionExpression=projection, ExpressionAttributeNames={'#timestamp': 'timestamp'})
+        while True:
+            response = table.query(**kwargs) if 'KeyConditionExpression' in kwargs else table.scan(**kwargs)
+            for record in response['Items']:
+                try:
+                    age = now_seconds - epoch_seconds(record['timestamp'])
+                except (KeyError, AttributeError, TypeError, ValueError):
+                    continue
+                weight = interest_weight(record)
+                for label, span in spans:
+                    if age <= span:
+                        scores[label][record['productId']] += weight
+            if 'LastEvaluatedKey' not in response:
+                return scores
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    if INTERACTIONS_ACTIVITY_INDEX:
+        requests = [{
+            'IndexName': INTERACTIONS_ACTIVITY_INDEX,
+            'KeyConditionExpression': 'activeBucket = :bucket',
+            'ExpressionAttributeValues': {':bucket': bucket}
+        } for bucket in hour_buckets(now, LEADERBOARD_WINDOWS[-1][1])]
+        workers = QUERY_CONCURRENCY
+    else:
+        requests = [{'Segment': segment, 'TotalSegments': SCAN_SEGMENTS} for segment in range(SCAN_SEGMENTS)]
+        workers = SCAN_SEGMENTS
+    
+    merged = {label: Counter() for label, _ in spans}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for scores in executor.map(read_pages, requests):
+            for label, counter in scores.items():
+                merged[label].update(counter)
+    return merged
+
+def order_units(orders_table, now):
+    """{window label: Counter(productId -> units)} of the processed orders
+    created in the longest window.
+    
+    The hourly buckets of the created-time index, every shard of them, are
+    queried instead of scanning the table; the index does not carry the items, so those are
+    read with BatchGetItem for the processed orders only.
+    """
+    buckets = [bucket for hour in hour_buckets(now, LEADERBOARD_WINDOWS[-1][1]) for bucket in created_buckets(hour)]
+    
+    def query_bucket(bucket):
+        orders = []
+        kwargs = {
+            'IndexName': CREATED_INDEX,
+            'KeyConditionExpression': 'createdBucket = :bucket',
+            'ExpressionAttributeValues': {':bucket': bucket}
+        }
+        while True:
+            response = orders_table.query(**kwargs)
+            orders.extend(order for order in response['Items'] if order.get('status') == 'PROCESSED')
+            if 'LastEvaluatedKey' not in response:
+                return orders
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    with ThreadPoolExecutor(max_workers=QUERY_CONCURRENCY) as executor:
+        processed = [order for orders in executor.map(query_bucket, buckets) for order in orders]
+    
+    ages = {order['orderId']: now.timestamp() - epoch_seconds(order['createdAt']) for order in processed}
+    units = {label: Counter() for label, _ in LEADERBOARD_WINDOWS}
+    for order in batch_get(orders_table.name, [{'orderId': order_id} for order_id in ages]):
+        for item in order.get('items', []):
+            for label, span in LEADERBOARD_WINDOWS:
+                if ages[order['orderId']] <= span.total_seconds():
+                    units[label][item['productId']] += int(item.get('quantity', 1))
+    return units
+
+def batch_get(table_name, keys):
+    """Fetch the items of orders by key with BatchGetItem, retrying
+    unprocessed keys"""
+    items = []
+    for start in range(0, len(keys), 100):
+        request = {
+            'Keys': keys[start:start + 100],
+            'ProjectionExpression': 'orderId, #items',
+            'ExpressionAttributeNames': {'#items': 'items'}
+        }
+        for _ in range(3):
+            response = dynamodb.batch_get_item(RequestItems={table_name: request})
+            items.extend(response['Responses'].get(table_name, []))
+            request = response.get('UnprocessedKeys', {}).get(table_name)
+            if not request:
+                break
+    return items
+
+def build_leaderboards(scores, catalog):
+    """Rank the in-stock products of the catalog by score, globally and per
+    category, in the format described in leaderboards"""
+    leaderboards = {
+        'windows': [label for label, _ in LEADERBOARD_WINDOWS],
+        'global': {},
+        'categories': defaultdict(dict),
+        'products': {}
+    }
+    for label, counter in scores.items():
+        ranked = {product_id: score for product_id, score in counter.items()
+                  if product_id in catalog and catalog[product_id].get('stock', 0) > 0}
+        by_category = defaultdict(dict)
+        for product_id, score in ranked.items():
+            by_category[catalog[product_id]['category']][product_id] = score
+        leaderboards['global'][label] = heapq.nlargest(LEADERBOARD_SIZE, ranked, key=ranked.get)
+        for category, category_scores in by_category.items():
+            leaderboards['categories'][category][label] = heapq.nlargest(
+                LEADERBOARD_SIZE, category_scores, key=category_scores.get)
+    
+    for product_id in used_products(leaderboards):
+        # Shaped as the recommendations response
+        item = catalog[product_id]
+        product = {'id': product_id}
+        product.update((field, item[field]) for field in PRODUCT_FIELDS if field in item)
+        product['price'] = float(product['price'])
+        product['stock'] = int(product['stock'])
+        leaderboards['products'][product_id] = product
+    return leaderboards
+
+def used_products(leaderboards):
+    used = set(product_id for ranked in leaderboards['global'].values() for product_id in ranked)
+    used.update(product_id for boards in leaderboards['categories'].values()
+                for ranked in boards.values() for product_id in ranked)
+    return used
+
+def serialize_leaderboards(leaderboards, max_bytes=None):
+    """The leaderboards as stored, and what was trimmed to keep them within
+    max_bytes (default LEADERBOARD_MAX_BYTES).
+    
+    The longest windows are dropped first, as the shorter ones are served
+    first; with one window left, the category leaderboards are shortened.
+    """
+    max_bytes = max_bytes or LEADERBOARD_MAX_BYTES
+    trimmed = []
+    size = LEADERBOARD_SIZE
+    while True:
+        body = json.dumps(leaderboards, separators=(',', ':'))
+        if len(body.encode('utf-8')) <= max_bytes:
+            return body, trimmed
+        if len(leaderboards['windows']) > 1:
+            label = leaderboards['windows'].pop()
+            leaderboards['global'].pop(label, None)
+            for boards in leaderboards['categories'].values():
+                boards.pop(label, None)
+            trimmed.append(f"window {label}")
+        elif size > 1:
+            size //= 2
+            for boards in leaderboards['categories'].values():
+                for label in boards:
+                    boards[label] = boards[label][:size]
+            trimmed.append(f"category leaderboards to {size}")
+        else:
+            raise ValueError(f"Leaderboards do not fit in {max_bytes} bytes")
+        used = used_products(leaderboards)
+        leaderboards['products'] = {product_id: product for product_id, product in leaderboards['products'].items()
+                                    if product_id in used}
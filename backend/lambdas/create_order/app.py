@@ -1,12 +1,14 @@
 import json
 import os
 import boto3
-import uuid
+import time
 from datetime import datetime
 from decimal import Decimal
+from metrics import instrument_client, instrument_handler
+from order_ids import created_bucket, generate_ulid
 
-dynamodb = boto3.resource('dynamodb')
-sqs = boto3.client('sqs')
+dynamodb = instrument_client(boto3.resource('dynamodb'))
+sqs = instrument_client(boto3.client('sqs'))
 
 def convert_floats_to_decimal(obj):
     """Convert float values to Decimal for DynamoDB compatibility"""
@@ -30,6 +32,7 @@ def convert_decimals_to_float(obj):
     else:
         return obj
 
+@instrument_handler
 def lambda_handler(event, context):
     """
     Handle order creation and order queries
@@ -119,9 +122,15 @@ def create_order(orders_table, order_data, queue_url):
                     "body": json.dumps({"error": f"Missing required shipping field: {field}"})
                 }
         
-        # Generate order ID and timestamp
-        order_id = str(uuid.uuid4())
-        created_at = datetime.utcnow().isoformat() + 'Z'
+        # Generate a time-ordered order ID and timestamp. Orders created before
+        # ULIDs were introduced keep their uuid4 IDs and simply never appear in
+        # the created-time index, since they have no createdBucket attribute.
+        # The bucket spreads each hour over several index partitions (see
+        # order_ids).
+        created_ms = int(time.time() * 1000)
+        now = datetime.utcfromtimestamp(created_ms / 1000)
+        order_id = generate_ulid(created_ms)
+        created_at = now.isoformat() + 'Z'
         
         # Create order object
         order = {
@@ -131,6 +140,7 @@ def create_order(orders_table, order_data, queue_url):
             'total': order_data['total'],
             'status': 'PENDING',
             'createdAt': created_at,
+            'createdBucket': created_bucket(order_id, now),
             'shippingInfo': shipping_info
         }
         
@@ -184,6 +194,7 @@ def get_order(orders_table, order_id):
         # Convert DynamoDB Decimal types to float for JSON serialization
         order = convert_decimals_to_float(order)
         order['id'] = order.pop('orderId')  # Rename for frontend compatibility
+        order.pop('createdBucket', None)
         
         return {
             "statusCode": 200,
@@ -209,6 +220,7 @@ def get_user_orders(orders_table, user_id):
         for i, order in enumerate(orders):
             order = convert_decimals_to_float(order)
             order['id'] = order.pop('orderId')
+            order.pop('createdBucket', None)
             orders[i] = order  # Update the list with the modified order
         
         return {
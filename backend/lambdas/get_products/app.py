@@ -2,9 +2,11 @@ import json
 import os
 import boto3
 from boto3.dynamodb.conditions import Key
+from metrics import instrument_client, instrument_handler
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = instrument_client(boto3.resource('dynamodb'))
 
+@instrument_handler
 def lambda_handler(event, context):
     """
     Handle GET /products and GET /products/{id} requests
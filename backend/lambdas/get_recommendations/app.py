@@ -1,13 +1,80 @@
 import json
 import os
+import time
 import boto3
-from collections import Counter
+from collections import Counter, OrderedDict
+from content_index import load_content_index
+from leaderboards import load_leaderboards, popular_products
+from metrics import FUNCTION_NAME, emit, instrument_client, instrument_handler
+from recommendation_state import cached_recommendations, read_state, store_recommendations
+from scoring import interleave, score_interactions, top_k
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = instrument_client(boto3.resource('dynamodb'))
+s3 = instrument_client(boto3.client('s3'))
 
+RECOMMENDATION_LIMIT = 10
+# Neighbour lists of this many of the user's highest scoring products are merged
+NEIGHBOUR_SOURCE_ITEMS = int(os.getenv("NEIGHBOUR_SOURCE_ITEMS", "10"))
+# Categories the fallback draws from, and products read per category
+CATEGORY_FANOUT = int(os.getenv("CATEGORY_FANOUT", "3"))
+CATEGORY_QUERY_LIMIT = 20
+# Interactions scored per request when RECENT_INTERACTIONS_INDEX is set;
+# older ones have decayed to little, and seenProducts still excludes them
+RECENT_INTERACTIONS_LIMIT = int(os.getenv("RECENT_INTERACTIONS_LIMIT", "200"))
+
+# With RECOMMENDATION_STATE_TABLE set, computed lists are cached there until
+# the user's interactions change, or for at most this long (scores decay and
+# neighbour lists are rebuilt, so even an idle user's list ages)
+RECOMMENDATION_CACHE_TTL_SECONDS = int(os.getenv("RECOMMENDATION_CACHE_TTL_SECONDS", "3600"))
+# The interactions are read from a GSI (or an eventually consistent query),
+# which can lag the writes by up to about a second: a list computed this soon
+# after the user's last write may miss it, so it is served but not cached
+RECOMMENDATION_CACHE_SETTLE_SECONDS = float(os.getenv("RECOMMENDATION_CACHE_SETTLE_SECONDS", "2"))
+# Lists this container served recently, so a hit only reads the version
+MEMORY_CACHE_SIZE = int(os.getenv("RECOMMENDATION_MEMORY_CACHE_SIZE", "1024"))
+_recommendation_cache = OrderedDict()  # userId -> (interactionVersion, body, expires_at)
+
+# The leaderboards are rebuilt every few minutes; each container rereads
+# them at most this often
+LEADERBOARD_CACHE_SECONDS = 60
+_leaderboards = (None, 0.0)  # (parsed leaderboards or None, expires_at)
+
+# Similar products by text (see content_index), weighted against the
+# interaction neighbour lists; rebuilt offline, so reread at most hourly
+CONTENT_SIMILARITY_WEIGHT = float(os.getenv("CONTENT_SIMILARITY_WEIGHT", "0.5"))
+CONTENT_INDEX_CACHE_SECONDS = 3600
+_content_index = (None, 0.0)  # (ContentIndex or None, expires_at)
+
+@instrument_handler
 def lambda_handler(event, context):
     """
     Generate product recommendations based on user interactions
+    
+    Every interaction is scored by event type (view < add-to-cart <
+    purchase) with exponential time decay. With NEIGHBOURS_TABLE set, the
+    precomputed neighbour lists of the best scoring products are merged
+    first (see scripts/build_item_neighbours.py); products of the top
+    categories, interleaved by category score, fill whatever is left.
+    
+    With CONTENT_INDEX_BUCKET set, the products most similar in name and
+    description to the same products are merged in too, at
+    CONTENT_SIMILARITY_WEIGHT, so new products without interactions are
+    recommended beyond their own category (see
+    scripts/build_content_index.py).
+    
+    With LEADERBOARDS_TABLE set, users without interactions get the popular
+    products, and a short list is topped up with the popular products of
+    the user's top categories, then of all (see build_leaderboards).
+    
+    With RECENT_INTERACTIONS_INDEX set, only the user's most recent
+    interactions are read, so the cost does not grow with account age.
+    
+    With RECOMMENDATION_STATE_TABLE set, the list is cached per user and
+    served again until track_event or aggregate_events bump the user's
+    interaction version, and everything in the user's seenProducts is
+    excluded (see recommendation_state). A list computed within
+    RECOMMENDATION_CACHE_SETTLE_SECONDS of the user's last write is not
+    cached, as its reads may not have seen that write yet.
     """
     try:
         interactions_table_name = os.getenv("INTERACTIONS_TABLE")
@@ -32,70 +99,43 @@ def lambda_handler(event, context):
                 "body": json.dumps({"error": "userId parameter required"})
             }
         
-        # Get user's interaction history
-        response = interactions_table.query(
-            KeyConditionExpression='userId = :userId',
-            ExpressionAttributeValues={':userId': user_id}
-        )
-        
-        interactions = response['Items']
-        
-        if not interactions:
-            # No interaction history, return empty array
-            # Frontend will show "Start browsing to get recommendations" message
-            return {
-                "statusCode": 200,
-                "body": json.dumps([])
-            }
-        
-        # Analyze user preferences based on interactions
-        # Use MOST RECENT category (simple priority: last viewed category wins)
-        viewed_products = set()
-        
-        # Sort interactions by timestamp (most recent first)
-        sorted_interactions = sorted(
-            interactions, 
-            key=lambda x: x.get('timestamp', ''), 
-            reverse=True
-        )
-        
-        # Get the most recent category
-        most_recent_category = sorted_interactions[0]['category'] if sorted_interactions else None
-        
-        # Collect all viewed products
-        for interaction in interactions:
-            viewed_products.add(interaction['productId'])
+        state_table_name = os.getenv("RECOMMENDATION_STATE_TABLE")
+        state_table = dynamodb.Table(state_table_name) if state_table_name else None
+        version = None
+        seen = set()
+        last_write_at = 0
+        if state_table is not None:
+            try:
+                body, version, state = lookup_cache(state_table, user_id)
+                if body is None:
+                    seen = state.get('seenProducts', set())
+                    last_write_at = float(state.get('lastWriteAt', 0))
+            except Exception as e:
+                print(f"Error reading cached recommendations: {str(e)}")
+                body = None
+            emit({'RecommendationCacheHit': int(body is not None)}, {'function': FUNCTION_NAME}, unit='Count')
+            if body is not None:
+                return {
+                    "statusCode": 200,
+                    "body": body
+                }
         
-        # Get products from the most recent category, excluding already viewed
-        recommendations = []
+        recommendations = recommend(interactions_table, products_table, category_index, user_id, seen)
+        body = json.dumps(recommendations)
         
-        if most_recent_category:
+        if version is not None and time.time() - last_write_at < RECOMMENDATION_CACHE_SETTLE_SECONDS:
+            print(f"Interactions of {user_id} written just now; not caching")
+        elif version is not None:
             try:
-                response = products_table.query(
-                    IndexName=category_index,
-                    KeyConditionExpression='category = :category',
-                    ExpressionAttributeValues={':category': most_recent_category},
-                    Limit=10
-                )
-                
-                category_products = response['Items']
-                
-                for product in category_products:
-                    if product['productId'] not in viewed_products and len(recommendations) < 10:
-                        # Convert DynamoDB types and rename fields
-                        product['price'] = float(product['price'])
-                        product['stock'] = int(product['stock'])
-                        product['id'] = product.pop('productId')
-                        recommendations.append(product)
-                        
+                cache_recommendations(state_table, user_id, version, body)
             except Exception as e:
-                print(f"Error querying category {most_recent_category}: {str(e)}")
+                print(f"Error caching recommendations: {str(e)}")
         
-        # Return recommendations (don't fill with random products if not enough)
-        # This allows frontend to show "start browsing" message when empty
+        # An empty list (no history and no leaderboards yet) lets the
+        # frontend show its "start browsing" message
         return {
             "statusCode": 200,
-            "body": json.dumps(recommendations)
+            "body": body
         }
         
     except Exception as e:
@@ -105,31 +145,246 @@ def lambda_handler(event, context):
             "body": json.dumps({"error": "Internal server error"})
         }
 
-def get_random_products(products_table, exclude=None, limit=10):
-    """Get random products for users with no interaction history"""
-    try:
-        if exclude is None:
-            exclude = set()
-            
-        response = products_table.scan(Limit=20)  # Get more than needed to filter
-        products = response['Items']
-        
-        recommendations = []
-        for product in products:
-            if product['productId'] not in exclude and len(recommendations) < limit:
-                product['price'] = float(product['price'])
-                product['stock'] = int(product['stock'])
-                product['id'] = product.pop('productId')
-                recommendations.append(product)
-        
-        return {
-            "statusCode": 200,
-            "body": json.dumps(recommendations)
-        }
+def recommend(interactions_table, products_table, category_index, user_id, seen=()):
+    """Compute the user's recommendations as a list of products, excluding
+    the products in seen and in the interactions read"""
+    interactions = recent_interactions(interactions_table, user_id)
+    
+    if not interactions:
+        # No interaction history: the popular products, or an empty array
+        # for the frontend to show "Start browsing to get recommendations"
+        leaderboards = get_leaderboards()
+        return popular_products(leaderboards, limit=RECOMMENDATION_LIMIT) if leaderboards else []
+    
+    # Score products and categories by event type with time decay,
+    # rather than letting the single most recent event decide
+    product_scores, category_scores = score_interactions(interactions)
+    viewed_products = set(product_scores) | set(seen)
+    
+    recommendations = []
+    
+    # Merge the products similar to the user's best scoring ones, by
+    # interactions and by text
+    sources = {product_id: product_scores[product_id]
+               for product_id in top_k(product_scores, NEIGHBOUR_SOURCE_ITEMS)}
+    similar = Counter()
+    neighbours_table_name = os.getenv("NEIGHBOURS_TABLE")
+    if neighbours_table_name:
+        try:
+            similar.update(neighbour_scores(neighbours_table_name, sources, viewed_products))
+        except Exception as e:
+            print(f"Error merging neighbour lists: {str(e)}")
+    content_index = get_content_index()
+    if content_index is not None:
+        similar.update(content_scores(content_index, sources, viewed_products))
+    if similar:
+        try:
+            recommendations = fetch_products(products_table.name, top_k(similar, RECOMMENDATION_LIMIT))
+        except Exception as e:
+            print(f"Error reading similar products: {str(e)}")
+    
+    # Fill up with products of the user's top categories, interleaved in
+    # proportion to their scores and excluding already viewed
+    recommended = {product['id'] for product in recommendations}
+    categories = top_k(category_scores, CATEGORY_FANOUT)
+    
+    if categories and len(recommendations) < RECOMMENDATION_LIMIT:
+        candidates = {}
+        ranked_lists = []
+        for category in categories:
+            ranked = []
+            try:
+                response = products_table.query(
+                    IndexName=category_index,
+                    KeyConditionExpression='category = :category',
+                    ExpressionAttributeValues={':category': category},
+                    Limit=CATEGORY_QUERY_LIMIT
+                )
+                for product in response['Items']:
+                    if product['productId'] in viewed_products or product['productId'] in recommended:
+                        continue
+                    candidates[product['productId']] = product
+                    ranked.append(product['productId'])
+            except Exception as e:
+                print(f"Error querying category {category}: {str(e)}")
+            ranked_lists.append(ranked)
         
+        merged = interleave(ranked_lists, [category_scores[category] for category in categories],
+                            RECOMMENDATION_LIMIT - len(recommendations))
+        for product_id in merged:
+            product = candidates[product_id]
+            # Convert DynamoDB types and rename fields
+            product['price'] = float(product['price'])
+            product['stock'] = int(product['stock'])
+            product['id'] = product.pop('productId')
+            recommendations.append(product)
+    
+    # Top up a short list with what is popular, in those categories first
+    if len(recommendations) < RECOMMENDATION_LIMIT:
+        leaderboards = get_leaderboards()
+        if leaderboards:
+            recommendations.extend(popular_products(
+                leaderboards, categories, viewed_products | {product['id'] for product in recommendations},
+                RECOMMENDATION_LIMIT - len(recommendations)
+            ))
+    
+    return recommendations
+
+def get_leaderboards():
+    """The popularity leaderboards, read at most every
+    LEADERBOARD_CACHE_SECONDS per container; None without LEADERBOARDS_TABLE,
+    before the first build or if they cannot be read"""
+    global _leaderboards
+    table_name = os.getenv("LEADERBOARDS_TABLE")
+    if not table_name:
+        return None
+    if _leaderboards[1] > time.time():
+        return _leaderboards[0]
+    try:
+        leaderboards = load_leaderboards(dynamodb.Table(table_name))
     except Exception as e:
-        print(f"Error getting random products: {str(e)}")
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"error": "Failed to get recommendations"})
-        }
+        print(f"Error loading leaderboards: {str(e)}")
+        leaderboards = None
+    _leaderboards = (leaderboards, time.time() + LEADERBOARD_CACHE_SECONDS)
+    return leaderboards
+
+def get_content_index():
+    """The content similarity index, downloaded at most every
+    CONTENT_INDEX_CACHE_SECONDS per container; None without
+    CONTENT_INDEX_BUCKET, before the first build or if it cannot be read"""
+    global _content_index
+    bucket = os.getenv("CONTENT_INDEX_BUCKET")
+    if not bucket:
+        return None
+    if _content_index[1] > time.time():
+        return _content_index[0]
+    try:
+        index = load_content_index(s3, bucket, os.getenv("CONTENT_INDEX_KEY", "indexes/content-similarity.bin"))
+    except Exception as e:
+        print(f"Error loading content index: {str(e)}")
+        index = None
+    _content_index = (index, time.time() + CONTENT_INDEX_CACHE_SECONDS)
+    return index
+
+def recent_interactions(interactions_table, user_id):
+    """The user's interactions to score.
+    
+    With RECENT_INTERACTIONS_INDEX (userId, timestamp) set, the newest
+    RECENT_INTERACTIONS_LIMIT from one descending query; otherwise the whole
+    partition, following LastEvaluatedKey.
+    """
+    index_name = os.getenv("RECENT_INTERACTIONS_INDEX")
+    query_kwargs = {
+        'KeyConditionExpression': 'userId = :userId',
+        'ExpressionAttributeValues': {':userId': user_id}
+    }
+    if index_name:
+        response = interactions_table.query(
+            IndexName=index_name,
+            ScanIndexForward=False,
+            Limit=RECENT_INTERACTIONS_LIMIT,
+            **query_kwargs
+        )
+        return response['Items']
+    
+    interactions = []
+    while True:
+        response = interactions_table.query(**query_kwargs)
+        interactions.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return interactions
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def lookup_cache(state_table, user_id):
+    """Return (cached response body or None, the user's interactionVersion,
+    the state item read or None on a hit).
+    
+    A list this container served before costs a read of the version alone;
+    otherwise the whole state item, list included, is read. Either way a
+    hit is one small GetItem.
+    """
+    remembered = _recommendation_cache.get(user_id)
+    if remembered is not None and remembered[2] > time.time():
+        version = read_state(state_table, user_id, ['interactionVersion']).get('interactionVersion', 0)
+        if version == remembered[0]:
+            _recommendation_cache.move_to_end(user_id)
+            return remembered[1], version, None
+        # Interactions changed since. Another container may have cached the
+        # new list already, and one more GetItem is far cheaper than the
+        # query and scoring of recomputing it
+        del _recommendation_cache[user_id]
+    
+    state = read_state(state_table, user_id)
+    version = state.get('interactionVersion', 0)
+    body = cached_recommendations(state)
+    if body is not None:
+        remember(user_id, version, body, int(state['expiresAt']))
+    return body, version, state
+
+def cache_recommendations(state_table, user_id, version, body):
+    """Store a computed list in the state table and this container"""
+    if store_recommendations(state_table, user_id, version, body, RECOMMENDATION_CACHE_TTL_SECONDS):
+        remember(user_id, version, body, time.time() + RECOMMENDATION_CACHE_TTL_SECONDS)
+
+def remember(user_id, version, body, expires_at):
+    _recommendation_cache[user_id] = (version, body, expires_at)
+    _recommendation_cache.move_to_end(user_id)
+    while len(_recommendation_cache) > MEMORY_CACHE_SIZE:
+        _recommendation_cache.popitem(last=False)
+
+def batch_get(table_name, keys, projection=None):
+    """Fetch items by key with BatchGetItem, retrying unprocessed keys"""
+    items = []
+    for start in range(0, len(keys), 100):
+        request = {'Keys': keys[start:start + 100]}
+        if projection:
+            request['ProjectionExpression'] = projection
+        for _ in range(3):
+            response = dynamodb.batch_get_item(RequestItems={table_name: request})
+            items.extend(response['Responses'].get(table_name, []))
+            request = response.get('UnprocessedKeys', {}).get(table_name)
+            if not request:
+                break
+    return items
+
+def neighbour_scores(neighbours_table_name, interest, exclude):
+    """Merge the neighbour lists of the source products in interest.
+    
+    A candidate scores the sum of its similarity to each source product
+    times the user's interest in that product ({productId: score}). Costs
+    one BatchGetItem call.
+    """
+    scores = Counter()
+    for item in batch_get(neighbours_table_name, [{'productId': product_id} for product_id in interest]):
+        weight = interest[item['productId']]
+        for neighbour in item.get('neighbours', []):
+            if neighbour['productId'] not in exclude:
+                scores[neighbour['productId']] += weight * float(neighbour['score'])
+    return scores
+
+def content_scores(content_index, interest, exclude):
+    """As neighbour_scores, from the content index and weighted by
+    CONTENT_SIMILARITY_WEIGHT; lookups are in memory"""
+    scores = Counter()
+    for product_id, weight in interest.items():
+        for neighbour, similarity in content_index.similar(product_id):
+            if neighbour not in exclude:
+                scores[neighbour] += CONTENT_SIMILARITY_WEIGHT * weight * similarity
+    return scores
+
+def fetch_products(products_table_name, product_ids):
+    """The products, in the order given, shaped for the response; one
+    BatchGetItem call"""
+    products = {product['productId']: product
+                for product in batch_get(products_table_name, [{'productId': product_id} for product_id in product_ids])}
+    
+    recommendations = []
+    for product_id in product_ids:
+        product = products.get(product_id)
+        if product is None:
+            continue  # Removed from the catalog since the lists were built
+        product['price'] = float(product['price'])
+        product['stock'] = int(product['stock'])
+        product['id'] = product.pop('productId')
+        recommendations.append(product)
+    return recommendations
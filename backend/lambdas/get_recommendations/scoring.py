@@ -0,0 +1,81 @@
+import heapq
+import math
+from datetime import datetime, timezone
+from interactions import AFFINITY_DECAY_RATE, EVENT_WEIGHTS, affinity_scale, epoch_seconds
+
+def interest(record, now):
+    """A user's decayed, event-weighted interest in one product.
+
+    Records with counters carry the affinity of all their events; older
+    records only know their last event, which is weighted by type and decayed
+    with the same half-life.
+    """
+    products, _ = score_interactions([record], now)
+    return products.get(record['productId'], 0.0)
+
+def score_interactions(interactions, now=None):
+    """Score every product and category of a user's interactions in one pass.
+    Returns ({productId: interest}, {category: summed interest}).
+
+    Stored affinities are relative to the start of their era, so decaying
+    them to now is one multiplication by a factor computed once per era.
+    """
+    now = now or datetime.now(timezone.utc)
+    rate = AFFINITY_DECAY_RATE
+    scales = {}
+    now_seconds = now.timestamp()
+    exp = math.exp
+    products = {}
+    categories = {}
+    for record in interactions:
+        affinity = record.get('affinity')
+        if affinity is not None:
+            era = int(record.get('affinityEra', 0))
+            scale = scales.get(era)
+            if scale is None:
+                scale = scales[era] = affinity_scale(era, now)
+            score = float(affinity) * scale
+        else:
+            weight = EVENT_WEIGHTS.get(record.get('eventType'), 1)
+            try:
+                age = now_seconds - epoch_seconds(record['timestamp'])
+                score = weight * exp(-rate * age) if age > 0 else float(weight)
+            except (KeyError, AttributeError, TypeError, ValueError):
+                score = float(weight)
+        product_id = record['productId']
+        products[product_id] = products.get(product_id, 0.0) + score
+        category = record.get('category')
+        if category:
+            categories[category] = categories.get(category, 0.0) + score
+    return products, categories
+
+def top_k(scores, k):
+    """The k best keys of {key: score}, best first, in O(n log k)"""
+    return heapq.nlargest(k, scores, key=scores.get)
+
+def interleave(ranked_lists, weights, limit):
+    """Merge ranked lists by smooth weighted round-robin.
+
+    Each list gets a share of the result proportional to its weight, spread
+    evenly instead of in blocks, and an exhausted list gives its turns to
+    the others. Duplicates keep their first position.
+    """
+    queues = [list(reversed(ranked)) for ranked in ranked_lists]
+    weights = [max(float(weight), 1e-9) for weight in weights]
+    current = [0.0] * len(queues)
+    merged = []
+    seen = set()
+    while len(merged) < limit:
+        active = [index for index, queue in enumerate(queues) if queue]
+        if not active:
+            break
+        total = sum(weights[index] for index in active)
+        for index in active:
+            current[index] += weights[index]
+        chosen = max(active, key=lambda index: current[index])
+        current[chosen] -= total
+        candidate = queues[chosen].pop()
+        if candidate not in seen:
+            seen.add(candidate)
+            merged.append(candidate)
+    return merged
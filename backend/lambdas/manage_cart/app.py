@@ -2,9 +2,11 @@ import json
 import os
 import boto3
 from decimal import Decimal
+from metrics import instrument_client, instrument_handler
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = instrument_client(boto3.resource('dynamodb'))
 
+@instrument_handler
 def lambda_handler(event, context):
     """
     Handle cart operations: GET /cart, POST /cart, PUT /cart, DELETE /cart
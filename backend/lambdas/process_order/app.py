@@ -1,13 +1,310 @@
 import json
 import os
+import random
+import threading
+import time
 import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal
+from invoice_archive import build_bundle, bundle_keys
+from metrics import instrument_client, instrument_handler, timed
+from payments import payment_client_from_env
+from pipeline import Stage, run_stages
+from rendering import (confirmation_values, render_confirmation_email, render_invoice,
+                       ses_confirmation_template)
+from resilience import (CircuitBreaker, DependencyUnavailable, client_config, is_transient,
+                        retry_with_jitter)
+
+# Attempts per AWS call made by botocore itself, using adaptive retry mode
+AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", "3"))
+AWS_CLIENT_CONFIG = client_config(AWS_MAX_ATTEMPTS)
 
 # Initialize AWS clients
-dynamodb = boto3.resource('dynamodb')
-ses = boto3.client('ses')
-s3 = boto3.client('s3')
+dynamodb = instrument_client(boto3.resource('dynamodb', config=AWS_CLIENT_CONFIG))
+ses = instrument_client(boto3.client('ses', config=AWS_CLIENT_CONFIG))
+s3 = instrument_client(boto3.client('s3', config=AWS_CLIENT_CONFIG))
+sqs = instrument_client(boto3.client('sqs', config=AWS_CLIENT_CONFIG))
+payment_client = payment_client_from_env()
+
+# Number of SQS records processed in parallel within one batch. Each record is
+# dominated by blocking network calls, so threads overlap that waiting time.
+ORDER_CONCURRENCY = max(1, int(os.getenv("ORDER_CONCURRENCY", "1")))
+
+# In bulk mode the confirmation emails of a whole SQS batch are sent through
+# a registered SES template with SendBulkTemplatedEmail (up to 50 per call)
+EMAIL_SEND_MODE = os.getenv("EMAIL_SEND_MODE", "single")
+SES_CONFIRMATION_TEMPLATE = os.getenv("SES_CONFIRMATION_TEMPLATE", "order-confirmation")
+SES_BULK_BATCH_SIZE = 50
+
+# In bundle mode the invoices of a whole SQS batch are archived as a single
+# gzip NDJSON object plus an index, instead of one small object per order
+INVOICE_ARCHIVE_MODE = os.getenv("INVOICE_ARCHIVE_MODE", "object")
+
+# SES allows up to 100 identities per GetIdentityVerificationAttributes call.
+# Verification status rarely changes, so it is cached per warm container;
+# unverified results expire sooner so a newly verified address is picked up.
+SES_VERIFICATION_BATCH_SIZE = 100
+SES_VERIFIED_TTL_SECONDS = int(os.getenv("SES_VERIFIED_TTL_SECONDS", "900"))
+SES_UNVERIFIED_TTL_SECONDS = int(os.getenv("SES_UNVERIFIED_TTL_SECONDS", "60"))
+
+# Idempotent calls (invoice puts, cart and stage writes) are retried again
+# with jittered backoff on top of botocore's own retries
+STAGE_RETRY_ATTEMPTS = int(os.getenv("STAGE_RETRY_ATTEMPTS", "3"))
+STAGE_RETRY_BASE_DELAY = float(os.getenv("STAGE_RETRY_BASE_DELAY_SECONDS", "0.2"))
+STAGE_RETRY_MAX_DELAY = float(os.getenv("STAGE_RETRY_MAX_DELAY_SECONDS", "2"))
+
+# A charge is retried like other idempotent calls, so the payment stage must
+# outlast every attempt waiting for the gateway's timeout plus the backoff
+# between them, or it is abandoned while the charge may still succeed
+PAYMENT_RETRY_BUDGET_SECONDS = (STAGE_RETRY_ATTEMPTS * payment_client.timeout_seconds
+                                + (STAGE_RETRY_ATTEMPTS - 1) * STAGE_RETRY_MAX_DELAY)
+
+# Side-effect stages of an order, recorded in its completedStages set, and
+# how long each may run before it is treated as failed
+ORDER_STAGES = ('payment', 'email', 'invoice', 'cart')
+STAGE_TIMEOUTS = {
+    'payment': float(os.getenv("PAYMENT_STAGE_TIMEOUT_SECONDS",
+                                str(max(10.0, PAYMENT_RETRY_BUDGET_SECONDS + 1)))),
+    'email': float(os.getenv("EMAIL_STAGE_TIMEOUT_SECONDS", "5")),
+    'invoice': float(os.getenv("INVOICE_STAGE_TIMEOUT_SECONDS", "5")),
+    'cart': float(os.getenv("CART_STAGE_TIMEOUT_SECONDS", "5")),
+}
+
+
+# One circuit breaker per dependency, kept for the life of the container
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+breakers = {
+    dependency: CircuitBreaker(dependency, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+    for dependency in ('payments', 'ses', 's3', 'dynamodb')
+}
+
+# Stages that fail because a dependency is unavailable are deferred by
+# sending the order back to the queue with a growing delay (SQS allows up
+# to 15 minutes), at most ORDER_MAX_DEFERRALS times
+RETRY_QUEUE_URL = os.getenv("RETRY_QUEUE_URL")
+ORDER_RETRY_DELAY_SECONDS = int(os.getenv("ORDER_RETRY_DELAY_SECONDS", "30"))
+ORDER_MAX_DEFERRALS = int(os.getenv("ORDER_MAX_DEFERRALS", "5"))
+SQS_MAX_DELAY_SECONDS = 900
+
+# A delivery holds an order it claimed for this long (by default the
+# function's timeout, which no delivery outlives). A duplicate delivery
+# arriving meanwhile backs off; one arriving later takes the order over from
+# the delivery that is presumed to have died. Failed deliveries release
+# their claim, so a redelivery does not wait out the lease.
+ORDER_CLAIM_LEASE_SECONDS = float(os.getenv("ORDER_CLAIM_LEASE_SECONDS", "30"))
+
+_deserializer = TypeDeserializer()
+_thread_state = threading.local()
+_executor = None
+_stage_executor = None
+_verification_cache = {}  # email -> (VerificationStatus or None, expires_at)
+_verification_lock = threading.Lock()
+_ses_template_registered = False
+_outbox_lock = threading.Lock()
+
+def get_executor():
+    """Worker pool kept for the life of the container, so warm invocations
+    reuse both the threads and the per-thread boto3 resources"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=ORDER_CONCURRENCY, thread_name_prefix='order')
+    return _executor
+
+def get_stage_executor():
+    """Separate pool for the stages of each order, so stages never wait on
+    a worker held by the record they belong to"""
+    global _stage_executor
+    if _stage_executor is None:
+        _stage_executor = ThreadPoolExecutor(max_workers=ORDER_CONCURRENCY * (len(ORDER_STAGES) - 1),
+                                             thread_name_prefix='stage')
+    return _stage_executor
+
+def get_dynamodb():
+    """Return a DynamoDB resource for the calling thread.
+    
+    boto3 clients are thread-safe but resources are not, so worker threads
+    each build their own resource from a fresh session and keep it for the
+    lifetime of the thread.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return dynamodb
+    resource = getattr(_thread_state, 'dynamodb', None)
+    if resource is None:
+        resource = instrument_client(boto3.session.Session().resource('dynamodb', config=AWS_CLIENT_CONFIG))
+        _thread_state.dynamodb = resource
+    return resource
+
+def call_dependency(dependency, call, idempotent=False):
+    """Make an AWS call through the dependency's circuit breaker.
+    
+    Idempotent calls are also retried with jittered backoff. Raises
+    DependencyUnavailable if the circuit is open or the dependency kept
+    failing with transient errors; other errors are raised unchanged.
+    """
+    breaker = breakers[dependency]
+    attempts = STAGE_RETRY_ATTEMPTS if idempotent else 1
+    try:
+        return retry_with_jitter(lambda: breaker.call(call), attempts=attempts, base_delay=STAGE_RETRY_BASE_DELAY,
+                                 max_delay=STAGE_RETRY_MAX_DELAY)
+    except DependencyUnavailable:
+        raise
+    except Exception as e:
+        if is_transient(e):
+            raise DependencyUnavailable(f"{dependency} unavailable: {str(e)}") from e
+        raise
+
+def get_verification_statuses(emails):
+    """Return {email: VerificationStatus or None}, querying SES only for
+    addresses missing from the cache, in batches of up to 100"""
+    now = time.monotonic()
+    statuses = {}
+    missing = []
+    with _verification_lock:
+        for email in dict.fromkeys(emails):
+            cached = _verification_cache.get(email)
+            if cached and cached[1] > now:
+                statuses[email] = cached[0]
+            else:
+                missing.append(email)
+    
+    for start in range(0, len(missing), SES_VERIFICATION_BATCH_SIZE):
+        chunk = missing[start:start + SES_VERIFICATION_BATCH_SIZE]
+        response = call_dependency(
+            'ses', lambda: ses.get_identity_verification_attributes(Identities=chunk), idempotent=True)
+        attributes = response.get('VerificationAttributes', {})
+        with _verification_lock:
+            for email in chunk:
+                status = attributes.get(email, {}).get('VerificationStatus')
+                ttl = SES_VERIFIED_TTL_SECONDS if status == 'Success' else SES_UNVERIFIED_TTL_SECONDS
+                _verification_cache[email] = (status, now + ttl)
+                statuses[email] = status
+    
+    return statuses
+
+def prefetch_verification_statuses(records):
+    """Resolve the recipients of a whole SQS batch up front, so the
+    per-order email step is served from the cache"""
+    if not os.getenv("SES_SENDER_EMAIL"):
+        return
+    emails = []
+    for record in records:
+        try:
+            email = json.loads(record['body']).get('shippingInfo', {}).get('email')
+        except Exception:
+            continue  # Reported when the record itself is processed
+        if email:
+            emails.append(email)
+    if not emails:
+        return
+    try:
+        get_verification_statuses(emails)
+    except Exception as e:
+        # Not fatal: each order falls back to looking up its own recipient
+        print(f"Could not prefetch SES verification statuses: {str(e)}")
+
+def register_confirmation_template():
+    """Create or refresh the SES confirmation template once per container,
+    so it always matches the templates deployed with this code"""
+    global _ses_template_registered
+    if _ses_template_registered:
+        return
+    template = ses_confirmation_template(SES_CONFIRMATION_TEMPLATE)
+    try:
+        ses.update_template(Template=template)
+    except ses.exceptions.TemplateDoesNotExistException:
+        ses.create_template(Template=template)
+    _ses_template_registered = True
+
+def send_bulk_confirmation_emails(email_outbox):
+    """Send queued confirmation emails with SendBulkTemplatedEmail.
+    
+    Returns the messageIds of the records whose email was not accepted.
+    """
+    sender_email = os.getenv("SES_SENDER_EMAIL")
+    failed_message_ids = set()
+    
+    try:
+        register_confirmation_template()
+    except Exception as e:
+        print(f"Could not register SES template {SES_CONFIRMATION_TEMPLATE}: {str(e)}")
+        return {email['messageId'] for email in email_outbox}
+    
+    for start in range(0, len(email_outbox), SES_BULK_BATCH_SIZE):
+        chunk = email_outbox[start:start + SES_BULK_BATCH_SIZE]
+        try:
+            destinations = [
+                {
+                    'Destination': {'ToAddresses': [email['email']]},
+                    'ReplacementTemplateData': json.dumps(email['data']),
+                }
+                for email in chunk
+            ]
+            response = call_dependency('ses', lambda: ses.send_bulk_templated_email(
+                Source=sender_email,
+                Template=SES_CONFIRMATION_TEMPLATE,
+                DefaultTemplateData=json.dumps({}),
+                Destinations=destinations
+            ))
+        except Exception as e:
+            print(f"Bulk email sending failed: {str(e)}")
+            failed_message_ids.update(email['messageId'] for email in chunk)
+            continue
+        
+        # Status entries are returned in the same order as the destinations
+        statuses = response.get('Status', [])
+        for index, email in enumerate(chunk):
+            status = statuses[index] if index < len(statuses) else {}
+            if status.get('Status') == 'Success':
+                print(f"Confirmation email sent to {email['email']} (MessageId: {status.get('MessageId')})")
+                mark_stage_completed(email['orderId'], 'email')
+            else:
+                print(f"Confirmation email to {email['email']} failed: {status.get('Status')} {status.get('Error', '')}")
+                failed_message_ids.add(email['messageId'])
+    
+    return failed_message_ids
+
+def store_invoice_bundle(invoice_outbox):
+    """Write the batch's invoices as one bundle and its orderId index, and
+    record each invoice's bundle, offset and length on its order.
+    
+    Returns the messageIds of the records whose invoice was not stored.
+    """
+    invoice_bucket = os.getenv("INVOICE_BUCKET")
+    try:
+        bundle, index = build_bundle([
+            {key: value for key, value in invoice.items() if key not in ('messageId', 'claimedAt')}
+            for invoice in invoice_outbox
+        ])
+        bundle_key, index_key = bundle_keys(datetime.utcnow())
+        
+        call_dependency('s3', lambda: s3.put_object(
+            Bucket=invoice_bucket,
+            Key=bundle_key,
+            Body=bundle,
+            ContentType='application/gzip',
+            Metadata={'invoiceCount': str(len(index))}
+        ), idempotent=True)
+        call_dependency('s3', lambda: s3.put_object(
+            Bucket=invoice_bucket,
+            Key=index_key,
+            Body=json.dumps({'bundle': bundle_key, 'invoices': index}).encode('utf-8'),
+            ContentType='application/json'
+        ), idempotent=True)
+        
+        print(f"{len(index)} invoices archived: s3://{invoice_bucket}/{bundle_key}")
+        # The location on the order lets an invoice be fetched without
+        # searching the day's bundle indexes
+        for order_id, location in index.items():
+            mark_stage_completed(order_id, 'invoice', {'invoiceLocation': dict(location, bundle=bundle_key)})
+        return set()
+        
+    except Exception as e:
+        print(f"Invoice bundle archival failed: {str(e)}")
+        return {invoice['messageId'] for invoice in invoice_outbox}
 
 def convert_decimals_to_float(obj):
     """Convert Decimal values back to float for JSON serialization"""
@@ -20,112 +317,419 @@ def convert_decimals_to_float(obj):
     else:
         return obj
 
+@instrument_handler
 def lambda_handler(event, context):
     """
     Process order messages from SQS - Phase 4 Implementation:
     1. Simulate payment gateway call
-    2. Send confirmation email via SES
-    3. Update order status to PROCESSED
+    2. Update order status to PROCESSED
+    3. Send confirmation email via SES
     4. Generate and store invoice in S3
     5. Clear user's cart (optional)
+    
+    Returns the partial batch response, listing the messageIds that failed.
     """
     
-    print(f"Processing {len(event.get('Records', []))} SQS messages")
+    records = event.get('Records', [])
+    print(f"Processing {len(records)} SQS messages")
     
-    # Process each SQS message
-    for record in event.get('Records', []):
-        try:
-            # Parse the SQS message body
-            message_body = json.loads(record['body'])
-            print(f"Processing order: {message_body}")
-            
-            # Extract order information
-            order_id = message_body.get('orderId')
-            user_id = message_body.get('userId')
-            total = message_body.get('total')
-            items = message_body.get('items', [])
-            shipping_info = message_body.get('shippingInfo', {})
-            
-            if not order_id:
-                print("Error: No orderId in message")
-                continue
-            
-            # Process the order
-            success = process_single_order(order_id, user_id, total, items, shipping_info)
-            
-            if success:
-                print(f"Successfully processed order {order_id}")
-            else:
-                print(f"Failed to process order {order_id}")
-                
-        except Exception as e:
-            print(f"Error processing SQS record: {str(e)}")
-            # In production, you might want to send failed messages to a DLQ
-            continue
+    # Report only the messages that failed so SQS redelivers those (and
+    # eventually moves them to the DLQ) without replaying the whole batch.
+    # Requires ReportBatchItemFailures on the event source mapping.
+    batch_item_failures = []
+    
+    prefetch_verification_statuses(records)
+    
+    # Side effects that are batched across the records of the invocation
+    outbox = {}
+    if EMAIL_SEND_MODE == 'bulk':
+        outbox['emails'] = []
+    if INVOICE_ARCHIVE_MODE == 'bundle':
+        outbox['invoices'] = []
     
-    return {"statusCode": 200, "body": json.dumps({"message": "Orders processed"})}
+    if ORDER_CONCURRENCY > 1 and len(records) > 1:
+        # process_record never raises, so one bad record can't affect the rest
+        results = list(get_executor().map(lambda record: process_record(record, outbox), records))
+    else:
+        results = [process_record(record, outbox) for record in records]
+    
+    failed_message_ids = {record['messageId'] for record, success in zip(records, results) if not success}
+    if outbox.get('emails'):
+        with timed('bulk-email'):
+            failed_message_ids |= send_bulk_confirmation_emails(outbox['emails'])
+    if outbox.get('invoices'):
+        with timed('invoice-bundle'):
+            failed_message_ids |= store_invoice_bundle(outbox['invoices'])
+    
+    # Orders whose batched step failed are redelivered; let them resume at once
+    released = set()
+    for entry in outbox.get('emails', []) + outbox.get('invoices', []):
+        if entry['messageId'] in failed_message_ids and entry['orderId'] not in released:
+            released.add(entry['orderId'])
+            release_claim(entry['orderId'], entry['claimedAt'])
+    
+    for record in records:
+        if record['messageId'] in failed_message_ids:
+            batch_item_failures.append({"itemIdentifier": record['messageId']})
+    
+    if batch_item_failures:
+        print(f"{len(batch_item_failures)} of {len(records)} messages failed and will be retried")
+    
+    return {"batchItemFailures": batch_item_failures}
 
-def process_single_order(order_id, user_id, total, items, shipping_info):
-    """Process a single order through all phases"""
+def process_record(record, outbox=None):
+    """Process one SQS record, returning False if the message should be retried.
+    
+    outbox maps the batched side effects ('emails', 'invoices') to lists.
+    Those steps are not performed per order; their payloads are appended to
+    the outbox, tagged with the record's messageId, once the order succeeds.
+    """
     try:
-        # Phase 4.1: Simulate payment gateway call
-        payment_success = simulate_payment_gateway(order_id, total)
-        if not payment_success:
-            print(f"Payment failed for order {order_id}")
-            update_order_status(order_id, "PAYMENT_FAILED")
+        # Parse the SQS message body
+        message_body = json.loads(record['body'])
+        print(f"Processing order: {message_body}")
+        
+        # Extract order information
+        order_id = message_body.get('orderId')
+        user_id = message_body.get('userId')
+        total = message_body.get('total')
+        items = message_body.get('items', [])
+        shipping_info = message_body.get('shippingInfo', {})
+        
+        if not order_id:
+            # Retrying won't fix a malformed message, but failing it routes it
+            # to the DLQ where it can be inspected instead of being dropped
+            print(f"Error: No orderId in message {record.get('messageId')}")
             return False
         
-        # Phase 4.2: Send confirmation email
-        email_success = send_confirmation_email(order_id, shipping_info, items, total)
-        if not email_success:
-            print(f"Email sending failed for order {order_id}")
-            # Continue processing even if email fails
-        
-        # Phase 4.3: Update order status to PROCESSED
-        update_success = update_order_status(order_id, "PROCESSED")
-        if not update_success:
-            print(f"Failed to update order status for {order_id}")
-            return False
+        # Process the order
+        deferred = {kind: [] for kind in outbox} if outbox else None
+        success = process_single_order(order_id, user_id, total, items, shipping_info, deferred,
+                                       deferrals=message_body.get('deferrals', 0))
+        if success and deferred:
+            with _outbox_lock:
+                for kind, entries in deferred.items():
+                    outbox[kind].extend(dict(entry, messageId=record['messageId']) for entry in entries)
+        
+        if success:
+            print(f"Successfully processed order {order_id}")
+        else:
+            print(f"Failed to process order {order_id}")
+        return success
         
-        # Phase 4.4: Generate and store invoice in S3
-        invoice_success = generate_and_store_invoice(order_id, user_id, items, total, shipping_info)
-        if not invoice_success:
-            print(f"Invoice generation failed for order {order_id}")
-            # Continue processing even if invoice fails
+    except Exception as e:
+        print(f"Error processing SQS record {record.get('messageId')}: {str(e)}")
+        return False
+
+def process_single_order(order_id, user_id, total, items, shipping_info, deferred=None, deferrals=0):
+    """Process a single order through all phases.
+    
+    SQS delivers at least once, so the order is first claimed (see
+    claim_order). If it was seen before, stages recorded in completedStages
+    are skipped, and an order already in a final state is acknowledged
+    without doing any work. A delivery that fails or leaves stages
+    unfinished releases its claim, so the next one can resume them at once.
+    Entries added to deferred carry the claim's claimedAt, for the caller to
+    release it if the batched step fails.
+    
+    Stages that fail because the payment gateway, SES, S3 or DynamoDB is
+    unavailable are deferred: the order is sent back to the queue to finish
+    them later. deferrals is the number of times that has already happened.
+    
+    Returns False if the message should be retried.
+    """
+    claim = None
+    try:
+        claim = claim_order(order_id)
+        if claim is None:
+            return False
         
-        # Phase 4.5: Clear user's cart (optional)
-        clear_cart_success = clear_user_cart(user_id)
-        if not clear_cart_success:
-            print(f"Failed to clear cart for user {user_id}")
-            # Continue processing even if cart clearing fails
+        completed = claim['completedStages']
+        if claim['status'] == 'PAYMENT_FAILED' or (claim['status'] == 'PROCESSED' and completed >= set(ORDER_STAGES)):
+            print(f"Order {order_id} already {claim['status']} - skipping duplicate delivery")
+            return True
+        if completed:
+            print(f"Resuming order {order_id}, already completed: {sorted(completed)}")
+        
+        outcome = {}
+        unavailable = []
+        
+        def deferrable(name, run):
+            @timed(name)
+            def stage():
+                try:
+                    return run()
+                except DependencyUnavailable as e:
+                    print(f"Stage {name} of order {order_id} deferred: {str(e)}")
+                    unavailable.append(name)
+                    return False
+            return stage
+        
+        # Phase 4.1: Simulate payment gateway call, then mark the order PROCESSED
+        def payment_stage():
+            if not process_payment(order_id, total):
+                print(f"Payment failed for order {order_id}")
+                outcome['declined'] = True
+                # A declined payment is final, so there is nothing to retry
+                outcome['recorded'] = update_order_status(order_id, "PAYMENT_FAILED", expected_status="PROCESSING")
+                return False
+            
+            update_success = update_order_status(order_id, "PROCESSED", expected_status="PROCESSING",
+                                                 completed_stage='payment')
+            if not update_success:
+                print(f"Failed to update order status for {order_id}")
+            return update_success
         
-        return True
+        # Phase 4.2: Send confirmation email
+        def email_stage():
+            emails = deferred.get('emails') if deferred else None
+            if not send_confirmation_email(order_id, shipping_info, items, total, emails):
+                print(f"Email sending failed for order {order_id}")
+                return False
+            if emails is None:
+                mark_stage_completed(order_id, 'email')
+            return True
+        
+        # Phase 4.3: Generate and store invoice in S3
+        def invoice_stage():
+            invoices = deferred.get('invoices') if deferred else None
+            if not generate_and_store_invoice(order_id, user_id, items, total, shipping_info, invoices):
+                print(f"Invoice generation failed for order {order_id}")
+                return False
+            if invoices is None:
+                mark_stage_completed(order_id, 'invoice')
+            return True
+        
+        # Phase 4.4: Clear user's cart
+        def cart_stage():
+            if not clear_user_cart(user_id):
+                print(f"Failed to clear cart for user {user_id}")
+                return False
+            mark_stage_completed(order_id, 'cart')
+            return True
+        
+        # Once payment succeeds the remaining stages are independent, so they
+        # run concurrently. Failures of optional stages don't fail the order.
+        stages = [
+            Stage('payment', deferrable('payment', payment_stage), timeout=STAGE_TIMEOUTS['payment']),
+            Stage('email', deferrable('email', email_stage), depends_on=['payment'],
+                  timeout=STAGE_TIMEOUTS['email'], required=False),
+            Stage('invoice', deferrable('invoice', invoice_stage), depends_on=['payment'],
+                  timeout=STAGE_TIMEOUTS['invoice'], required=False),
+            Stage('cart', deferrable('cart', cart_stage), depends_on=['payment'],
+                  timeout=STAGE_TIMEOUTS['cart'], required=False),
+        ]
+        succeeded, results = run_stages(stages, get_stage_executor(), completed=completed)
+        
+        if outcome.get('declined'):
+            if not outcome['recorded']:
+                release_claim(order_id, claim['claimedAt'])
+            return outcome['recorded']
+        if unavailable or not all(results.values()):
+            release_claim(order_id, claim['claimedAt'])
+        if unavailable:
+            message = {
+                'orderId': order_id,
+                'userId': user_id,
+                'total': total,
+                'items': items,
+                'shippingInfo': shipping_info,
+            }
+            return defer_order(message, deferrals, unavailable)
+        if succeeded and deferred:
+            for entries in deferred.values():
+                for entry in entries:
+                    entry['claimedAt'] = claim['claimedAt']
+        return succeeded
         
     except Exception as e:
         print(f"Error processing order {order_id}: {str(e)}")
+        if claim is not None:
+            release_claim(order_id, claim['claimedAt'])
         return False
 
-def simulate_payment_gateway(order_id, total):
-    """Simulate a payment gateway call"""
+def defer_order(message, deferrals, stages):
+    """Send an order back to the queue with a jittered, growing delay so
+    its unfinished stages run once the dependency has recovered.
+    
+    Returns False if the order could not be deferred, in which case the
+    record is reported as failed and redelivered by SQS instead.
+    """
+    order_id = message['orderId']
+    if not RETRY_QUEUE_URL:
+        print(f"No retry queue configured - order {order_id} will be redelivered")
+        return False
+    if deferrals >= ORDER_MAX_DEFERRALS:
+        print(f"Order {order_id} was deferred {deferrals} times - leaving it to SQS redrive")
+        return False
+    
+    delay = ORDER_RETRY_DELAY_SECONDS * 2 ** deferrals
+    delay = min(SQS_MAX_DELAY_SECONDS, int(random.uniform(delay / 2, delay)))
     try:
-        print(f"Simulating payment gateway call for order {order_id}")
-        print(f"Processing payment of ${total}")
-        
-        # Simulate payment processing time and logic
-        # In a real system, this would call Stripe, PayPal, etc.
-        
-        # For demo purposes, assume payment always succeeds
-        # You could add logic to randomly fail some payments for testing
-        
-        print(f"Payment successful for order {order_id}")
+        sqs.send_message(
+            QueueUrl=RETRY_QUEUE_URL,
+            MessageBody=json.dumps(dict(message, deferrals=deferrals + 1)),
+            DelaySeconds=delay
+        )
+        print(f"Order {order_id} deferred for {delay}s, unfinished stages: {sorted(stages)}")
         return True
-        
     except Exception as e:
-        print(f"Payment gateway error for order {order_id}: {str(e)}")
+        print(f"Failed to defer order {order_id}: {str(e)}")
         return False
 
-def send_confirmation_email(order_id, shipping_info, items, total):
-    """Send order confirmation email via SES"""
+def claim_order(order_id):
+    """Claim an order for this delivery with conditional writes.
+    
+    A PENDING order moves to PROCESSING, stamped with claimedAt. An order
+    seen before and not yet final is in flight while its claimedAt is
+    younger than ORDER_CLAIM_LEASE_SECONDS: another delivery is working on
+    it, so this one fails and SQS redelivers it later. Past the lease (or
+    once released) the claim is taken over, on condition that claimedAt is
+    still the one read, so only one of several late deliveries resumes it.
+    
+    Returns {'status', 'completedStages'} as they were before this delivery
+    and this delivery's 'claimedAt', or None if the order could not be
+    claimed, is in flight or does not exist.
+    """
+    claimed_at = datetime.utcnow().isoformat() + 'Z'
+    try:
+        orders_table = get_dynamodb().Table(os.environ["ORDERS_TABLE"])
+        call_dependency('dynamodb', lambda: orders_table.update_item(
+            Key={'orderId': order_id},
+            UpdateExpression='SET #status = :processing, #claimedAt = :claimedAt',
+            ConditionExpression='#status = :pending',
+            ExpressionAttributeNames={
+                '#status': 'status',
+                '#claimedAt': 'claimedAt'
+            },
+            ExpressionAttributeValues={
+                ':pending': 'PENDING',
+                ':processing': 'PROCESSING',
+                ':claimedAt': claimed_at
+            },
+            # The failed write returns the current item, so detecting a
+            # duplicate delivery costs no extra read
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        ))
+        return {'status': 'PENDING', 'completedStages': set(), 'claimedAt': claimed_at}
+        
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print(f"Failed to claim order {order_id}: {str(e)}")
+            return None
+        if 'Item' not in e.response:
+            print(f"Order {order_id} not found")
+            return None
+        current = {key: _deserializer.deserialize(value) for key, value in e.response['Item'].items()}
+    except Exception as e:
+        print(f"Failed to claim order {order_id}: {str(e)}")
+        return None
+    
+    claim = {
+        'status': current.get('status'),
+        'completedStages': set(current.get('completedStages', set())),
+        'claimedAt': claimed_at
+    }
+    if claim['status'] == 'PAYMENT_FAILED' or (claim['status'] == 'PROCESSED'
+                                               and claim['completedStages'] >= set(ORDER_STAGES)):
+        return claim
+    
+    previous = current.get('claimedAt')
+    if previous is not None and lease_age_seconds(previous) < ORDER_CLAIM_LEASE_SECONDS:
+        print(f"Order {order_id} is in flight since {previous} - retrying later")
+        return None
+    try:
+        orders_table = get_dynamodb().Table(os.environ["ORDERS_TABLE"])
+        call_dependency('dynamodb', lambda: orders_table.update_item(
+            Key={'orderId': order_id},
+            UpdateExpression='SET #claimedAt = :claimedAt',
+            ConditionExpression='#claimedAt = :previous' if previous is not None
+            else 'attribute_not_exists(#claimedAt)',
+            ExpressionAttributeNames={'#claimedAt': 'claimedAt'},
+            ExpressionAttributeValues={':claimedAt': claimed_at,
+                                       **({':previous': previous} if previous is not None else {})}
+        ))
+        print(f"Took over order {order_id} from the claim of {previous}")
+        return claim
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f"Order {order_id} was taken over by another delivery - retrying later")
+        else:
+            print(f"Failed to claim order {order_id}: {str(e)}")
+        return None
+    except Exception as e:
+        print(f"Failed to claim order {order_id}: {str(e)}")
+        return None
+
+def lease_age_seconds(claimed_at):
+    """Seconds since a claimedAt timestamp; unparseable ones count as expired"""
+    try:
+        return (datetime.utcnow() - datetime.fromisoformat(claimed_at.rstrip('Z'))).total_seconds()
+    except (AttributeError, TypeError, ValueError):
+        return float('inf')
+
+def release_claim(order_id, claimed_at):
+    """Give up this delivery's claim so the next delivery of the order need
+    not wait out the lease. A failure only delays that delivery."""
+    try:
+        orders_table = get_dynamodb().Table(os.environ["ORDERS_TABLE"])
+        call_dependency('dynamodb', lambda: orders_table.update_item(
+            Key={'orderId': order_id},
+            UpdateExpression='REMOVE #claimedAt',
+            ConditionExpression='#claimedAt = :claimedAt',
+            ExpressionAttributeNames={'#claimedAt': 'claimedAt'},
+            ExpressionAttributeValues={':claimedAt': claimed_at}
+        ), idempotent=True)
+    except Exception as e:
+        print(f"Failed to release the claim on order {order_id}: {str(e)}")
+
+def mark_stage_completed(order_id, stage, attributes=None):
+    """Record a finished side effect so redeliveries skip it, setting any
+    attributes that describe its result on the order"""
+    try:
+        orders_table = get_dynamodb().Table(os.environ["ORDERS_TABLE"])
+        update_expression = 'ADD #completedStages :stage'
+        names = {'#completedStages': 'completedStages'}
+        values = {':stage': {stage}}
+        if attributes:
+            assignments = []
+            for i, (name, value) in enumerate(attributes.items()):
+                names[f'#a{i}'] = name
+                values[f':a{i}'] = value
+                assignments.append(f'#a{i} = :a{i}')
+            update_expression = f"SET {', '.join(assignments)} {update_expression}"
+        call_dependency('dynamodb', lambda: orders_table.update_item(
+            Key={'orderId': order_id},
+            UpdateExpression=update_expression,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        ), idempotent=True)
+        return True
+    except Exception as e:
+        # Worst case the stage is repeated if this message is redelivered
+        print(f"Failed to record stage {stage} for order {order_id}: {str(e)}")
+        return False
+
+def process_payment(order_id, total):
+    """Charge the order through the configured payment client.
+    
+    Returns True if the payment was approved and False if it was declined.
+    Gateway timeouts and errors are retried with the orderId as idempotency
+    key; if they persist, DependencyUnavailable is raised and the order is
+    deferred rather than marked PAYMENT_FAILED.
+    """
+    print(f"Processing payment of ${total} for order {order_id}")
+    approved = call_dependency('payments', lambda: payment_client.charge(order_id, total), idempotent=True)
+    
+    if approved:
+        print(f"Payment successful for order {order_id}")
+    else:
+        print(f"Payment declined for order {order_id}")
+    return approved
+
+def send_confirmation_email(order_id, shipping_info, items, total, deferred_emails=None):
+    """Send order confirmation email via SES, or queue it on deferred_emails
+    when the batch is sent in bulk"""
     try:
         sender_email = os.getenv("SES_SENDER_EMAIL")
         if not sender_email:
@@ -139,9 +743,8 @@ def send_confirmation_email(order_id, shipping_info, items, total):
         
         # Check if the customer email is verified in SES (required for sandbox mode)
         try:
-            # Try to get the verification status of the customer email
-            response = ses.get_identity_verification_attributes(Identities=[customer_email])
-            verification_status = response.get('VerificationAttributes', {}).get(customer_email, {}).get('VerificationStatus')
+            # Usually answered from the cache filled by the batch prefetch
+            verification_status = get_verification_statuses([customer_email])[customer_email]
             
             if verification_status != 'Success':
                 print(f"ERROR: Customer email '{customer_email}' is not verified in SES")
@@ -152,92 +755,30 @@ def send_confirmation_email(order_id, shipping_info, items, total):
             else:
                 print(f"Customer email {customer_email} is verified in SES - proceeding with email")
                 
+        except DependencyUnavailable:
+            raise
         except Exception as e:
             print(f"ERROR: Could not check verification status for {customer_email}: {str(e)}")
             print(f"This may indicate SES permission issues or the email is not verified")
             return False
         
-        customer_name = shipping_info.get('name', 'Valued Customer')
-        
         # Create email content
-        subject = f"Order Confirmation - Order #{order_id[:8]}"
+        order_date = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
         
-        # Create items list for email
-        items_text = ""
-        for item in items:
-            product_name = item.get('product', {}).get('name', 'Unknown Product')
-            quantity = item.get('quantity', 1)
-            price = item.get('product', {}).get('price', 0)
-            items_text += f"- {product_name} (Qty: {quantity}) - ${price:.2f}\n"
-        
-        # Email body
-        body_text = f"""
-Dear {customer_name},
-
-Thank you for your order! We're excited to confirm that we've received your order and it's being processed.
-
-Order Details:
-Order ID: {order_id}
-Order Date: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC
-
-Items Ordered:
-{items_text}
-
-Total: ${total:.2f}
-
-Shipping Address:
-{shipping_info.get('name', '')}
-{shipping_info.get('address', '')}
-{shipping_info.get('city', '')}, {shipping_info.get('zipCode', '')}
-
-Your order is now being processed and you'll receive another email when it ships.
-
-Thank you for shopping with us!
-
-Best regards,
-CloudShop Team
-        """
+        if deferred_emails is not None:
+            # Bulk mode: the whole batch is sent with one templated call later
+            deferred_emails.append({
+                'orderId': order_id,
+                'email': customer_email,
+                'data': confirmation_values(order_id, order_date, shipping_info, items, total),
+            })
+            return True
         
-        body_html = f"""
-<html>
-<head></head>
-<body>
-    <h2>Order Confirmation</h2>
-    <p>Dear {customer_name},</p>
-    
-    <p>Thank you for your order! We're excited to confirm that we've received your order and it's being processed.</p>
-    
-    <h3>Order Details:</h3>
-    <ul>
-        <li><strong>Order ID:</strong> {order_id}</li>
-        <li><strong>Order Date:</strong> {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC</li>
-    </ul>
-    
-    <h3>Items Ordered:</h3>
-    <ul>
-        {"".join([f"<li>{item.get('product', {}).get('name', 'Unknown Product')} (Qty: {item.get('quantity', 1)}) - ${item.get('product', {}).get('price', 0):.2f}</li>" for item in items])}
-    </ul>
-    
-    <h3>Total: ${total:.2f}</h3>
-    
-    <h3>Shipping Address:</h3>
-    <p>
-        {shipping_info.get('name', '')}<br>
-        {shipping_info.get('address', '')}<br>
-        {shipping_info.get('city', '')}, {shipping_info.get('zipCode', '')}
-    </p>
-    
-    <p>Your order is now being processed and you'll receive another email when it ships.</p>
-    
-    <p>Thank you for shopping with us!</p>
-    
-    <p>Best regards,<br>CloudShop Team</p>
-</body>
-</html>
-        """
+        subject, body_text, body_html = render_confirmation_email(order_id, order_date, shipping_info, items, total)
         
         # Send email via SES
-        response = ses.send_email(
+        # Not retried here: a send that timed out may still have been delivered
+        response = call_dependency('ses', lambda: ses.send_email(
             Source=sender_email,
             Destination={'ToAddresses': [customer_email]},
             Message={
@@ -247,39 +788,51 @@ CloudShop Team
                     'Html': {'Data': body_html, 'Charset': 'UTF-8'}
                 }
             }
-        )
+        ))
         
         print(f"Confirmation email sent to {customer_email} (MessageId: {response['MessageId']})")
         return True
         
+    except DependencyUnavailable:
+        raise
     except Exception as e:
         print(f"Email sending failed: {str(e)}")
         return False
 
-def update_order_status(order_id, new_status):
-    """Update order status in DynamoDB"""
+def update_order_status(order_id, new_status, expected_status=None, completed_stage=None):
+    """Update order status in DynamoDB, optionally only from expected_status
+    and recording a completed stage in the same write"""
     try:
         orders_table_name = os.getenv("ORDERS_TABLE")
         if not orders_table_name:
             print("ORDERS_TABLE environment variable not set")
             return False
         
-        orders_table = dynamodb.Table(orders_table_name)
+        orders_table = get_dynamodb().Table(orders_table_name)
         
-        # Update the order status
-        response = orders_table.update_item(
-            Key={'orderId': order_id},
-            UpdateExpression='SET #status = :status, #processedAt = :processedAt',
-            ExpressionAttributeNames={
+        update_kwargs = {
+            'Key': {'orderId': order_id},
+            'UpdateExpression': 'SET #status = :status, #processedAt = :processedAt',
+            'ExpressionAttributeNames': {
                 '#status': 'status',
                 '#processedAt': 'processedAt'
             },
-            ExpressionAttributeValues={
+            'ExpressionAttributeValues': {
                 ':status': new_status,
                 ':processedAt': datetime.utcnow().isoformat() + 'Z'
             },
-            ReturnValues='UPDATED_NEW'
-        )
+            'ReturnValues': 'UPDATED_NEW'
+        }
+        if expected_status:
+            update_kwargs['ConditionExpression'] = '#status = :expected'
+            update_kwargs['ExpressionAttributeValues'][':expected'] = expected_status
+        if completed_stage:
+            update_kwargs['UpdateExpression'] += ' ADD #completedStages :stage'
+            update_kwargs['ExpressionAttributeNames']['#completedStages'] = 'completedStages'
+            update_kwargs['ExpressionAttributeValues'][':stage'] = {completed_stage}
+        
+        # Update the order status
+        call_dependency('dynamodb', lambda: orders_table.update_item(**update_kwargs))
         
         print(f"Order {order_id} status updated to {new_status}")
         return True
@@ -288,8 +841,9 @@ def update_order_status(order_id, new_status):
         print(f"Failed to update order status: {str(e)}")
         return False
 
-def generate_and_store_invoice(order_id, user_id, items, total, shipping_info):
-    """Generate invoice and store in S3"""
+def generate_and_store_invoice(order_id, user_id, items, total, shipping_info, deferred_invoices=None):
+    """Generate invoice and store in S3, or queue it on deferred_invoices
+    when the batch is archived as a bundle"""
     try:
         invoice_bucket = os.getenv("INVOICE_BUCKET")
         if not invoice_bucket:
@@ -297,53 +851,24 @@ def generate_and_store_invoice(order_id, user_id, items, total, shipping_info):
             return False
         
         # Generate invoice content
-        invoice_date = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        
-        invoice_content = f"""
-CLOUDSHOP INVOICE
-================
-
-Invoice Date: {invoice_date} UTC
-Order ID: {order_id}
-Customer ID: {user_id}
-
-BILLING INFORMATION:
-{shipping_info.get('name', '')}
-{shipping_info.get('email', '')}
-{shipping_info.get('address', '')}
-{shipping_info.get('city', '')}, {shipping_info.get('zipCode', '')}
-
-ITEMS:
-------
-"""
-        
-        subtotal = 0
-        for item in items:
-            product_name = item.get('product', {}).get('name', 'Unknown Product')
-            quantity = item.get('quantity', 1)
-            price = item.get('product', {}).get('price', 0)
-            line_total = quantity * price
-            subtotal += line_total
-            
-            invoice_content += f"{product_name:<30} Qty: {quantity:>3} @ ${price:>8.2f} = ${line_total:>8.2f}\n"
+        now = datetime.utcnow()
+        invoice_date = now.strftime('%Y-%m-%d %H:%M:%S')
+        invoice_content = render_invoice(order_id, user_id, invoice_date, shipping_info, items, total)
         
-        invoice_content += f"""
-------
-Subtotal: ${subtotal:>8.2f}
-Tax:      ${0:>8.2f}
-------
-TOTAL:    ${total:>8.2f}
-
-Thank you for your business!
-
-This is an automated invoice generated by CloudShop.
-For questions, please contact support@cloudshop.com
-        """
+        if deferred_invoices is not None:
+            deferred_invoices.append({
+                'orderId': order_id,
+                'userId': user_id,
+                'total': str(total),
+                'generatedAt': invoice_date,
+                'content': invoice_content,
+            })
+            return True
         
         # Store invoice in S3
-        invoice_key = f"invoices/{datetime.utcnow().strftime('%Y/%m/%d')}/{order_id}.txt"
+        invoice_key = f"invoices/{now.strftime('%Y/%m/%d')}/{order_id}.txt"
         
-        s3.put_object(
+        call_dependency('s3', lambda: s3.put_object(
             Bucket=invoice_bucket,
             Key=invoice_key,
             Body=invoice_content.encode('utf-8'),
@@ -354,11 +879,13 @@ For questions, please contact support@cloudshop.com
                 'total': str(total),
                 'generatedAt': invoice_date
             }
-        )
+        ), idempotent=True)
         
         print(f"Invoice generated and stored: s3://{invoice_bucket}/{invoice_key}")
         return True
         
+    except DependencyUnavailable:
+        raise
     except Exception as e:
         print(f"Invoice generation failed: {str(e)}")
         return False
@@ -371,21 +898,23 @@ def clear_user_cart(user_id):
             print("CARTS_TABLE environment variable not set")
             return False
         
-        carts_table = dynamodb.Table(carts_table_name)
+        carts_table = get_dynamodb().Table(carts_table_name)
         
         # Clear the cart by setting items to empty array
         # Note: 'items' is a reserved keyword in DynamoDB, so we use ExpressionAttributeNames
-        carts_table.update_item(
+        call_dependency('dynamodb', lambda: carts_table.update_item(
             Key={'userId': user_id},
             UpdateExpression='SET #items = :empty_items',
             ExpressionAttributeNames={'#items': 'items'},
             ExpressionAttributeValues={':empty_items': []},
             ReturnValues='UPDATED_NEW'
-        )
+        ), idempotent=True)
         
         print(f"Cart cleared for user {user_id}")
         return True
         
+    except DependencyUnavailable:
+        raise
     except Exception as e:
         print(f"Failed to clear cart: {str(e)}")
         return False
@@ -0,0 +1,39 @@
+import gzip
+import json
+import uuid
+
+def build_bundle(invoices):
+    """Pack invoices into one gzip NDJSON bundle.
+
+    Every invoice is compressed as its own gzip member. Concatenated members
+    are still a valid gzip file, so the whole bundle decompresses to NDJSON
+    with standard tools, while a single invoice can be read back on its own
+    with a ranged GET of its member.
+
+    Returns (bundle bytes, {orderId: {'offset': ..., 'length': ...}}).
+    """
+    members = []
+    index = {}
+    offset = 0
+    for invoice in invoices:
+        line = json.dumps(invoice, separators=(',', ':')) + '\n'
+        member = gzip.compress(line.encode('utf-8'), mtime=0)
+        index[invoice['orderId']] = {'offset': offset, 'length': len(member)}
+        members.append(member)
+        offset += len(member)
+    return b''.join(members), index
+
+def bundle_keys(now):
+    """S3 keys of a new bundle and its index under the day's invoice prefix"""
+    name = f"bundle-{now.strftime('%H%M%S')}-{uuid.uuid4().hex[:12]}"
+    prefix = f"invoices/{now.strftime('%Y/%m/%d')}/{name}"
+    return f"{prefix}.ndjson.gz", f"{prefix}.index.json"
+
+def read_bundled_invoice(s3, bucket, bundle_key, offset, length):
+    """Fetch one invoice record from a bundle with a ranged GET"""
+    response = s3.get_object(
+        Bucket=bucket,
+        Key=bundle_key,
+        Range=f"bytes={offset}-{offset + length - 1}"
+    )
+    return json.loads(gzip.decompress(response['Body'].read()))
@@ -0,0 +1,124 @@
+import math
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from resilience import TransientError
+
+class PaymentTimeout(TransientError):
+    """The gateway did not answer in time; the charge may be retried with
+    the same idempotency key"""
+
+class PaymentGatewayError(TransientError):
+    """The gateway failed to process the charge (e.g. a 5xx response)"""
+
+class PaymentClient(ABC):
+    """Interface of a payment gateway.
+
+    charge returns True if the payment was approved and False if it was
+    declined, which is final. It raises a TransientError when the outcome is
+    unknown and the charge should be retried. order_id doubles as the
+    idempotency key, so retrying a charge never takes payment twice.
+
+    timeout_seconds is the longest one charge may wait for the gateway.
+    """
+
+    timeout_seconds = 0.0
+
+    @abstractmethod
+    def charge(self, order_id, amount):
+        """Charge amount for order_id"""
+
+class ApprovingPaymentClient(PaymentClient):
+    """Approves every payment immediately"""
+
+    def charge(self, order_id, amount):
+        return True
+
+class SimulatedPaymentGateway(PaymentClient):
+    """Gateway simulator for load tests.
+
+    Latency is sampled from a distribution: 'fixed' (always median_ms),
+    'uniform' (0 to 2 x median_ms) or 'lognormal' (median median_ms, shape
+    sigma, with the long tail of real gateways). A sample above
+    timeout_seconds waits timeout_seconds and raises PaymentTimeout. Of the
+    remaining charges, error_rate fail with PaymentGatewayError and
+    decline_rate are declined.
+
+    With a seed, each (order, attempt) draws from its own generator, so a
+    run is reproducible however the orders are spread across threads. An
+    order's attempts are forgotten once its charge is approved or declined,
+    and at most MAX_TRACKED_ORDERS orders still retrying are remembered.
+    """
+
+    DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+    MAX_TRACKED_ORDERS = 10000
+
+    def __init__(self, distribution='lognormal', median_ms=150, sigma=0.5, decline_rate=0.0,
+                 error_rate=0.0, timeout_seconds=5.0, seed=None, sleep=time.sleep):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {distribution}, expected one of {self.DISTRIBUTIONS}")
+        self.distribution = distribution
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.decline_rate = decline_rate
+        self.error_rate = error_rate
+        self.timeout_seconds = timeout_seconds
+        self.seed = seed
+        self.sleep = sleep
+        self._attempts = OrderedDict()
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def _generator(self, order_id):
+        if self.seed is None:
+            return self._random
+        with self._lock:
+            attempt = self._attempts.pop(order_id, 0)
+            self._attempts[order_id] = attempt + 1
+            if len(self._attempts) > self.MAX_TRACKED_ORDERS:
+                self._attempts.popitem(last=False)
+        return random.Random(f"{self.seed}:{order_id}:{attempt}")
+
+    def sample_latency(self, rng):
+        """Latency of one charge in seconds"""
+        if self.distribution == 'fixed':
+            return self.median_ms / 1000
+        if self.distribution == 'uniform':
+            return rng.uniform(0, 2 * self.median_ms) / 1000
+        return self.median_ms * math.exp(rng.gauss(0, self.sigma)) / 1000
+
+    def charge(self, order_id, amount):
+        rng = self._generator(order_id)
+        latency = self.sample_latency(rng)
+        if latency > self.timeout_seconds:
+            self.sleep(self.timeout_seconds)
+            raise PaymentTimeout(f"Payment gateway timed out after {self.timeout_seconds}s")
+        self.sleep(latency)
+        outcome = rng.random()
+        if outcome < self.error_rate:
+            raise PaymentGatewayError("Payment gateway error")
+        with self._lock:
+            self._attempts.pop(order_id, None)
+        return outcome >= self.error_rate + self.decline_rate
+
+def payment_client_from_env():
+    """Build the payment client selected by PAYMENT_GATEWAY ('approve' or
+    'simulated') and the PAYMENT_* settings"""
+    gateway = os.getenv("PAYMENT_GATEWAY", "approve")
+    if gateway == 'approve':
+        return ApprovingPaymentClient()
+    if gateway == 'simulated':
+        seed = os.getenv("PAYMENT_SEED")
+        return SimulatedPaymentGateway(
+            distribution=os.getenv("PAYMENT_LATENCY_DISTRIBUTION", "lognormal"),
+            median_ms=float(os.getenv("PAYMENT_LATENCY_MEDIAN_MS", "150")),
+            sigma=float(os.getenv("PAYMENT_LATENCY_SIGMA", "0.5")),
+            decline_rate=float(os.getenv("PAYMENT_DECLINE_RATE", "0")),
+            error_rate=float(os.getenv("PAYMENT_ERROR_RATE", "0")),
+            timeout_seconds=float(os.getenv("PAYMENT_TIMEOUT_SECONDS", "5")),
+            seed=int(seed) if seed else None
+        )
+    raise ValueError(f"Unknown PAYMENT_GATEWAY {gateway}, expected approve or simulated")
@@ -0,0 +1,73 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+class Stage:
+    """One step of a stage graph.
+
+    run is called with no arguments and returns True on success. A stage
+    starts once every stage in depends_on has succeeded; if one of them
+    fails, the stage is not run and counts as failed. A stage still running
+    after timeout seconds is reported as failed (its thread cannot be
+    stopped, so it finishes in the background). Only required stages decide
+    whether the pipeline as a whole succeeded.
+    """
+
+    def __init__(self, name, run, depends_on=(), timeout=None, required=True):
+        self.name = name
+        self.run = run
+        self.depends_on = tuple(depends_on)
+        self.timeout = timeout
+        self.required = required
+
+def run_stages(stages, executor, completed=()):
+    """Run a stage graph, starting independent stages concurrently.
+
+    Stages named in completed are treated as already succeeded and skipped.
+    Returns (succeeded, {stage name: True/False}), where succeeded is False
+    if any required stage failed.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        unknown = set(stage.depends_on) - set(by_name)
+        if unknown:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages {sorted(unknown)}")
+
+    results = {name: True for name in completed if name in by_name}
+    running = {}  # future -> (stage, deadline)
+
+    def start_ready_stages():
+        for stage in stages:
+            if stage.name in results or any(stage is running_stage for running_stage, _ in running.values()):
+                continue
+            dependency_results = [results.get(dependency) for dependency in stage.depends_on]
+            if False in dependency_results:
+                results[stage.name] = False
+            elif None not in dependency_results:
+                deadline = time.monotonic() + stage.timeout if stage.timeout else None
+                running[executor.submit(stage.run)] = (stage, deadline)
+
+    start_ready_stages()
+    while running:
+        deadlines = [deadline for _, deadline in running.values() if deadline is not None]
+        wait_for = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+        done, _ = wait(list(running), timeout=wait_for, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            stage, _ = running.pop(future)
+            try:
+                results[stage.name] = bool(future.result())
+            except Exception as e:
+                print(f"Stage {stage.name} failed: {str(e)}")
+                results[stage.name] = False
+
+        now = time.monotonic()
+        for future, (stage, deadline) in list(running.items()):
+            if deadline is not None and now >= deadline:
+                print(f"Stage {stage.name} timed out after {stage.timeout}s")
+                running.pop(future)
+                results[stage.name] = False
+
+        start_ready_stages()
+
+    succeeded = all(results.get(stage.name) for stage in stages if stage.required)
+    return succeeded, results
@@ -0,0 +1,123 @@
+import html
+import os
+from string import Formatter
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+class Template:
+    """A str.format template loaded and validated once per container"""
+
+    def __init__(self, name):
+        with open(os.path.join(TEMPLATE_DIR, name), encoding='utf-8') as f:
+            source = f.read().rstrip('\n')
+        self.name = name
+        self.source = source
+        # Parsing up front fails the cold start on a malformed template,
+        # rather than failing every order that tries to render it
+        self.fields = {field for _, field, _, _ in Formatter().parse(source) if field}
+
+    def render(self, values):
+        return self.source.format_map(values)
+
+CONFIRMATION_SUBJECT = Template('confirmation_subject.txt')
+CONFIRMATION_TEXT = Template('confirmation.txt')
+CONFIRMATION_HTML = Template('confirmation.html')
+CONFIRMATION_ITEM_TEXT = Template('confirmation_item.txt')
+CONFIRMATION_ITEM_HTML = Template('confirmation_item.html')
+INVOICE_TEXT = Template('invoice.txt')
+INVOICE_ITEM_TEXT = Template('invoice_item.txt')
+
+def item_values(item):
+    """Flatten an order item into the fields used by the item templates"""
+    product = item.get('product', {})
+    quantity = item.get('quantity', 1)
+    price = product.get('price', 0)
+    return {
+        'name': product.get('name', 'Unknown Product'),
+        'quantity': quantity,
+        'price': price,
+        'line_total': quantity * price,
+    }
+
+def address_values(shipping_info):
+    return {
+        'name': shipping_info.get('name', ''),
+        'email': shipping_info.get('email', ''),
+        'address': shipping_info.get('address', ''),
+        'city': shipping_info.get('city', ''),
+        'zip_code': shipping_info.get('zipCode', ''),
+    }
+
+def escape_values(values):
+    return {key: html.escape(value) if isinstance(value, str) else value for key, value in values.items()}
+
+def confirmation_values(order_id, order_date, shipping_info, items, total):
+    """Fields of the confirmation email as display strings.
+    
+    The same values feed the local templates and the SES template data, so
+    numbers are formatted here rather than in the templates.
+    """
+    return {
+        'order_ref': order_id[-8:],
+        'customer_name': shipping_info.get('name', 'Valued Customer'),
+        'order_id': order_id,
+        'order_date': order_date,
+        'total': f"{total:.2f}",
+        **address_values(shipping_info),
+        'items': [
+            {'name': line['name'], 'quantity': str(line['quantity']), 'price': f"{line['price']:.2f}"}
+            for line in map(item_values, items)
+        ],
+    }
+
+def render_confirmation_email(order_id, order_date, shipping_info, items, total):
+    """Return (subject, text, html) of the order confirmation email"""
+    values = confirmation_values(order_id, order_date, shipping_info, items, total)
+    lines = values['items']
+
+    subject = CONFIRMATION_SUBJECT.render(values)
+    text = CONFIRMATION_TEXT.render({
+        **values,
+        'items': '\n'.join([CONFIRMATION_ITEM_TEXT.render(line) for line in lines]),
+    })
+    body_html = CONFIRMATION_HTML.render({
+        **escape_values(values),
+        'items': '\n        '.join([CONFIRMATION_ITEM_HTML.render(escape_values(line)) for line in lines]),
+    })
+    return subject, text, body_html
+
+def ses_confirmation_template(template_name):
+    """Build the SES (Handlebars) version of the confirmation email by
+    rendering the local templates with placeholders for every field"""
+    def placeholders(template):
+        return {field: '{{%s}}' % field for field in template.fields}
+
+    def item_block(template, separator):
+        return '{{#each items}}' + template.render(placeholders(template)) + separator + '{{/each}}'
+
+    return {
+        'TemplateName': template_name,
+        'SubjectPart': CONFIRMATION_SUBJECT.render(placeholders(CONFIRMATION_SUBJECT)),
+        'TextPart': CONFIRMATION_TEXT.render({
+            **placeholders(CONFIRMATION_TEXT),
+            'items': item_block(CONFIRMATION_ITEM_TEXT, '\n'),
+        }),
+        'HtmlPart': CONFIRMATION_HTML.render({
+            **placeholders(CONFIRMATION_HTML),
+            'items': item_block(CONFIRMATION_ITEM_HTML, '\n        '),
+        }),
+    }
+
+def render_invoice(order_id, user_id, invoice_date, shipping_info, items, total):
+    """Return the plain-text invoice for an order"""
+    lines = [item_values(item) for item in items]
+    return INVOICE_TEXT.render({
+        'invoice_date': invoice_date,
+        'order_id': order_id,
+        'user_id': user_id,
+        'items': '\n'.join([INVOICE_ITEM_TEXT.render(line) for line in lines]),
+        'subtotal': sum(line['line_total'] for line in lines),
+        'tax': 0,
+        'total': total,
+        **address_values(shipping_info),
+    })
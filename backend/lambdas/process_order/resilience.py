@@ -0,0 +1,116 @@
+import random
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+THROTTLING_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+    'ProvisionedThroughputExceededException', 'RequestLimitExceeded', 'SlowDown',
+    'RequestThrottled', 'RequestThrottledException', 'LimitExceededException',
+}
+
+def client_config(max_attempts):
+    """botocore config with adaptive retries: exponential backoff plus a
+    client-side rate limiter that slows down while a service is throttling"""
+    return Config(
+        retries={'mode': 'adaptive', 'max_attempts': max_attempts},
+        connect_timeout=2,
+        read_timeout=5
+    )
+
+class TransientError(Exception):
+    """Base for errors of non-AWS dependencies that are worth retrying"""
+
+def is_transient(error):
+    """True for errors that say the dependency is unhealthy rather than the
+    request being wrong: throttling, 5xx responses and connection failures"""
+    if isinstance(error, (TransientError, ConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in THROTTLING_ERROR_CODES or status >= 500
+    return False
+
+class DependencyUnavailable(Exception):
+    """Raised when a dependency's circuit is open or it kept failing"""
+
+class CircuitBreaker:
+    """Fails fast once a dependency has failed repeatedly.
+
+    After failure_threshold consecutive transient failures the circuit opens
+    and calls are rejected without reaching the service. Once reset_timeout
+    seconds have passed a single trial call is let through: success closes
+    the circuit again, failure re-opens it. Breakers live at module level,
+    so their state carries across invocations of a warm container.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or (self.opened_at is None and self.failures >= self.failure_threshold):
+                print(f"Circuit for {self.name} opened after {self.failures} failures")
+                self.opened_at = self.clock()
+            self._trial_in_flight = False
+
+    def call(self, fn):
+        """Call fn through the breaker. Only transient errors count as
+        failures; any other error means the service answered."""
+        if not self.allow():
+            raise DependencyUnavailable(f"Circuit for {self.name} is open")
+        try:
+            result = fn()
+        except Exception as e:
+            if is_transient(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+def retry_with_jitter(fn, attempts=3, base_delay=0.1, max_delay=2.0):
+    """Call fn, retrying transient errors with full-jitter exponential backoff.
+    Only use for idempotent calls."""
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts - 1 or not is_transient(e):
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
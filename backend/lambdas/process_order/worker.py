@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Long-polling SQS worker that processes orders outside Lambda, e.g. in a
+container or on a VM under steady high-volume load.
+
+Each message goes through the same process_record / process_single_order
+path as the Lambda handler. Messages are received only while a worker is
+free, their visibility is extended while they are being processed, and
+processed messages are deleted in batches of up to 10. Buffered latency
+metrics are flushed every minute. SIGTERM and SIGINT stop receiving, let
+in-flight orders finish and delete them before exiting.
+
+The worker processes messages one at a time, so it refuses to start when
+EMAIL_SEND_MODE=bulk or INVOICE_ARCHIVE_MODE=bundle is configured: those
+modes batch side effects across the records of a Lambda invocation.
+
+Usage:
+    python worker.py --queue-url URL [--workers 8] [--visibility-timeout 60]
+
+Example:
+    ORDERS_TABLE=orders CARTS_TABLE=carts INVOICE_BUCKET=invoices \\
+        python worker.py --queue-url https://sqs.us-east-1.amazonaws.com/123456789012/orders --workers 16
+"""
+
+import argparse
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import flush, set_route
+
+SQS_MAX_MESSAGES = 10
+SQS_MAX_WAIT_SECONDS = 20
+METRICS_FLUSH_SECONDS = 60
+
+
+class Worker:
+    """Receive, process and delete order messages until stopped.
+
+    process_record is called with a Lambda-style SQS record and returns
+    True once the message can be deleted.
+    """
+
+    def __init__(self, sqs, queue_url, process_record, workers=4, visibility_timeout=60,
+                 wait_seconds=SQS_MAX_WAIT_SECONDS, delete_interval=1.0, metrics_interval=METRICS_FLUSH_SECONDS):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.process_record = process_record
+        self.workers = workers
+        self.visibility_timeout = visibility_timeout
+        self.wait_seconds = wait_seconds
+        self.delete_interval = delete_interval
+        self.metrics_interval = metrics_interval
+        self.processed = 0
+        self.failed = 0
+        self._in_flight = {}  # messageId -> receipt handle
+        self._to_delete = []
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._done = threading.Event()
+
+    def stop(self, *args):
+        """Stop receiving; messages already received are still processed"""
+        if not self._stop.is_set():
+            print("Stopping worker after in-flight orders finish")
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+
+    def run(self):
+        set_route('worker')
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='worker')
+        maintenance = threading.Thread(target=self._maintain, name='worker-maintenance')
+        maintenance.start()
+        try:
+            while not self._stop.is_set():
+                capacity = self._wait_for_capacity()
+                if capacity:
+                    for message in self._receive(capacity):
+                        pool.submit(self._process, message)
+        finally:
+            pool.shutdown(wait=True)
+            self._done.set()
+            maintenance.join()
+            flush()
+            print(f"Worker stopped: {self.processed} processed, {self.failed} failed")
+
+    def _wait_for_capacity(self):
+        with self._condition:
+            while len(self._in_flight) >= self.workers and not self._stop.is_set():
+                self._condition.wait()
+            return 0 if self._stop.is_set() else min(SQS_MAX_MESSAGES, self.workers - len(self._in_flight))
+
+    def _receive(self, capacity):
+        try:
+            response = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=capacity,
+                WaitTimeSeconds=self.wait_seconds,
+                VisibilityTimeout=self.visibility_timeout
+            )
+        except Exception as e:
+            print(f"Failed to receive messages: {str(e)}")
+            self._stop.wait(1)
+            return []
+        messages = response.get('Messages', [])
+        with self._condition:
+            for message in messages:
+                self._in_flight[message['MessageId']] = message['ReceiptHandle']
+        return messages
+
+    def _process(self, message):
+        record = {
+            'messageId': message['MessageId'],
+            'receiptHandle': message['ReceiptHandle'],
+            'body': message['Body'],
+        }
+        try:
+            success = self.process_record(record)
+        except Exception as e:
+            print(f"Error processing message {message['MessageId']}: {str(e)}")
+            success = False
+        with self._condition:
+            self._in_flight.pop(message['MessageId'], None)
+            if success:
+                self.processed += 1
+                self._to_delete.append({'Id': message['MessageId'], 'ReceiptHandle': message['ReceiptHandle']})
+            else:
+                # Left on the queue: it reappears once its visibility times
+                # out and moves to the DLQ after the redrive limit
+                self.failed += 1
+            self._condition.notify_all()
+
+    def _maintain(self):
+        """Delete processed messages, extend the visibility of in-flight
+        ones and flush metrics until the worker has stopped"""
+        next_extension = time.monotonic() + self.visibility_timeout / 3
+        next_flush = time.monotonic() + self.metrics_interval
+        while not self._done.wait(self.delete_interval):
+            self._delete_processed()
+            if time.monotonic() >= next_extension:
+                self._extend_visibility()
+                next_extension = time.monotonic() + self.visibility_timeout / 3
+            if time.monotonic() >= next_flush:
+                flush()
+                next_flush = time.monotonic() + self.metrics_interval
+        self._delete_processed()
+
+    def _delete_processed(self):
+        with self._condition:
+            entries, self._to_delete = self._to_delete, []
+        for start in range(0, len(entries), SQS_MAX_MESSAGES):
+            chunk = entries[start:start + SQS_MAX_MESSAGES]
+            try:
+                response = self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=chunk)
+                for failure in response.get('Failed', []):
+                    print(f"Failed to delete message {failure['Id']}: {failure.get('Message')}")
+            except Exception as e:
+                # The orders are done; a redelivery is skipped as a duplicate
+                print(f"Failed to delete {len(chunk)} messages: {str(e)}")
+
+    def _extend_visibility(self):
+        with self._condition:
+            in_flight = list(self._in_flight.items())
+        for start in range(0, len(in_flight), SQS_MAX_MESSAGES):
+            entries = [
+                {'Id': message_id, 'ReceiptHandle': receipt_handle, 'VisibilityTimeout': self.visibility_timeout}
+                for message_id, receipt_handle in in_flight[start:start + SQS_MAX_MESSAGES]
+            ]
+            try:
+                self.sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                print(f"Failed to extend visibility of {len(entries)} messages: {str(e)}")
+
+
+def batched_modes(app):
+    """The configured modes that batch side effects across a Lambda
+    invocation's records, which the worker does not support"""
+    modes = []
+    if app.EMAIL_SEND_MODE == 'bulk':
+        modes.append("EMAIL_SEND_MODE=bulk")
+    if app.INVOICE_ARCHIVE_MODE == 'bundle':
+        modes.append("INVOICE_ARCHIVE_MODE=bundle")
+    return modes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process orders from SQS outside Lambda")
+    parser.add_argument("--queue-url", default=os.getenv("ORDER_QUEUE_URL"),
+                        help="Order queue URL (default: $ORDER_QUEUE_URL)")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("ORDER_CONCURRENCY", "4")),
+                        help="Orders processed in parallel (default: $ORDER_CONCURRENCY or 4)")
+    parser.add_argument("--visibility-timeout", type=int, default=60,
+                        help="Visibility timeout in seconds, extended while an order is processed (default: 60)")
+    parser.add_argument("--wait-seconds", type=int, default=SQS_MAX_WAIT_SECONDS,
+                        help="Long-poll wait per receive call (default: 20)")
+    args = parser.parse_args()
+    if not args.queue_url:
+        parser.error("--queue-url or ORDER_QUEUE_URL is required")
+
+    # Imported once configured: the per-order stage pool is sized from ORDER_CONCURRENCY
+    os.environ["ORDER_CONCURRENCY"] = str(args.workers)
+    import app
+
+    unsupported = batched_modes(app)
+    if unsupported:
+        parser.error(f"{' and '.join(unsupported)} batch an invocation's orders and are not supported by the worker")
+    worker = Worker(app.sqs, args.queue_url, app.process_record, args.workers,
+                    args.visibility_timeout, args.wait_seconds)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    print(f"Polling {args.queue_url} with {args.workers} workers")
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,48 @@
 import json
 import os
 import boto3
-from datetime import datetime
+from interactions import Debouncer, validate_events, write_interactions
+from metrics import instrument_client, instrument_handler
+from recommendation_state import record_interactions
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = instrument_client(boto3.resource('dynamodb'))
+sqs = instrument_client(boto3.client('sqs'))
 
+# A request may carry a batch of events (the frontend beacon flushes its
+# buffer every few seconds)
+MAX_EVENTS_PER_REQUEST = int(os.getenv("MAX_EVENTS_PER_REQUEST", "100"))
+
+# In queue mode events are only validated here and sent to the events queue,
+# where aggregate_events writes them; "direct" writes them before responding
+EVENT_INGEST_MODE = os.getenv("EVENT_INGEST_MODE", "direct")
+
+# In direct mode, also send stored events to the events queue so that
+# aggregate_events archives them (queue mode archives everything anyway)
+ARCHIVE_EVENTS = os.getenv("ARCHIVE_EVENTS", "false").lower() == "true"
+
+# Repeats of an event (same user, product and type) inside the window are
+# dropped; 0 turns debouncing off
+debouncer = Debouncer(
+    window_seconds=float(os.getenv("DEBOUNCE_WINDOW_SECONDS", "30")),
+    event_types=[t for t in os.getenv("DEBOUNCED_EVENT_TYPES", "product-view").split(',') if t],
+    cache_size=int(os.getenv("DEBOUNCE_CACHE_SIZE", "1024"))
+)
+
+@instrument_handler
 def lambda_handler(event, context):
     """
-    Handle user interaction event tracking
+    Handle user interaction event tracking.
+    
+    The body is either a single event or a batch: a JSON array of events,
+    or an object with an "events" array. A batch is validated as a whole and
+    rejected with every problem listed if any event is invalid.
+    
+    In queue mode the validated events are sent to the events queue as one
+    message and the request is answered with 202 Accepted.
+    
+    Otherwise they are written here. If some records cannot be updated the
+    answer is 503, with the indices of the events that were not stored in
+    unprocessedEvents; the rest were, so only those may be resent.
     """
     try:
         interactions_table_name = os.getenv("INTERACTIONS_TABLE")
@@ -18,8 +53,6 @@ def lambda_handler(event, context):
                 "body": json.dumps({"error": "INTERACTIONS_TABLE environment variable not set"})
             }
         
-        interactions_table = dynamodb.Table(interactions_table_name)
-        
         # Parse request body
         if not event.get('body'):
             return {
@@ -28,53 +61,109 @@ def lambda_handler(event, context):
             }
         
         try:
-            interaction_data = json.loads(event['body'])
+            payload = json.loads(event['body'])
         except json.JSONDecodeError:
             return {
                 "statusCode": 400,
                 "body": json.dumps({"error": "Invalid JSON in request body"})
             }
         
-        # Validate required fields
-        required_fields = ['userId', 'productId', 'eventType', 'productType']
-        for field in required_fields:
-            if field not in interaction_data:
-                return {
-                    "statusCode": 400,
-                    "body": json.dumps({"error": f"Missing required field: {field}"})
-                }
+        batch = isinstance(payload, list) or (isinstance(payload, dict) and 'events' in payload)
+        events = payload if isinstance(payload, list) else payload.get('events') if batch else [payload]
+        
+        if not isinstance(events, list) or not events:
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": "events must be a non-empty array"})
+            }
+        if len(events) > MAX_EVENTS_PER_REQUEST:
+            return {
+                "statusCode": 413,
+                "body": json.dumps({"error": f"At most {MAX_EVENTS_PER_REQUEST} events per request"})
+            }
         
-        # Validate event type
-        valid_event_types = ['product-view', 'add-to-cart', 'purchase']
-        if interaction_data['eventType'] not in valid_event_types:
+        interactions, errors = validate_events(events)
+        if errors:
+            # A single event keeps the original error format
+            body = {"error": errors[0]['error']} if not batch else {"error": "Invalid events", "errors": errors}
             return {
                 "statusCode": 400,
-                "body": json.dumps({"error": f"Invalid eventType. Must be one of: {valid_event_types}"})
+                "body": json.dumps(body)
             }
         
-        # Add timestamp if not provided
-        timestamp = interaction_data.get('timestamp', datetime.utcnow().isoformat() + 'Z')
+        if EVENT_INGEST_MODE == 'queue':
+            return enqueue_interactions(interactions)
         
-        # Create interaction record
-        interaction = {
-            'userId': interaction_data['userId'],
-            'productId': interaction_data['productId'],
-            'eventType': interaction_data['eventType'],
-            'category': interaction_data['productType'],  # Map productType to category
-            'timestamp': timestamp
-        }
+        written, unprocessed = write_interactions(dynamodb, interactions_table_name, interactions, debouncer)
         
-        # Save interaction to DynamoDB
-        interactions_table.put_item(Item=interaction)
+        # Note the users' seen products and invalidate their cached
+        # recommendations, only where a record changed: a debounced repeat
+        # leaves both the interactions and the cached list as they were
+        state_table_name = os.getenv("RECOMMENDATION_STATE_TABLE")
+        if state_table_name and written:
+            record_interactions(dynamodb, state_table_name, written)
+        
+        if unprocessed:
+            # The other events are stored, and resending them would count
+            # them twice: the client resends only the listed ones
+            failed_keys = {(summary['userId'], summary['productId']) for summary in unprocessed}
+            failed, stored = [], []
+            for index, interaction in enumerate(interactions):
+                if (interaction['userId'], interaction['productId']) in failed_keys:
+                    failed.append(index)
+                else:
+                    stored.append(interaction)
+            print(f"{len(unprocessed)} interaction records could not be updated")
+            if ARCHIVE_EVENTS and stored:
+                forward_to_archive(stored)
+            return {
+                "statusCode": 503,
+                "body": json.dumps({"error": "Some events could not be stored, please retry",
+                                    "unprocessed": len(unprocessed),
+                                    "unprocessedEvents": failed})
+            }
+        
+        if ARCHIVE_EVENTS:
+            forward_to_archive(interactions)
         
         return {
             "statusCode": 200,
-            "body": json.dumps({"message": "Event tracked successfully"})
+            "body": json.dumps({"message": "Event tracked successfully", "count": len(events)})
         }
-        
+    
     except Exception as e:
         print(f"Error: {str(e)}")
         return {
             "statusCode": 500,
             "body": json.dumps({"error": "Internal server error"})
         }
+
+def enqueue_interactions(interactions):
+    """Send validated interactions to the events queue as a single message"""
+    queue_url = os.getenv("EVENTS_QUEUE_URL")
+    if not queue_url:
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"error": "EVENTS_QUEUE_URL environment variable not set"})
+        }
+    
+    sqs.send_message(
+        QueueUrl=queue_url,
+        MessageBody=json.dumps({"events": interactions}, separators=(',', ':'))
+    )
+    
+    return {
+        "statusCode": 202,
+        "body": json.dumps({"message": "Events accepted", "count": len(interactions)})
+    }
+
+def forward_to_archive(interactions):
+    """Queue stored interactions for archiving only. They are already
+    written, so a failure is logged rather than failing the request."""
+    try:
+        sqs.send_message(
+            QueueUrl=os.environ["EVENTS_QUEUE_URL"],
+            MessageBody=json.dumps({"events": interactions, "stored": True}, separators=(',', ':'))
+        )
+    except Exception as e:
+        print(f"Failed to queue {len(interactions)} events for archiving: {str(e)}")
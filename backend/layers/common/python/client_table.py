@@ -0,0 +1,34 @@
+"""
+Table-style updates on DynamoDB's low-level client, for worker threads.
+
+boto3 resources, and the Table objects made from them, are not thread-safe;
+clients are. ClientTable makes the Table calls the layer's thread pools need
+on the resource's own client (so instrument_client still times them),
+converting Python values to DynamoDB's typed form and back.
+"""
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+def _serialize(values):
+    return {key: _serializer.serialize(value) for key, value in values.items()}
+
+class ClientTable:
+    """The update_item of dynamodb.Table(table_name), safe to share between
+    threads. Errors are the client's: a failed condition's returned Item is
+    in typed form, as it is from the resource."""
+
+    def __init__(self, dynamodb, table_name):
+        self.client = dynamodb.meta.client
+        self.name = table_name
+
+    def update_item(self, Key, ExpressionAttributeValues=None, **kwargs):
+        if ExpressionAttributeValues is not None:
+            kwargs['ExpressionAttributeValues'] = _serialize(ExpressionAttributeValues)
+        response = self.client.update_item(TableName=self.name, Key=_serialize(Key), **kwargs)
+        if 'Attributes' in response:
+            response['Attributes'] = {key: _deserializer.deserialize(value)
+                                      for key, value in response['Attributes'].items()}
+        return response
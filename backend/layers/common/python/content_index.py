@@ -0,0 +1,85 @@
+"""
+Content-based product similarity index, built offline from product text by
+scripts/build_content_index.py and read by get_recommendations.
+
+The index is a single binary object in S3. The Lambdas do not ship NumPy,
+so it is laid out to be read with the standard library alone:
+
+    header      b'CSIX', version, products n, neighbours per product k
+                (little-endian '<4sHIH')
+    ids         uint32 byte length, then the n product ids, UTF-8,
+                newline separated
+    neighbours  n x k int32 positions into ids, best first; -1 pads
+    scores      n x k uint16 cosine similarities, scaled by 65535
+
+A lookup is a dict hit and a slice of k entries.
+"""
+
+import struct
+import sys
+from array import array
+
+MAGIC = b'CSIX'
+VERSION = 1
+HEADER = struct.Struct('<4sHIH')
+LENGTH = struct.Struct('<I')
+SCORE_SCALE = 65535
+
+def pack(product_ids, neighbours, scores, k):
+    """Serialize an index. neighbours and scores are n x k row-major
+    buffers of little-endian int32 and uint16 (NumPy arrays or array)."""
+    ids = '\n'.join(product_ids).encode('utf-8')
+    return b''.join([
+        HEADER.pack(MAGIC, VERSION, len(product_ids), k),
+        LENGTH.pack(len(ids)), ids,
+        bytes(neighbours), bytes(scores)
+    ])
+
+class ContentIndex:
+    """The similar products of each product, from a packed index"""
+
+    def __init__(self, data):
+        magic, version, count, self.k = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a version {VERSION} content index")
+        offset = HEADER.size
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        self.product_ids = data[offset:offset + length].decode('utf-8').split('\n') if count else []
+        offset += length
+        self.neighbours = array('i')
+        self.neighbours.frombytes(data[offset:offset + 4 * count * self.k])
+        offset += 4 * count * self.k
+        self.scores = array('H')
+        self.scores.frombytes(data[offset:offset + 2 * count * self.k])
+        if len(self.product_ids) != count or len(self.scores) != count * self.k:
+            raise ValueError("Truncated content index")
+        if sys.byteorder == 'big':
+            self.neighbours.byteswap()
+            self.scores.byteswap()
+        self.positions = {product_id: position for position, product_id in enumerate(self.product_ids)}
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def __contains__(self, product_id):
+        return product_id in self.positions
+
+    def similar(self, product_id, limit=None):
+        """[(productId, similarity), ...] best first; [] for products built
+        after the index"""
+        position = self.positions.get(product_id)
+        if position is None:
+            return []
+        start = position * self.k
+        end = start + min(limit if limit is not None else self.k, self.k)
+        similar = []
+        for neighbour, score in zip(self.neighbours[start:end], self.scores[start:end]):
+            if neighbour < 0:
+                break
+            similar.append((self.product_ids[neighbour], score / SCORE_SCALE))
+        return similar
+
+def load_content_index(s3, bucket, key):
+    """Download and parse the index object"""
+    return ContentIndex(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
@@ -0,0 +1,435 @@
+"""
+Validation, aggregation and storage of product interaction events, shared by
+track_event (which receives them) and aggregate_events (which consumes them
+from the events queue).
+
+The interactions table keeps one record per (userId, productId) that
+accumulates every event for the pair:
+
+    viewCount, cartCount, purchaseCount   events of each type (ADD)
+    firstSeen, lastSeen                   first and latest event time
+    eventType, category, timestamp        the latest event, as before
+    activeBucket                          hour of timestamp (YYYY-MM-DDTHH), the
+                                          key of the activity index
+    affinity, affinityEra                 decayed, weighted interest score
+
+affinity is the sum of weight x e^(lambda x (t - start of affinityEra)) over
+the events, so it grows with ADD alone; current_affinity divides out the
+growth to give the score decayed to the present. An era lasts
+AFFINITY_ERA_HALF_LIVES half-lives, which bounds the growth far inside
+DynamoDB's number range (1e125); the first write to a record in a new era
+rescales its score to that era with a conditional update.
+"""
+
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+from client_table import ClientTable
+from metrics import FUNCTION_NAME, emit
+
+REQUIRED_FIELDS = ['userId', 'productId', 'eventType', 'productType']
+VALID_EVENT_TYPES = ['product-view', 'add-to-cart', 'purchase']
+
+# Counter attribute and affinity weight of each event type
+EVENT_COUNTERS = {'product-view': 'viewCount', 'add-to-cart': 'cartCount', 'purchase': 'purchaseCount'}
+EVENT_WEIGHTS = {'product-view': 1, 'add-to-cart': 3, 'purchase': 5}
+
+# Scores are stored relative to the start of their era and double every
+# half-life, so they stay below 2^AFFINITY_ERA_HALF_LIVES x the event weights.
+# Era 0 starts at AFFINITY_EPOCH; records without affinityEra belong to it.
+AFFINITY_EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+AFFINITY_HALF_LIFE_DAYS = float(os.getenv("AFFINITY_HALF_LIFE_DAYS", "14"))
+AFFINITY_DECAY_RATE = math.log(2) / (AFFINITY_HALF_LIFE_DAYS * 86400)
+AFFINITY_ERA_HALF_LIVES = 32
+AFFINITY_ERA_SECONDS = AFFINITY_ERA_HALF_LIVES * AFFINITY_HALF_LIFE_DAYS * 86400
+
+# Accepted event times: clients buffer events for a while and their clocks
+# drift, but a timestamp far outside this range would swing the affinity
+MAX_EVENT_AGE_DAYS = float(os.getenv("MAX_EVENT_AGE_DAYS", "30"))
+MAX_CLOCK_SKEW_SECONDS = float(os.getenv("MAX_CLOCK_SKEW_SECONDS", "300"))
+
+# Records are updated one UpdateItem per key, this many at a time
+UPDATE_CONCURRENCY = 8
+
+# Last time each event type was written, in epoch seconds, for debouncing
+LAST_SEEN_ATTRIBUTES = {'product-view': 'lastViewAt', 'add-to-cart': 'lastCartAt', 'purchase': 'lastPurchaseAt'}
+# Conditional updates of one key before giving up on a racing writer
+DEBOUNCE_ATTEMPTS = 3
+
+UPDATE_EXPRESSION = (
+    'SET eventType = :eventType, category = :category, #timestamp = :timestamp, '
+    'lastSeen = :timestamp, firstSeen = if_not_exists(firstSeen, :firstSeen), affinityEra = :affinityEra, '
+    'activeBucket = :activeBucket '
+    'ADD viewCount :viewCount, cartCount :cartCount, purchaseCount :purchaseCount, affinity :affinity'
+)
+
+_deserializer = TypeDeserializer()
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp, treating one without a zone as UTC"""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def timestamp_error(timestamp, now=None, max_age_days=MAX_EVENT_AGE_DAYS):
+    """Why an event timestamp is not accepted, or None if it is"""
+    try:
+        parsed = parse_timestamp(timestamp)
+    except (AttributeError, TypeError, ValueError):
+        return "Invalid timestamp. Must be ISO 8601"
+    now = now or datetime.now(timezone.utc)
+    if parsed > now + timedelta(seconds=MAX_CLOCK_SKEW_SECONDS):
+        return "Invalid timestamp. Must not be in the future"
+    if max_age_days is not None and parsed < now - timedelta(days=max_age_days):
+        return f"Invalid timestamp. Must be within the last {MAX_EVENT_AGE_DAYS:g} days"
+    return None
+
+def validate_events(events):
+    """Validate every event in one pass.
+
+    Returns (interaction records, errors), where each error is
+    {'index', 'error'} for an invalid event.
+    """
+    interactions = []
+    errors = []
+    now = datetime.utcnow().isoformat() + 'Z'
+
+    for index, interaction_data in enumerate(events):
+        if not isinstance(interaction_data, dict):
+            errors.append({"index": index, "error": "Event must be an object"})
+            continue
+
+        # Validate required fields
+        missing = [field for field in REQUIRED_FIELDS if field not in interaction_data]
+        if missing:
+            errors.append({"index": index, "error": f"Missing required field: {missing[0]}"})
+            continue
+
+        # Validate event type
+        if interaction_data['eventType'] not in VALID_EVENT_TYPES:
+            errors.append({"index": index,
+                           "error": f"Invalid eventType. Must be one of: {VALID_EVENT_TYPES}"})
+            continue
+
+        # The timestamp drives the affinity decay, so it has to parse and
+        # be recent
+        timestamp = interaction_data.get('timestamp', now)  # Add timestamp if not provided
+        error = timestamp_error(timestamp)
+        if error:
+            errors.append({"index": index, "error": error})
+            continue
+
+        interactions.append({
+            'userId': interaction_data['userId'],
+            'productId': interaction_data['productId'],
+            'eventType': interaction_data['eventType'],
+            'category': interaction_data['productType'],  # Map productType to category
+            'timestamp': timestamp
+        })
+
+    return interactions, errors
+
+def is_interaction_record(record):
+    """True for a record as produced by validate_events. Queued records may
+    have aged since, so only a timestamp in the future is refused."""
+    return isinstance(record, dict) and all(
+        isinstance(record.get(field), str) for field in ('userId', 'productId', 'eventType', 'category', 'timestamp')
+    ) and record['eventType'] in EVENT_COUNTERS and timestamp_error(record['timestamp'], max_age_days=None) is None
+
+def affinity_era(now=None):
+    """The era scores written at now (default: the current time) belong to"""
+    now = now or datetime.now(timezone.utc)
+    return max(0, int((now - AFFINITY_EPOCH).total_seconds() // AFFINITY_ERA_SECONDS))
+
+def era_start(era):
+    return AFFINITY_EPOCH + timedelta(seconds=era * AFFINITY_ERA_SECONDS)
+
+def affinity_scale(era, now=None):
+    """Factor turning a score stored in era into the score decayed to now"""
+    now = now or datetime.now(timezone.utc)
+    return math.exp(-AFFINITY_DECAY_RATE * (now - era_start(era)).total_seconds())
+
+def rescale_affinity(affinity, from_era, to_era):
+    """A stored score moved from one era to another"""
+    return affinity * math.exp(-AFFINITY_DECAY_RATE * (to_era - from_era) * AFFINITY_ERA_SECONDS)
+
+def affinity_weight(event_type, timestamp, era=None):
+    """Contribution of one event to the affinity stored in era (default: the
+    current one). Event times are validated to be recent, so this stays
+    below 2^AFFINITY_ERA_HALF_LIVES x the weight."""
+    era = affinity_era() if era is None else era
+    elapsed = (parse_timestamp(timestamp) - era_start(era)).total_seconds()
+    return EVENT_WEIGHTS[event_type] * math.exp(AFFINITY_DECAY_RATE * elapsed)
+
+def current_affinity(record, now=None):
+    """A stored record's affinity decayed to now (default: the current time)"""
+    return float(record.get('affinity', 0)) * affinity_scale(int(record.get('affinityEra', 0)), now)
+
+def hour_bucket(timestamp):
+    """The hourly bucket of an ISO 8601 timestamp, e.g. '2025-06-01T10'"""
+    return parse_timestamp(timestamp).astimezone(timezone.utc).strftime('%Y-%m-%dT%H')
+
+def epoch_seconds(timestamp):
+    """Seconds since the Unix epoch of an ISO 8601 timestamp"""
+    return parse_timestamp(timestamp).timestamp()
+
+class Debouncer:
+    """Drops repeats of an event inside a time window.
+
+    An event of a debounced type is suppressed when the same user sent the
+    same event type for the same product less than window_seconds before (or
+    after) it. Recent events are looked up in three places, cheapest first:
+    earlier events of the same batch, an LRU of the hottest keys kept in the
+    container, and the record itself, whose per-type last-seen time
+    (LAST_SEEN_ATTRIBUTES) guards the update as a condition.
+    """
+
+    def __init__(self, window_seconds, event_types=('product-view',), cache_size=1024):
+        self.window_seconds = window_seconds
+        self.event_types = set(event_types)
+        self.cache_size = cache_size
+        self._recent = OrderedDict()  # (userId, productId, eventType) -> epoch seconds
+        self._lock = threading.Lock()
+
+    def applies(self, event_type):
+        return self.window_seconds > 0 and event_type in self.event_types
+
+    def last_seen(self, key):
+        with self._lock:
+            seen_at = self._recent.get(key)
+            if seen_at is not None:
+                self._recent.move_to_end(key)
+            return seen_at
+
+    def remember(self, key, seen_at):
+        with self._lock:
+            if seen_at >= self._recent.get(key, seen_at):
+                self._recent[key] = seen_at
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
+
+    def is_repeat(self, seen_at, previous):
+        return previous is not None and abs(seen_at - float(previous)) < self.window_seconds
+
+    def filter(self, interactions):
+        """Drop repeats within the batch or of events in the LRU.
+        Returns (kept interactions, number suppressed)."""
+        kept, suppressed, last = [], 0, {}
+        # Stable sort, so later arrivals still win timestamp ties
+        for interaction in sorted(interactions, key=lambda i: epoch_seconds(i['timestamp'])):
+            if not self.applies(interaction['eventType']):
+                kept.append(interaction)
+                continue
+            key = (interaction['userId'], interaction['productId'], interaction['eventType'])
+            seen_at = epoch_seconds(interaction['timestamp'])
+            previous = last[key] if key in last else self.last_seen(key)
+            if self.is_repeat(seen_at, previous):
+                suppressed += 1
+                continue
+            last[key] = seen_at
+            kept.append(interaction)
+        return kept, suppressed
+
+def aggregate_interactions(interactions):
+    """Collapse interactions into one summary per (userId, productId).
+
+    The summary carries the latest event (by timestamp, later arrivals
+    winning ties) plus what the events add up to: a count per event type,
+    the earliest timestamp, the affinity contribution to the current era
+    (affinityEra) and, in seenAt, the first and last time of each event type
+    in epoch seconds. Returns {(userId, productId): summary}.
+    """
+    summaries = {}
+    era = affinity_era()
+    for interaction in interactions:
+        key = (interaction['userId'], interaction['productId'])
+        summary = summaries.get(key)
+        if summary is None:
+            summary = summaries[key] = dict(interaction, firstSeen=interaction['timestamp'], affinity=0.0,
+                                            affinityEra=era, seenAt={},
+                                            **{counter: 0 for counter in EVENT_COUNTERS.values()})
+        elif interaction['timestamp'] >= summary['timestamp']:
+            summary.update(interaction)
+        summary['firstSeen'] = min(summary['firstSeen'], interaction['timestamp'])
+        summary[EVENT_COUNTERS[interaction['eventType']]] += 1
+        summary['affinity'] += affinity_weight(interaction['eventType'], interaction['timestamp'], era)
+        seen_at = epoch_seconds(interaction['timestamp'])
+        first, last = summary['seenAt'].get(interaction['eventType'], (seen_at, seen_at))
+        summary['seenAt'][interaction['eventType']] = (min(first, seen_at), max(last, seen_at))
+    return summaries
+
+def update_interaction(table, summary, debouncer=None, observed=None):
+    """Fold one summary into its record with a single UpdateItem.
+
+    The affinity is ADDed if the record's score is of the summary's era (or
+    it has none); otherwise the update raises
+    ConditionalCheckFailedException with the current item. With a
+    debouncer, the update also records the last-seen time of each debounced
+    event type and only succeeds if none of them was seen within the window.
+
+    Once the caller has an observed item, the stored score is rescaled to
+    the newer era and the total SET instead, and the condition is that the
+    score and last-seen times are still the observed ones.
+    """
+    update_expression = UPDATE_EXPRESSION
+    era = summary['affinityEra']
+    affinity = summary['affinity']
+    conditions = []
+    values = {}
+    if observed is None:
+        conditions.append('(attribute_not_exists(affinity) OR affinityEra = :affinityEra'
+                          + (' OR attribute_not_exists(affinityEra))' if era == 0 else ')'))
+    else:
+        stored_era = int(observed.get('affinityEra', 0))
+        target_era = max(era, stored_era)
+        affinity = rescale_affinity(affinity, era, target_era)
+        if 'affinity' in observed:
+            affinity += rescale_affinity(float(observed['affinity']), stored_era, target_era)
+            conditions.append('affinity = :observedAffinity')
+            values[':observedAffinity'] = observed['affinity']
+        else:
+            conditions.append('attribute_not_exists(affinity)')
+        era = target_era
+        update_expression = update_expression.replace(', affinity :affinity', '').replace(
+            ' ADD ', ', affinity = :affinity ADD ', 1)
+    values.update({
+        ':eventType': summary['eventType'],
+        ':category': summary['category'],
+        ':timestamp': summary['timestamp'],
+        ':activeBucket': hour_bucket(summary['timestamp']),
+        ':firstSeen': summary['firstSeen'],
+        ':viewCount': summary['viewCount'],
+        ':cartCount': summary['cartCount'],
+        ':purchaseCount': summary['purchaseCount'],
+        ':affinity': Decimal(f"{affinity:.15g}"),
+        ':affinityEra': era
+    })
+    for event_type, (first, last) in summary['seenAt'].items():
+        if debouncer is None or not debouncer.applies(event_type):
+            continue
+        attribute = LAST_SEEN_ATTRIBUTES[event_type]
+        update_expression = update_expression.replace(' ADD ', f', {attribute} = :{attribute} ADD ', 1)
+        previous = observed.get(attribute) if observed is not None else None
+        if observed is None:
+            conditions.append(f"(attribute_not_exists({attribute}) OR {attribute} <= :{attribute}Cutoff)")
+            values[f':{attribute}Cutoff'] = Decimal(f"{first - debouncer.window_seconds:.3f}")
+        elif previous is None:
+            conditions.append(f"attribute_not_exists({attribute})")
+        else:
+            conditions.append(f"{attribute} = :{attribute}Observed")
+            values[f':{attribute}Observed'] = previous
+        values[f':{attribute}'] = max(Decimal(f"{last:.3f}"), previous or 0)
+
+    table.update_item(
+        Key={'userId': summary['userId'], 'productId': summary['productId']},
+        UpdateExpression=update_expression,
+        ConditionExpression=' AND '.join(conditions),
+        # The failed write returns the current item, so the caller can
+        # rescale the score and tell which events were repeats without an
+        # extra read
+        ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        ExpressionAttributeNames={'#timestamp': 'timestamp'},
+        ExpressionAttributeValues=values
+    )
+
+def update_key(table, interactions, debouncer=None):
+    """Write the interactions of one (userId, productId), dropping those the
+    record shows to be repeats. Returns (written summary or None, unwritten
+    summary or None, number of events suppressed)."""
+    suppressed = 0
+    observed = None
+    for _ in range(DEBOUNCE_ATTEMPTS):
+        if not interactions:
+            return None, None, suppressed
+        [summary] = aggregate_interactions(interactions).values()
+        try:
+            update_interaction(table, summary, debouncer, observed)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            observed = {key: _deserializer.deserialize(value) for key, value in e.response.get('Item', {}).items()}
+            if debouncer is None:
+                continue
+            remaining = []
+            for interaction in interactions:
+                event_type = interaction['eventType']
+                previous = observed.get(LAST_SEEN_ATTRIBUTES[event_type]) if debouncer.applies(event_type) else None
+                if previous is not None:
+                    debouncer.remember((summary['userId'], summary['productId'], event_type), float(previous))
+                if not debouncer.is_repeat(epoch_seconds(interaction['timestamp']), previous):
+                    remaining.append(interaction)
+            suppressed += len(interactions) - len(remaining)
+            interactions = remaining
+            continue
+        if debouncer is not None:
+            for event_type, (_, last) in summary['seenAt'].items():
+                if debouncer.applies(event_type):
+                    debouncer.remember((summary['userId'], summary['productId'], event_type), last)
+        return summary, None, suppressed
+    return None, aggregate_interactions(interactions).get((summary['userId'], summary['productId'])), suppressed
+
+def unwritten_summary(interactions):
+    """The summary of one key's interactions that could not be written.
+    Never raises, so one bad key cannot fail the others: if the events
+    cannot even be aggregated, only the key is returned."""
+    try:
+        return next(iter(aggregate_interactions(interactions).values()))
+    except Exception as e:
+        first = interactions[0]
+        print(f"Cannot aggregate interactions of {first['userId']}/{first['productId']}: {str(e)}")
+        return {'userId': first['userId'], 'productId': first['productId']}
+
+def write_interactions(dynamodb, table_name, interactions, debouncer=None):
+    """Add interactions to their records, one UpdateItem per (userId, productId).
+
+    Events for the same key are aggregated first, so a batch costs one write
+    per key however many events it holds. With a debouncer, repeat events
+    are dropped first (see Debouncer) and a key whose events were all
+    repeats is not written at all; the SuppressedEvents and SkippedWrites
+    metrics report how many.
+
+    The counters are additive, so a failed update is not retried here: it is
+    returned for the caller to redeliver. Returns (written, unwritten): the
+    summaries of the events that were written, without the repeats, and
+    those that could not be written.
+    """
+    # Shared by the update threads, so on the (thread-safe) client
+    table = ClientTable(dynamodb, table_name)
+    suppressed = 0
+    if debouncer is not None:
+        kept, suppressed = debouncer.filter(interactions)
+    else:
+        kept = interactions
+
+    by_key = {}
+    for interaction in kept:
+        by_key.setdefault((interaction['userId'], interaction['productId']), []).append(interaction)
+    skipped = len({(i['userId'], i['productId']) for i in interactions}) - len(by_key)
+
+    def update(key_interactions):
+        try:
+            return update_key(table, key_interactions, debouncer)
+        except Exception as e:
+            first = key_interactions[0]
+            print(f"Failed to update interaction {first['userId']}/{first['productId']}: {str(e)}")
+            return None, unwritten_summary(key_interactions), 0
+
+    groups = list(by_key.values())
+    if len(groups) <= 1:
+        results = [update(group) for group in groups]
+    else:
+        with ThreadPoolExecutor(max_workers=min(UPDATE_CONCURRENCY, len(groups))) as executor:
+            results = list(executor.map(update, groups))
+
+    if debouncer is not None:
+        suppressed += sum(count for _, _, count in results)
+        emit({'SuppressedEvents': suppressed, 'SkippedWrites': skipped}, {'function': FUNCTION_NAME}, unit='Count')
+
+    written = [summary for summary, _, _ in results if summary is not None]
+    return written, [summary for _, summary, _ in results if summary is not None]
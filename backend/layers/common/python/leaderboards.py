@@ -0,0 +1,64 @@
+"""
+Popularity leaderboards, built on a schedule by build_leaderboards and read
+by get_recommendations.
+
+All leaderboards live in one item of the leaderboards table, as a single
+JSON string so a reader parses it without deserializing DynamoDB types:
+
+    {"name": "popular", "builtAt": "...", "leaderboards": "<json>"}
+
+    {
+      "windows": ["1d", "7d", "30d"],                   shortest first
+      "global": {"1d": ["prod-3", ...], ...},           best first, per window
+      "categories": {"Books": {"1d": [...], ...}, ...},
+      "products": {"prod-3": {"id": "prod-3", "name": ..., ...}, ...}
+    }
+
+Each product appears once in "products", already shaped as the
+recommendations response, so serving a leaderboard needs no other reads.
+"""
+
+import json
+import re
+from datetime import timedelta
+
+LEADERBOARD_NAME = 'popular'
+
+WINDOW_UNITS = {'h': 'hours', 'd': 'days'}
+
+def parse_windows(value):
+    """'1d,7d,30d' -> [('1d', timedelta(days=1)), ...], shortest first"""
+    windows = []
+    for label in (part.strip() for part in value.split(',')):
+        match = re.fullmatch(r'(\d+)([hd])', label)
+        if not match or int(match.group(1)) == 0:
+            raise ValueError(f"Invalid leaderboard window {label!r}, expected e.g. 12h or 7d")
+        windows.append((label, timedelta(**{WINDOW_UNITS[match.group(2)]: int(match.group(1))})))
+    return sorted(windows, key=lambda window: window[1])
+
+def load_leaderboards(table):
+    """The parsed leaderboards, or None before the first build"""
+    item = table.get_item(Key={'name': LEADERBOARD_NAME}).get('Item')
+    return json.loads(item['leaderboards']) if item else None
+
+def popular_products(leaderboards, categories=(), exclude=(), limit=10):
+    """Up to limit popular products, as response dicts.
+
+    The leaderboards of categories are used in the order given, then the
+    global one; within each, the shortest window first, so recent
+    popularity wins and the longer windows fill in behind it.
+    """
+    boards = [leaderboards['categories'].get(category, {}) for category in categories]
+    boards.append(leaderboards['global'])
+    chosen = []
+    seen = set(exclude)
+    for board in boards:
+        for window in leaderboards['windows']:
+            for product_id in board.get(window, []):
+                if product_id in seen:
+                    continue
+                seen.add(product_id)
+                chosen.append(dict(leaderboards['products'][product_id]))
+                if len(chosen) >= limit:
+                    return chosen
+    return chosen
@@ -0,0 +1,174 @@
+"""
+Latency metrics in CloudWatch Embedded Metric Format (EMF), shared by the
+Lambda handlers through the common layer.
+
+Timings are buffered per (route, stage) and written as one EMF JSON line per
+pair when the invocation ends, with all values in a single array, so an
+invocation that makes a hundred AWS calls logs a handful of lines. CloudWatch
+turns the lines into Latency metrics with function, route and stage
+dimensions; percentiles (p99 etc.) come for free.
+
+    @instrument_handler
+    def lambda_handler(event, context):
+        with timed('load-cart'):
+            ...
+
+    dynamodb = instrument_client(boto3.resource('dynamodb'))  # every call timed
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import ContextDecorator
+
+NAMESPACE = os.getenv("METRICS_NAMESPACE", "CloudShop")
+FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "local")
+
+# EMF accepts up to 100 values per metric in one line
+MAX_VALUES_PER_LINE = 100
+
+def _process_age():
+    """Seconds since this process started, read from /proc (Linux only)"""
+    try:
+        with open('/proc/self/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return max(0.0, time.clock_gettime(time.CLOCK_BOOTTIME) - started)
+    except (OSError, ValueError, AttributeError, IndexError):
+        return 0.0
+
+# Start of the init phase: the process start where /proc is available,
+# otherwise the moment this module was imported
+_init_started = time.monotonic() - _process_age()
+_cold_start = True
+_route = '-'
+_timings = {}  # (route, stage) -> [milliseconds]
+_lock = threading.Lock()
+
+def emit(metrics, dimensions, unit='Milliseconds'):
+    """Write one EMF line. metrics maps metric names to a value or a list
+    of values; dimensions maps dimension names to values."""
+    line = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name in metrics],
+            }],
+        },
+        **dimensions,
+        **metrics,
+    }
+    print(json.dumps(line))
+
+def record(stage, milliseconds):
+    """Buffer one latency sample for the current route"""
+    with _lock:
+        key = (_route, stage)
+        values = _timings.setdefault(key, [])
+        values.append(round(milliseconds, 3))
+        if len(values) < MAX_VALUES_PER_LINE:
+            return
+        del _timings[key]
+    _emit_latency(key, values)
+
+def flush():
+    """Write the buffered samples, one line per (route, stage)"""
+    global _timings
+    with _lock:
+        timings, _timings = _timings, {}
+    for key, values in timings.items():
+        _emit_latency(key, values)
+
+def _emit_latency(key, values):
+    route, stage = key
+    emit({'Latency': values}, {'function': FUNCTION_NAME, 'route': route, 'stage': stage})
+
+class timed(ContextDecorator):
+    """Time a block or a function as a stage of the current route:
+
+        with timed('payment'):
+            ...
+
+        @timed('render-invoice')
+        def render(...):
+            ...
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self._local = threading.local()
+
+    def __enter__(self):
+        # Thread-local, so one decorated function can run on several threads
+        self._local.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.stage, (time.perf_counter() - self._local.started) * 1000)
+        return False
+
+def set_route(route):
+    """Set the route dimension for the samples that follow"""
+    global _route
+    _route = route
+
+def route_of(event):
+    """Route dimension of an invocation: the HTTP API route key, or the
+    event source for queue and scheduled invocations"""
+    if not isinstance(event, dict):
+        return 'direct'
+    if event.get('routeKey'):
+        return event['routeKey']
+    if event.get('httpMethod'):
+        return f"{event['httpMethod']} {event.get('resource') or event.get('path', '')}"
+    records = event.get('Records')
+    if records:
+        return records[0].get('eventSource', 'records')
+    return event.get('source', 'direct')
+
+def instrument_handler(handler):
+    """Decorate a Lambda handler: sets the route, times the whole handler,
+    reports the init duration on a cold start and flushes the metrics"""
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _cold_start
+        started = time.perf_counter()
+        set_route(route_of(event))
+        if _cold_start:
+            _cold_start = False
+            init_ms = (time.monotonic() - _init_started) * 1000
+            emit({'InitDuration': round(init_ms, 3)}, {'function': FUNCTION_NAME})
+        try:
+            return handler(event, context)
+        finally:
+            record('handler', (time.perf_counter() - started) * 1000)
+            flush()
+    return wrapper
+
+def instrument_client(client):
+    """Time every API call of a boto3 client or resource as a stage named
+    after the service and operation, e.g. dynamodb.UpdateItem. Returns the
+    client, so it can wrap the constructor call."""
+    meta_client = getattr(client.meta, 'client', client)
+    service = meta_client.meta.service_model.service_name
+
+    def before_call(context, model, **kwargs):
+        context['metrics_started'] = (model.name, time.perf_counter())
+
+    def after_call(context, **kwargs):
+        started = context.pop('metrics_started', None)
+        if started is not None:
+            operation, started_at = started
+            record(f"{service}.{operation}", (time.perf_counter() - started_at) * 1000)
+
+    events = meta_client.meta.events
+    # before-parameter-build rather than before-call: a before-call handler
+    # that answers the call (e.g. a Stubber) stops that event early
+    events.register('before-parameter-build', before_call)
+    events.register('after-call', after_call)
+    events.register('after-call-error', after_call)
+    return client
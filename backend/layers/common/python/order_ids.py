@@ -0,0 +1,62 @@
+"""
+Time-ordered order IDs and the keys of the orders' created-time index,
+shared by create_order, build_leaderboards and scripts/order_report.py.
+
+Order IDs are ULIDs: a 48-bit millisecond timestamp followed by 80 random
+bits, in Crockford base32. Each order also carries a createdBucket, the
+partition key of the sparse createdBucket-index GSI. A single key per hour
+would put every order of that hour on one index partition, capping the
+write rate at DynamoDB's per-partition limit, so each hour is spread over
+CREATED_BUCKET_SHARDS keys: 'YYYY-MM-DDTHH' for shard 0 (the key orders had
+before sharding, so they are still found) and 'YYYY-MM-DDTHH#<shard>' for
+the others. Readers query every key of an hour.
+"""
+
+import os
+import time
+
+# Crockford base32, as used by ULID. The alphabet is in ASCII order, so the
+# encoded IDs sort lexicographically in the same order as their timestamps.
+ULID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+CREATED_INDEX = "createdBucket-index"
+CREATED_BUCKET_SHARDS = 4
+
+def encode_ulid(value):
+    """The 26-character base32 form of a 128-bit value"""
+    chars = []
+    for _ in range(26):
+        chars.append(ULID_ALPHABET[value & 0x1F])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+def generate_ulid(timestamp_ms=None):
+    """A new ULID for the given millisecond (default: now)"""
+    if timestamp_ms is None:
+        timestamp_ms = int(time.time() * 1000)
+    return encode_ulid((timestamp_ms << 80) | int.from_bytes(os.urandom(10), 'big'))
+
+def ulid_bound(timestamp_ms, upper=False):
+    """Smallest (or largest) ULID that can be generated at the given millisecond"""
+    value = timestamp_ms << 80
+    if upper:
+        value |= (1 << 80) - 1
+    return encode_ulid(value)
+
+def ulid_timestamp_ms(ulid):
+    """Creation time in epoch milliseconds, from the first 10 characters"""
+    value = 0
+    for char in ulid[:10]:
+        value = value * 32 + ULID_ALPHABET.index(char)
+    return value
+
+def created_bucket(order_id, created_at):
+    """createdBucket of an order created at the given datetime. The shard
+    comes from the ULID's last, random, character."""
+    hour = created_at.strftime('%Y-%m-%dT%H')
+    shard = ULID_ALPHABET.index(order_id[-1]) % CREATED_BUCKET_SHARDS
+    return hour if shard == 0 else f"{hour}#{shard}"
+
+def created_buckets(hour):
+    """Every createdBucket of the hour given as 'YYYY-MM-DDTHH'"""
+    return [hour] + [f"{hour}#{shard}" for shard in range(1, CREATED_BUCKET_SHARDS)]
@@ -0,0 +1,121 @@
+"""
+Per-user recommendation state, shared by the writers of interactions
+(track_event, aggregate_events) and get_recommendations.
+
+The recommendation state table keeps one small item per user:
+
+    interactionVersion    bumped (ADD 1) after the user's interactions change
+    lastWriteAt           epoch seconds of that bump
+    seenProducts          every product the user interacted with (ADD)
+    cachedVersion         the interactionVersion the cached list was built from
+    recommendations       the cached list, as the serialized response body
+    expiresAt             epoch seconds; DynamoDB TTL deletes the item after it
+
+A cached list is valid while cachedVersion equals interactionVersion and it
+has not expired, so writers invalidate it without knowing anything about it.
+seenProducts lets get_recommendations exclude everything the user has seen
+while reading only their most recent interactions. It is bounded by the
+catalog; if it ever outgrows the 400 KB item limit, writers fall back to
+bumping the version alone. lastWriteAt tells get_recommendations that its
+eventually consistent reads of the interactions may not include the last
+write yet, so the list it computes from them is not cached.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from botocore.exceptions import ClientError
+from client_table import ClientTable
+
+BUMP_CONCURRENCY = 8
+
+def record_interactions(dynamodb, table_name, interactions):
+    """Add the interactions' products to each user's seenProducts and bump
+    their interactionVersion, invalidating their cached recommendations.
+
+    One UpdateItem per user, called after the interactions are written. A
+    failure is logged, and that user's cache then lives until it expires.
+    """
+    # Shared by the update threads, so on the (thread-safe) client
+    table = ClientTable(dynamodb, table_name)
+    products = {}
+    for interaction in interactions:
+        products.setdefault(interaction['userId'], set()).add(interaction['productId'])
+
+    def record(user_id):
+        try:
+            try:
+                table.update_item(
+                    Key={'userId': user_id},
+                    UpdateExpression='SET lastWriteAt = :now ADD interactionVersion :one, seenProducts :products',
+                    ExpressionAttributeValues={':now': Decimal(f"{time.time():.3f}"), ':one': 1,
+                                               ':products': products[user_id]}
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ValidationException':
+                    raise
+                # Item size limit: invalidating the cache matters more
+                print(f"Cannot add to the seen products of {user_id}: {str(e)}")
+                table.update_item(
+                    Key={'userId': user_id},
+                    UpdateExpression='SET lastWriteAt = :now ADD interactionVersion :one',
+                    ExpressionAttributeValues={':now': Decimal(f"{time.time():.3f}"), ':one': 1}
+                )
+            return True
+        except Exception as e:
+            print(f"Failed to bump the interaction version of {user_id}: {str(e)}")
+            return False
+
+    users = sorted(products)
+    if len(users) <= 1:
+        return all(record(user_id) for user_id in users)
+    with ThreadPoolExecutor(max_workers=min(BUMP_CONCURRENCY, len(users))) as executor:
+        return all(list(executor.map(record, users)))
+
+def read_state(table, user_id, attributes=None):
+    """The user's state item ({} if there is none), or only the given
+    attributes of it.
+
+    The read is strongly consistent, so an event tracked just before is
+    never answered with the list from before it.
+    """
+    kwargs = {'Key': {'userId': user_id}, 'ConsistentRead': True}
+    if attributes:
+        kwargs['ProjectionExpression'] = ', '.join(attributes)
+    return table.get_item(**kwargs).get('Item', {})
+
+def cached_recommendations(state, now=None):
+    """The cached response body of a state item, or None if it is stale"""
+    now = now or time.time()
+    version = state.get('interactionVersion', 0)
+    if 'recommendations' not in state or state.get('cachedVersion') != version:
+        return None
+    if state.get('expiresAt', 0) <= now:
+        return None  # TTL deletion can lag by hours
+    return state['recommendations']
+
+def store_recommendations(table, user_id, version, body, ttl_seconds):
+    """Cache body as built from interactionVersion version.
+
+    The write is conditional on the version being unchanged, so a list
+    computed while new interactions arrived is dropped rather than cached.
+    Returns whether it was stored.
+    """
+    try:
+        table.update_item(
+            Key={'userId': user_id},
+            UpdateExpression='SET recommendations = :body, cachedVersion = :version, expiresAt = :expires',
+            ConditionExpression=('attribute_not_exists(interactionVersion) OR interactionVersion = :version'
+                                 if version == 0 else 'interactionVersion = :version'),
+            ExpressionAttributeValues={
+                ':body': body,
+                ':version': version,
+                ':expires': int(time.time() + ttl_seconds),
+            }
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f"Interactions of {user_id} changed while recommending; not caching")
+        return False
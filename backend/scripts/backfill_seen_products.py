@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Backfill the seenProducts sets of the recommendation state table.
+
+track_event and aggregate_events add every product a user interacts with to
+the user's seenProducts set, which get_recommendations excludes while only
+reading the user's most recent interactions. Interactions written before
+the set existed are not in it; this script scans the interactions table and
+adds them. It only ADDs to the sets, so it is safe to run while events are
+being tracked, and to run again.
+
+Usage:
+    python backfill_seen_products.py --interactions-table <table> --state-table <table> [--dry-run]
+
+Example:
+    python backfill_seen_products.py --interactions-table aws-ecommerce-dev-user-interactions \\
+        --state-table aws-ecommerce-dev-recommendation-state
+"""
+
+import argparse
+import boto3
+
+# Products added per UpdateItem, keeping each request well under the limits
+PRODUCTS_PER_UPDATE = 500
+
+
+def seen_products(table):
+    """Scan the interactions table into {userId: {productId, ...}}"""
+    seen = {}
+    kwargs = {"ProjectionExpression": "userId, productId"}
+    while True:
+        response = table.scan(**kwargs)
+        for item in response["Items"]:
+            seen.setdefault(item["userId"], set()).add(item["productId"])
+        if "LastEvaluatedKey" not in response:
+            return seen
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def add_seen_products(table, user_id, products):
+    """ADD products to the user's set, PRODUCTS_PER_UPDATE at a time"""
+    products = sorted(products)
+    for start in range(0, len(products), PRODUCTS_PER_UPDATE):
+        table.update_item(
+            Key={"userId": user_id},
+            UpdateExpression="ADD seenProducts :products",
+            ExpressionAttributeValues={":products": set(products[start:start + PRODUCTS_PER_UPDATE])}
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill seenProducts from the interactions table")
+    parser.add_argument("--interactions-table", required=True, help="Name of the user-interactions table")
+    parser.add_argument("--state-table", required=True, help="Name of the recommendation state table")
+    parser.add_argument("--dry-run", action="store_true", help="Count users and products without writing")
+    parser.add_argument("--region", default="us-east-1", help="AWS region (default: us-east-1)")
+    args = parser.parse_args()
+
+    dynamodb = boto3.resource("dynamodb", region_name=args.region)
+    seen = seen_products(dynamodb.Table(args.interactions_table))
+    total = sum(len(products) for products in seen.values())
+    print(f"{len(seen)} users, {total} seen products")
+    if args.dry_run:
+        return
+
+    state_table = dynamodb.Table(args.state_table)
+    for count, (user_id, products) in enumerate(sorted(seen.items()), 1):
+        add_seen_products(state_table, user_id, products)
+        if count % 1000 == 0:
+            print(f"  {count} users done")
+    print(f"Backfilled {len(seen)} users in {args.state_table}")
+
+
+if __name__ == "__main__":
+    main()
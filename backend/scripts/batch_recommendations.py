@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Generate recommendations for every user at once, for email campaigns and
+bulk exports.
+
+Interactions become the sparse user x product matrix X of
+build_item_neighbours.py (log-damped event weights), and S is the cosine
+similarity of its columns, pruned to the --neighbours best per product.
+Every user is scored against every product with one sparse product,
+
+    scores = X S
+
+in chunks of users sized to fit --memory-mb as a dense chunk x products
+array. Products the user already interacted with are masked out and
+np.argpartition picks the top K of each row. A small popularity prior
+breaks ties and fills the lists of users with nothing similar.
+
+The lists are written to a DynamoDB table keyed by userId, by parallel
+BatchWriteItem workers while the next chunk is scored, and/or to an NDJSON
+file, one line per user:
+
+    {"userId": "user-1", "products": ["prod-7", ...], "scores": [0.82, ...], "generatedAt": "..."}
+
+Users per second and peak memory are reported for each phase; --synthetic
+generates interactions instead of reading them, to size a run.
+
+Usage:
+    python batch_recommendations.py (--table <interactions-table> | --root <dir> | --bucket <archive-bucket>
+                                     | --synthetic USERS PRODUCTS) [--start YYYY-MM-DD --end YYYY-MM-DD]
+                                    [--top-k 10] [--neighbours 50] [--memory-mb 512]
+                                    [--output-table <table>] [--output recommendations.ndjson] [--workers 8]
+
+Example:
+    python batch_recommendations.py --table aws-ecommerce-dev-user-interactions \\
+        --output-table aws-ecommerce-dev-batch-recommendations --workers 16
+    python batch_recommendations.py --synthetic 200000 20000 --memory-mb 256
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import numpy as np
+from scipy import sparse
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from build_item_neighbours import interaction_matrix, item_similarity, weights_from_archive, weights_from_table  # noqa: E402,E501
+
+
+def synthetic_interactions(users, products, per_user=20, seed=42):
+    """(user ids, product ids, weights) with Zipf-like product popularity"""
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(per_user, users) + 1
+    user_codes = np.repeat(np.arange(users), counts)
+    popularity = 1 / np.arange(1, products + 1) ** 0.8
+    item_codes = rng.choice(products, size=user_codes.size, p=popularity / popularity.sum())
+    weights = rng.choice([1, 3, 5], size=user_codes.size, p=[0.85, 0.1, 0.05]).astype(np.float32)
+    return (np.char.add("user-", user_codes.astype(str)), np.char.add("prod-", item_codes.astype(str)), weights)
+
+
+def prune_similarity(similarity, keep):
+    """Keep the `keep` highest similarities of each row, so X S stays sparse"""
+    similarity = similarity.tocsr()
+    row_lengths = np.diff(similarity.indptr)
+    for row in np.flatnonzero(row_lengths > keep):
+        start, end = similarity.indptr[row], similarity.indptr[row + 1]
+        weakest = np.argpartition(similarity.data[start:end], -keep)[:-keep]
+        similarity.data[start + weakest] = 0
+    similarity.eliminate_zeros()
+    return similarity.astype(np.float32)
+
+
+def chunk_rows(products, memory_mb):
+    """Users per chunk so that the dense scores and their temporaries fit"""
+    return max(1, int(memory_mb * 2 ** 20 // (products * 4 * 3)))
+
+
+def score_users(matrix, similarity, top_k=10, memory_mb=512):
+    """Yield (first row, top product codes, scores) per chunk of users, best
+    first; a user with fewer unseen products than top_k gets -inf scores in
+    the trailing columns"""
+    users, products = matrix.shape
+    popularity = np.asarray((matrix > 0).sum(axis=0), dtype=np.float32).ravel()
+    prior = popularity / max(float(popularity.max(initial=0)), 1.0) * np.float32(1e-3)
+    k = min(top_k, products)
+    rows_per_chunk = chunk_rows(products, memory_mb)
+
+    for start in range(0, users, rows_per_chunk):
+        rows = matrix[start:start + rows_per_chunk]
+        scores = (rows @ similarity).toarray().astype(np.float32, copy=False)
+        scores += prior
+        seen_rows, seen_columns = rows.nonzero()
+        scores[seen_rows, seen_columns] = -np.inf
+        top = np.argpartition(scores, -k, axis=1)[:, -k:]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        yield start, np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def to_records(user_ids, item_ids, start, top, top_scores, generated_at):
+    """The chunk's lists as records, dropping the -inf padding"""
+    records = []
+    for offset, (codes, scores) in enumerate(zip(top, top_scores)):
+        valid = np.isfinite(scores)
+        records.append({
+            "userId": str(user_ids[start + offset]),
+            "products": [str(item_ids[code]) for code in codes[valid]],
+            "scores": [round(float(score), 4) for score in scores[valid]],
+            "generatedAt": generated_at,
+        })
+    return records
+
+
+class TableWriter:
+    """Writes records with BatchWriteItem from a pool of threads, each with
+    its own boto3 resource (they are not thread-safe).
+
+    At most two slices per worker are queued or in flight: submit waits for
+    the oldest beyond that, so the records held in memory stay bounded
+    however far the scoring runs ahead of the writes.
+    """
+
+    def __init__(self, table_name, workers, region, ttl_days):
+        self.table_name = table_name
+        self.region = region
+        self.ttl_days = ttl_days
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = 2 * workers
+        self.pending = deque()
+        self.written = 0
+
+    def _table(self):
+        if not hasattr(self.local, "table"):
+            import boto3
+            self.local.table = boto3.session.Session().resource("dynamodb", region_name=self.region).Table(
+                self.table_name)
+        return self.local.table
+
+    def _write(self, records):
+        expires_at = int(time.time() + self.ttl_days * 86400)
+        with self._table().batch_writer() as batch:
+            for record in records:
+                batch.put_item(Item=dict(record, scores=[Decimal(str(score)) for score in record["scores"]],
+                                         expiresAt=expires_at))
+        return len(records)
+
+    def submit(self, records, slice_size=500):
+        for start in range(0, len(records), slice_size):
+            while self.pending and (self.pending[0].done() or len(self.pending) >= self.max_pending):
+                self.written += self.pending.popleft().result()
+            self.pending.append(self.executor.submit(self._write, records[start:start + slice_size]))
+
+    def wait(self):
+        while self.pending:
+            self.written += self.pending.popleft().result()
+        self.executor.shutdown()
+        return self.written
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process (ru_maxrss is in KB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate top-K recommendations for every user in batch")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--table", help="Scan this user-interactions table")
+    source.add_argument("--root", help="Read a local copy of the interaction archive")
+    source.add_argument("--bucket", help="Read the interaction archive bucket")
+    source.add_argument("--synthetic", type=int, nargs=2, metavar=("USERS", "PRODUCTS"),
+                        help="Generate interactions for USERS users over PRODUCTS products")
+    parser.add_argument("--start", type=date.fromisoformat, help="First archive date (YYYY-MM-DD)")
+    parser.add_argument("--end", type=date.fromisoformat, help="Last archive date, inclusive")
+    parser.add_argument("--top-k", type=int, default=10, help="Products per user (default: 10)")
+    parser.add_argument("--neighbours", type=int, default=50, help="Similar products kept per product (default: 50)")
+    parser.add_argument("--max-items-per-user", type=int, default=200,
+                        help="Strongest products kept per user (default: 200)")
+    parser.add_argument("--memory-mb", type=int, default=512, help="Memory for one chunk of scores (default: 512)")
+    parser.add_argument("--output-table", help="Write the lists to this DynamoDB table (keyed by userId)")
+    parser.add_argument("--output", help="Write the lists to this NDJSON file")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel batch writers (default: 8)")
+    parser.add_argument("--ttl-days", type=int, default=7, help="Days until written lists expire (default: 7)")
+    parser.add_argument("--region", default="us-east-1", help="AWS region (default: us-east-1)")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.synthetic:
+        users, items, weights = synthetic_interactions(*args.synthetic)
+    elif args.table:
+        import boto3
+        users, items, weights = weights_from_table(boto3.resource("dynamodb", region_name=args.region).Table(args.table))
+    else:
+        if not args.start or not args.end:
+            parser.error("--start and --end are required when reading the archive")
+        from load_interactions import load_interactions
+        import boto3
+        s3 = boto3.client("s3", region_name=args.region) if args.bucket else None
+        users, items, weights = weights_from_archive(load_interactions(args.start, args.end, args.bucket, args.root, s3))
+    loaded = time.perf_counter()
+
+    matrix, item_ids = interaction_matrix(users, items, weights, args.max_items_per_user)
+    user_ids = np.unique(np.asarray(users, dtype=str))
+    similarity = prune_similarity(item_similarity(matrix), args.neighbours)
+    matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+    built = time.perf_counter()
+    print(f"{matrix.shape[0]} users x {matrix.shape[1]} products, {matrix.nnz} pairs, "
+          f"{similarity.nnz} similar pairs (loaded in {loaded - started:.1f}s, built in {built - loaded:.1f}s)")
+    print(f"Scoring {chunk_rows(matrix.shape[1], args.memory_mb)} users per chunk")
+
+    writer = TableWriter(args.output_table, args.workers, args.region, args.ttl_days) if args.output_table else None
+    output = open(args.output, "w") if args.output else None
+    generated_at = datetime.now(timezone.utc).isoformat()
+    sample = None
+    try:
+        for start, top, top_scores in score_users(matrix, similarity, args.top_k, args.memory_mb):
+            records = to_records(user_ids, item_ids, start, top, top_scores, generated_at)
+            sample = sample or records[:3]
+            if writer:
+                writer.submit(records)
+            if output:
+                output.writelines(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+        scored = time.perf_counter()
+        written = writer.wait() if writer else 0
+    finally:
+        if output:
+            output.close()
+    finished = time.perf_counter()
+
+    count = matrix.shape[0]
+    print(f"Scored {count} users in {scored - built:.1f}s ({count / max(scored - built, 1e-9):,.0f} users/s)")
+    if writer:
+        # Writes overlap the scoring, so their rate is over both
+        print(f"Wrote {written} lists to {args.output_table} in {finished - built:.1f}s "
+              f"({written / max(finished - built, 1e-9):,.0f} users/s)")
+    if output:
+        print(f"Wrote {args.output}")
+    print(f"Peak memory {peak_memory_mb():,.0f} MB")
+    if not (writer or output):
+        for record in sample or []:
+            print(f"  {record['userId']}: {', '.join(record['products'][:5])}")
+
+if __name__ == "__main__":
+    main()
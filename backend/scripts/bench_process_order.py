@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Benchmark process_order batch throughput as a function of concurrency.
+
+The handler runs against the in-memory AWS stand-ins from tests/local_aws.py,
+with a fixed latency injected into every SES, S3 and DynamoDB call to mimic
+network round trips. No AWS account is needed.
+
+Payments approve instantly unless --payment-latency-ms is given, in which
+case the gateway simulator from payments.py is used: latency sampled from a
+distribution, declines, gateway errors and timeouts (retried, then deferred
+to the retry queue). --seed makes those runs reproducible.
+
+Usage:
+    python bench_process_order.py [--batch-size 10] [--latency-ms 20] [--concurrency 1 2 4 8]
+                                  [--payment-latency-ms 150 --payment-sigma 0.5 --decline-rate 0.02
+                                   --payment-error-rate 0.01 --payment-timeout 1 --seed 42]
+
+Example:
+    python bench_process_order.py --batch-size 10 --latency-ms 25 --concurrency 1 2 5 10
+    python bench_process_order.py --payment-latency-ms 200 --payment-sigma 0.8 --payment-timeout 1 \
+        --decline-rate 0.05 --seed 42 --concurrency 1 5 10
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+
+from local_aws import (FakeDynamoDB, FakeS3, FakeSES, FakeSQS, FakeTable, load_lambda,  # noqa: E402
+                       sqs_record)
+import metrics  # noqa: E402
+
+CUSTOMER_EMAIL = "customer@example.com"
+
+
+class WithLatency:
+    """Proxy that sleeps before forwarding every method call"""
+
+    def __init__(self, target, latency_seconds):
+        self._target = target
+        self._latency = latency_seconds
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            time.sleep(self._latency)
+            return attribute(*args, **kwargs)
+        return call
+
+
+class SlowDynamoDB(FakeDynamoDB):
+    def __init__(self, tables, latency_seconds):
+        super().__init__(tables)
+        self.latency = latency_seconds
+
+    def Table(self, name):
+        return WithLatency(super().Table(name), self.latency)
+
+
+def make_batch(orders, batch_size, batch_number):
+    """Store PENDING orders as create_order does and return their SQS event"""
+    items = [{"productId": f"prod-{i}", "quantity": 1,
+              "product": {"name": f"Product {i}", "price": 9.99}} for i in range(3)]
+    records = []
+    for i in range(batch_size):
+        order_id = f"order-{batch_number}-{i}"
+        orders.put_item(Item={"orderId": order_id, "status": "PENDING"})
+        records.append(sqs_record({
+            "orderId": order_id,
+            "userId": f"user-{i}",
+            "total": 29.97,
+            "items": items,
+            "shippingInfo": {"name": "Bench User", "email": CUSTOMER_EMAIL,
+                             "address": "1 Bench St", "city": "Bench City", "zipCode": "00000"},
+        }))
+    return {"Records": records}
+
+
+def run(concurrency, batch_size, latency_seconds, rounds, payment=None):
+    """Return (orders/s, seconds per batch, declined, deferred) at the given
+    concurrency. payment holds SimulatedPaymentGateway settings, if any."""
+    os.environ.update({
+        "ORDER_CONCURRENCY": str(concurrency),
+        "ORDERS_TABLE": "orders",
+        "CARTS_TABLE": "carts",
+        "INVOICE_BUCKET": "invoices",
+        "SES_SENDER_EMAIL": "shop@example.com",
+    })
+    app = load_lambda("process_order")
+    orders = FakeTable("orders", ["orderId"])
+    fake_dynamodb = SlowDynamoDB([orders, FakeTable("carts", ["userId"])], latency_seconds)
+    app.dynamodb = fake_dynamodb
+    app.get_dynamodb = lambda: fake_dynamodb
+    app.ses = WithLatency(FakeSES(verified=[CUSTOMER_EMAIL]), latency_seconds)
+    app.s3 = WithLatency(FakeS3(), latency_seconds)
+    app.sqs = FakeSQS()
+    app.RETRY_QUEUE_URL = "https://sqs.local/orders"
+    app.print = metrics.print = lambda *args, **kwargs: None
+    if payment:
+        from payments import SimulatedPaymentGateway
+        app.payment_client = SimulatedPaymentGateway(**payment)
+
+    events = [make_batch(orders, batch_size, batch_number) for batch_number in range(rounds)]
+    started = time.perf_counter()
+    for event in events:
+        response = app.lambda_handler(event, None)
+        assert not response["batchItemFailures"], response
+    elapsed = time.perf_counter() - started
+    declined = sum(1 for item in orders.items.values() if item["status"] == "PAYMENT_FAILED")
+    return batch_size * rounds / elapsed, elapsed / rounds, declined, len(app.sqs.messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark process_order batch throughput")
+    parser.add_argument("--batch-size", type=int, default=10, help="Records per SQS batch (default: 10)")
+    parser.add_argument("--latency-ms", type=float, default=20,
+                        help="Injected latency per AWS call in ms (default: 20)")
+    parser.add_argument("--rounds", type=int, default=3, help="Batches per measurement (default: 3)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 10],
+                        help="Concurrency levels to measure (default: 1 2 4 8 10)")
+    parser.add_argument("--payment-latency-ms", type=float,
+                        help="Median simulated payment latency in ms (default: instant approval)")
+    parser.add_argument("--payment-distribution", default="lognormal", choices=["fixed", "uniform", "lognormal"],
+                        help="Payment latency distribution (default: lognormal)")
+    parser.add_argument("--payment-sigma", type=float, default=0.5,
+                        help="Shape of the lognormal payment latency (default: 0.5)")
+    parser.add_argument("--decline-rate", type=float, default=0.0, help="Share of declined payments (default: 0)")
+    parser.add_argument("--payment-error-rate", type=float, default=0.0,
+                        help="Share of payment gateway errors (default: 0)")
+    parser.add_argument("--payment-timeout", type=float, default=5.0,
+                        help="Payment gateway timeout in seconds (default: 5)")
+    parser.add_argument("--seed", type=int, help="Seed for reproducible payment outcomes")
+    args = parser.parse_args()
+
+    payment = None
+    if args.payment_latency_ms is not None:
+        payment = {
+            "distribution": args.payment_distribution,
+            "median_ms": args.payment_latency_ms,
+            "sigma": args.payment_sigma,
+            "decline_rate": args.decline_rate,
+            "error_rate": args.payment_error_rate,
+            "timeout_seconds": args.payment_timeout,
+            "seed": args.seed,
+        }
+
+    print(f"Batch size {args.batch_size}, {args.latency_ms:.0f} ms per AWS call, {args.rounds} rounds")
+    if payment:
+        print(f"Simulated payments: {args.payment_distribution} latency, median {args.payment_latency_ms:.0f} ms, "
+              f"{args.decline_rate:.0%} declined, {args.payment_error_rate:.0%} errors, "
+              f"{args.payment_timeout:g} s timeout")
+    print(f"{'concurrency':>12} {'batch ms':>10} {'orders/s':>10} {'speedup':>8} {'declined':>9} {'deferred':>9}")
+    baseline = None
+    for concurrency in args.concurrency:
+        throughput, batch_seconds, declined, deferred = run(
+            concurrency, args.batch_size, args.latency_ms / 1000, args.rounds, payment)
+        baseline = baseline or throughput
+        print(f"{concurrency:>12} {batch_seconds * 1000:>10.1f} {throughput:>10.1f} {throughput / baseline:>7.1f}x"
+              f" {declined:>9} {deferred:>9}")
+
+
+if __name__ == "__main__":
+    main()
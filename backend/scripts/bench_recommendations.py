@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Benchmark get_recommendations for users with long interaction histories.
+
+For each history size a synthetic user is generated (views, add-to-carts
+and purchases spread over --days days and --categories categories), with
+records shaped as the counters track_event keeps (affinity included) or,
+with --legacy, as records that only hold their last event. It is timed
+three ways:
+
+    sort     the previous approach: sort the whole history by timestamp to
+             find the most recent category
+    score    scoring.score_interactions + top_k: event-weighted, decayed
+             scores for every product and category in one pass
+    handler  the full handler, against in-memory tables, so only the
+             analysis and not DynamoDB latency is measured
+
+Usage:
+    python bench_recommendations.py [--interactions 1000 10000 50000] [--categories 8] [--repeat 20] [--legacy]
+
+Example:
+    python bench_recommendations.py --interactions 100 1000 10000 100000 --repeat 10
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+
+from local_aws import FakeDynamoDB, FakeTable, load_lambda  # noqa: E402
+from interactions import EVENT_COUNTERS, affinity_era, affinity_weight  # noqa: E402
+import metrics  # noqa: E402
+
+EVENT_MIX = [("product-view", 0.85), ("add-to-cart", 0.1), ("purchase", 0.05)]
+
+
+class PartitionTable:
+    """Interactions table that answers the partition query from a list"""
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+
+    def query(self, **kwargs):
+        return {"Items": list(self.items)}
+
+
+def synthetic_history(count, categories, days, seed, legacy=False):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    era = affinity_era(now)
+    event_types, weights = zip(*EVENT_MIX)
+    history = []
+    for index in range(count):
+        category = f"category-{min(int(rng.expovariate(0.6)), categories - 1)}"
+        record = {
+            "userId": "bench-user",
+            "productId": f"{category}-prod-{index}",
+            "eventType": rng.choices(event_types, weights)[0],
+            "category": category,
+            "timestamp": (now - timedelta(seconds=rng.uniform(0, days * 86400))).isoformat(),
+        }
+        if not legacy:
+            record.update({counter: Decimal(0) for counter in EVENT_COUNTERS.values()})
+            record[EVENT_COUNTERS[record["eventType"]]] = Decimal(1)
+            record["affinity"] = Decimal(f"{affinity_weight(record['eventType'], record['timestamp'], era):.15g}")
+            record["affinityEra"] = era
+        history.append(record)
+    return history
+
+
+def catalog(categories, per_category=40):
+    products = FakeTable("products", ["productId"], indexes={"category-index": None})
+    for category in range(categories):
+        for index in range(per_category):
+            products.put_item(Item={"productId": f"catalog-{category}-{index}", "name": "Product",
+                                    "category": f"category-{category}", "price": Decimal("9.99"),
+                                    "stock": Decimal("10")})
+    return products
+
+
+def time_ms(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recommendation scoring on long histories")
+    parser.add_argument("--interactions", type=int, nargs="+", default=[1000, 10000, 50000],
+                        help="History sizes to benchmark (default: 1000 10000 50000)")
+    parser.add_argument("--categories", type=int, default=8, help="Categories in the history (default: 8)")
+    parser.add_argument("--days", type=int, default=180, help="Days the history spans (default: 180)")
+    parser.add_argument("--repeat", type=int, default=20, help="Runs per measurement, median reported")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--legacy", action="store_true", help="Records without counters or affinity")
+    args = parser.parse_args()
+
+    os.environ.update({"INTERACTIONS_TABLE": "interactions", "PRODUCTS_TABLE": "products"})
+    os.environ.pop("NEIGHBOURS_TABLE", None)
+    app = load_lambda("get_recommendations")
+    import scoring
+    metrics.print = lambda *args, **kwargs: None  # keep the EMF lines out of the report
+    products = catalog(args.categories)
+
+    print(f"{'interactions':>12} {'sort ms':>9} {'score ms':>9} {'handler ms':>11}  top categories")
+    for count in args.interactions:
+        history = synthetic_history(count, args.categories, args.days, args.seed, args.legacy)
+        app.dynamodb = FakeDynamoDB([PartitionTable("interactions", history), products])
+        event = {"queryStringParameters": {"userId": "bench-user"}}
+
+        sort_ms = time_ms(lambda: sorted(history, key=lambda x: x.get("timestamp", ""), reverse=True)[0]["category"],
+                          args.repeat)
+        score_ms = time_ms(lambda: scoring.top_k(scoring.score_interactions(history)[1], 3), args.repeat)
+        handler_ms = time_ms(lambda: app.lambda_handler(event, None), args.repeat)
+
+        _, categories = scoring.score_interactions(history)
+        top = ", ".join(scoring.top_k(categories, 3))
+        assert len(json.loads(app.lambda_handler(event, None)["body"])) == 10
+        print(f"{count:>12} {sort_ms:>9.2f} {score_ms:>9.2f} {handler_ms:>11.2f}  {top}")
+
+
+if __name__ == "__main__":
+    main()
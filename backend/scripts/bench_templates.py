@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Benchmark rendering of the process_order email and invoice templates.
+
+Templates are loaded once at import, exactly as in a warm Lambda container,
+and each render is timed for orders with 1 to 500 line items.
+
+Usage:
+    python bench_templates.py [--items 1 10 50 100 500] [--repeat 200]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambdas", "process_order"))
+
+from rendering import render_confirmation_email, render_invoice  # noqa: E402
+
+SHIPPING_INFO = {
+    "name": "Bench User",
+    "email": "bench@example.com",
+    "address": "1 Bench St",
+    "city": "Bench City",
+    "zipCode": "00000",
+}
+
+
+def make_items(count):
+    return [{"productId": f"prod-{i}", "quantity": i % 5 + 1,
+             "product": {"name": f"Benchmark Product {i}", "price": 9.99 + i}} for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark email and invoice template rendering")
+    parser.add_argument("--items", type=int, nargs="+", default=[1, 10, 50, 100, 500],
+                        help="Line item counts to measure (default: 1 10 50 100 500)")
+    parser.add_argument("--repeat", type=int, default=200, help="Renders per measurement (default: 200)")
+    args = parser.parse_args()
+
+    print(f"{'items':>6} {'email us':>10} {'invoice us':>11} {'email KB':>9}")
+    for count in args.items:
+        items = make_items(count)
+        total = sum(item["quantity"] * item["product"]["price"] for item in items)
+
+        def email():
+            return render_confirmation_email("01JBENCHMARK0000000000000", "2025-01-01 00:00:00",
+                                             SHIPPING_INFO, items, total)
+
+        def invoice():
+            return render_invoice("01JBENCHMARK0000000000000", "user-bench", "2025-01-01 00:00:00",
+                                  SHIPPING_INFO, items, total)
+
+        email_us = timeit.timeit(email, number=args.repeat) / args.repeat * 1e6
+        invoice_us = timeit.timeit(invoice, number=args.repeat) / args.repeat * 1e6
+        size_kb = sum(len(body) for body in email()) / 1024
+        print(f"{count:>6} {email_us:>10.1f} {invoice_us:>11.1f} {size_kb:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
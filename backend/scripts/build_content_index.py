@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Build the content-based product similarity index used by get_recommendations.
+
+Recommendations from interactions only reach products someone has already
+interacted with; this index relates products by their text instead, so a
+new product is recommended next to similar ones in any category.
+
+Each product's name (counted twice) and description are tokenized and
+hashed into a 2^--dims-bit space (signed feature hashing, no vocabulary to
+ship or grow), weighted by sublinear TF-IDF and L2-normalized, so a dot
+product is the cosine similarity.
+
+Comparing every pair of products is quadratic. Instead the catalog is
+partitioned by content (spherical k-means on a random projection, see
+partitions), each product joining its --probes nearest partitions of about
+--partition-size products. Cosines are computed exactly within partitions
+only, which costs O(products x probes x partition size) instead of
+O(products^2). The top K of each product over all its partitions are kept.
+The result is approximate: more probes find more of the true neighbours at
+proportionally more time (see partitions).
+
+The index is written as one compact binary object (see content_index in the
+common layer) to S3 and/or a local file.
+
+Usage:
+    python build_content_index.py (--table <products-table> | --synthetic PRODUCTS)
+                                  [--top-k 20] [--min-score 0.05] [--partition-size 256] [--probes 5]
+                                  [--bucket <bucket> --key indexes/content-similarity.bin] [--output index.bin]
+
+Example:
+    python build_content_index.py --table aws-ecommerce-dev-products \\
+        --bucket aws-ecommerce-dev-interaction-archive-1a2b3c4d
+    python build_content_index.py --synthetic 200000 --output /tmp/content-index.bin
+"""
+
+import argparse
+import math
+import os
+import re
+import sys
+import time
+import zlib
+
+import numpy as np
+from scipy import sparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "layers", "common", "python"))
+
+from content_index import SCORE_SCALE, ContentIndex, pack  # noqa: E402
+
+DEFAULT_KEY = "indexes/content-similarity.bin"
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has in is it its of on or that the to with your you this".split())
+TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokens(product):
+    """Lowercase word tokens of the name (twice) and description"""
+    text = f"{product.get('name', '')} {product.get('name', '')} {product.get('description', '')}"
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOP_WORDS and len(token) > 1]
+
+
+def hashed_tfidf(products, dims=18):
+    """Sparse products x 2^dims matrix of L2-normalized TF-IDF weights.
+
+    Each token is hashed with CRC32: the low bits pick the column, the top
+    bit a sign, so collisions cancel out on average instead of adding up.
+    """
+    hashes = {}
+    rows, columns = [], []
+    for row, product in enumerate(products):
+        for token in tokens(product):
+            code = hashes.get(token)
+            if code is None:
+                code = hashes[token] = zlib.crc32(token.encode("utf-8"))
+            rows.append(row)
+            columns.append(code)
+    codes = np.asarray(columns, dtype=np.uint32)
+    signs = np.where(codes >> 31, -1.0, 1.0).astype(np.float32)
+    counts = sparse.csr_matrix((np.ones(codes.size, dtype=np.float32), (rows, codes & ((1 << dims) - 1))),
+                               shape=(len(products), 1 << dims))
+    counts.sum_duplicates()
+    signed = sparse.csr_matrix((signs, (rows, codes & ((1 << dims) - 1))), shape=counts.shape)
+    signed.sum_duplicates()
+
+    document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log((1 + len(products)) / (1 + document_frequency)).astype(np.float32) + 1
+    matrix = counts.copy()
+    matrix.data = (1 + np.log(matrix.data)) * idf[matrix.indices] * np.sign(signed.data)
+    matrix.eliminate_zeros()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms).astype(np.float32) @ matrix)
+
+
+def partitions(matrix, partition_size=256, probes=5, max_block=1024, dims=256, iterations=8, seed=42):
+    """Yield arrays of product rows to compare with each other.
+
+    The TF-IDF vectors are projected onto `dims` random directions (which
+    roughly preserves cosines) and clustered with spherical k-means into
+    about products / partition_size partitions, trained on a sample. Each
+    product joins the partitions of its `probes` nearest centroids, so
+    neighbours near a partition boundary still meet. Partitions larger than
+    max_block are split.
+
+    The search is approximate, and probes trades recall for time, which
+    grows about linearly with it. On 3,000 synthetic products (12
+    partitions) the share of the exact top 10 found is about 16% with 1
+    probe, 74% with 3, 90% with 5 and 98% with 8. Fewer than two products yield nothing.
+    """
+    rng = np.random.default_rng(seed)
+    count = matrix.shape[0]
+    if count < 2:
+        return
+    used = np.unique(matrix.indices)
+    projected = np.asarray(matrix[:, used] @ rng.standard_normal((len(used), dims)).astype(np.float32))
+    projected /= np.maximum(np.linalg.norm(projected, axis=1, keepdims=True), 1e-9)
+
+    clusters = max(1, math.ceil(count / partition_size))
+    sample = projected[rng.choice(count, min(count, clusters * 40), replace=False)]
+    centroids = sample[rng.choice(len(sample), clusters, replace=False)]
+    for _ in range(iterations):
+        labels = np.argmax(sample @ centroids.T, axis=1)
+        members = sparse.csr_matrix((np.ones(len(labels), dtype=np.float32), (labels, np.arange(len(labels)))),
+                                    shape=(clusters, len(sample)))
+        sums = np.asarray(members @ sample)
+        filled = np.asarray(members.sum(axis=1)).ravel() > 0
+        centroids[filled] = sums[filled] / np.linalg.norm(sums[filled], axis=1, keepdims=True)
+
+    probes = min(probes, clusters)
+    rows, labels = [], []
+    for start in range(0, count, 4096):
+        similarity = projected[start:start + 4096] @ centroids.T
+        nearest = np.argpartition(similarity, -probes, axis=1)[:, -probes:] if probes < clusters else \
+            np.broadcast_to(np.arange(clusters), similarity.shape)
+        rows.append(np.repeat(np.arange(start, start + len(similarity)), probes))
+        labels.append(nearest.ravel())
+    rows, labels = np.concatenate(rows), np.concatenate(labels)
+    order = np.argsort(labels, kind="stable")
+    rows, labels = rows[order], labels[order]
+    for partition in np.split(rows, np.flatnonzero(np.diff(labels)) + 1):
+        if len(partition) > max_block:
+            partition = rng.permutation(partition)
+        for start in range(0, len(partition), max_block):
+            block = partition[start:start + max_block]
+            if len(block) > 1:
+                yield block
+
+
+def nearest_neighbours(matrix, top_k=20, min_score=0.05, partition_size=256, probes=5, max_block=1024):
+    """(neighbours, scores): n x top_k arrays of the most similar products
+    found in shared partitions, best first; -1 and 0 pad short lists"""
+    count = matrix.shape[0]
+    pair_rows, pair_columns, pair_scores = [], [], []
+    for block in partitions(matrix, partition_size, probes, max_block):
+        rows = matrix[block]
+        similarity = (rows @ rows.T).toarray()
+        np.fill_diagonal(similarity, 0)
+        keep = min(top_k, len(block) - 1)
+        best = np.argpartition(similarity, -keep, axis=1)[:, -keep:]
+        scores = np.take_along_axis(similarity, best, axis=1)
+        mask = scores >= min_score
+        pair_rows.append(np.repeat(block, keep).reshape(-1, keep)[mask])
+        pair_columns.append(block[best][mask])
+        pair_scores.append(scores[mask])
+
+    neighbours = np.full((count, top_k), -1, dtype="<i4")
+    quantized = np.zeros((count, top_k), dtype="<u2")
+    if not pair_rows:
+        return neighbours, quantized
+    rows, columns, scores = np.concatenate(pair_rows), np.concatenate(pair_columns), np.concatenate(pair_scores)
+
+    # The same pair found in several partitions has the same score; keep one
+    _, unique = np.unique(rows.astype(np.int64) * count + columns, return_index=True)
+    rows, columns, scores = rows[unique], columns[unique], scores[unique]
+    order = np.lexsort((-scores, rows))
+    rows, columns, scores = rows[order], columns[order], scores[order]
+    starts = np.searchsorted(rows, rows, side="left")
+    ranks = np.arange(len(rows)) - starts
+    kept = ranks < top_k
+    neighbours[rows[kept], ranks[kept]] = columns[kept]
+    quantized[rows[kept], ranks[kept]] = np.round(np.clip(scores[kept], 0, 1) * SCORE_SCALE)
+    return neighbours, quantized
+
+
+def scan_products(table):
+    """Every product's id, name and description"""
+    products = []
+    kwargs = {"ProjectionExpression": "productId, #name, description", "ExpressionAttributeNames": {"#name": "name"}}
+    while True:
+        response = table.scan(**kwargs)
+        products.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            return products
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def synthetic_products(count, vocabulary=20000, topics=500, seed=42):
+    """Products whose words mostly come from one of `topics` word groups"""
+    rng = np.random.default_rng(seed)
+    words = np.char.add("w", np.arange(vocabulary).astype(str))
+    topic_words = rng.integers(0, vocabulary, size=(topics, 40))
+    products = []
+    for number, topic in enumerate(rng.integers(0, topics, size=count)):
+        own = topic_words[topic][rng.integers(0, 40, size=12)]
+        noise = rng.integers(0, vocabulary, size=4)
+        text = words[np.concatenate([own, noise])]
+        products.append({"productId": f"prod-{number}", "name": " ".join(text[:4]),
+                         "description": " ".join(text[4:])})
+    return products
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the content-based product similarity index")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--table", help="Scan this products table")
+    source.add_argument("--synthetic", type=int, metavar="PRODUCTS", help="Generate this many products")
+    parser.add_argument("--top-k", type=int, default=20, help="Neighbours kept per product (default: 20)")
+    parser.add_argument("--min-score", type=float, default=0.05, help="Smallest similarity kept (default: 0.05)")
+    parser.add_argument("--dims", type=int, default=18, help="Hashed feature bits (default: 18)")
+    parser.add_argument("--partition-size", type=int, default=256, help="Products per partition (default: 256)")
+    parser.add_argument("--probes", type=int, default=5,
+                        help="Partitions each product joins; more find more of the true neighbours, "
+                             "at proportionally more time (default: 5)")
+    parser.add_argument("--max-block", type=int, default=1024, help="Largest partition compared whole (default: 1024)")
+    parser.add_argument("--bucket", help="Upload the index to this S3 bucket")
+    parser.add_argument("--key", default=DEFAULT_KEY, help=f"S3 key of the index (default: {DEFAULT_KEY})")
+    parser.add_argument("--output", help="Also write the index to this file")
+    parser.add_argument("--region", default="us-east-1", help="AWS region (default: us-east-1)")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.table:
+        import boto3
+        products = scan_products(boto3.resource("dynamodb", region_name=args.region).Table(args.table))
+    else:
+        products = synthetic_products(args.synthetic)
+    product_ids = [str(product["productId"]) for product in products]
+    loaded = time.perf_counter()
+
+    matrix = hashed_tfidf(products, args.dims)
+    vectorized = time.perf_counter()
+    neighbours, scores = nearest_neighbours(matrix, args.top_k, args.min_score, args.partition_size, args.probes,
+                                            args.max_block)
+    built = time.perf_counter()
+    data = pack(product_ids, neighbours, scores, args.top_k)
+
+    print(f"{len(products)} products, {matrix.nnz} hashed terms (loaded in {loaded - started:.1f}s, "
+          f"vectorized in {vectorized - loaded:.1f}s)")
+    print(f"{int((neighbours >= 0).sum())} neighbours, {int((neighbours[:, 0] >= 0).sum())} products with any "
+          f"(built in {built - vectorized:.1f}s), index {len(data) / 2 ** 20:.1f} MB")
+
+    index = ContentIndex(data)
+    lookups = product_ids[:1000]
+    lookup_started = time.perf_counter()
+    for product_id in lookups:
+        index.similar(product_id)
+    if lookups:
+        print(f"Lookup {(time.perf_counter() - lookup_started) / len(lookups) * 1e6:.1f} us per product")
+
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(data)
+        print(f"Wrote {args.output}")
+    if args.bucket:
+        import boto3
+        boto3.client("s3", region_name=args.region).put_object(
+            Bucket=args.bucket, Key=args.key, Body=data, ContentType="application/octet-stream")
+        print(f"Uploaded s3://{args.bucket}/{args.key}")
+    if not (args.output or args.bucket):
+        for product_id in product_ids[:5]:
+            print(f"  {product_id}: {', '.join(f'{n} ({s:.2f})' for n, s in index.similar(product_id, 5))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Build the item-to-item neighbour lists used by get_recommendations.
+
+Interactions are turned into a sparse user x product matrix, weighted by
+event type (view 1, add-to-cart 3, purchase 5, log-damped so a hundred views
+don't drown one purchase). The cosine similarity of its columns,
+C = X^T X / (|x_i| |x_j|), says how often two products are wanted by the same
+users. The top K neighbours of every product are written to the neighbours
+table, one item per product:
+
+    {"productId": "prod-1", "neighbours": [{"productId": "prod-7", "score": 0.82}, ...]}
+
+The build replaces the table: items of products it has no list for are
+deleted.
+
+Interactions are read from the user-interactions table (a scan of the
+per-pair counters) or from the interaction archive (see load_interactions.py).
+
+Usage:
+    python build_item_neighbours.py (--table <interactions-table> | --root <dir> | --bucket <archive-bucket>)
+                                    [--start YYYY-MM-DD --end YYYY-MM-DD] [--top-k 20]
+                                    [--neighbours-table <table>] [--output neighbours.json] [--dry-run]
+
+Example:
+    python build_item_neighbours.py --table aws-ecommerce-dev-user-interactions \\
+        --neighbours-table aws-ecommerce-dev-item-neighbours --top-k 20
+    python build_item_neighbours.py --root archive --start 2025-05-01 --end 2025-06-30 --output neighbours.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+from scipy import sparse
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "layers", "common", "python"))
+
+from interactions import EVENT_COUNTERS, EVENT_WEIGHTS  # noqa: E402
+
+
+def weights_from_table(table):
+    """Scan the interactions table into (user ids, product ids, weights)"""
+    users, items, weights = [], [], []
+    projection = "userId, productId, eventType, " + ", ".join(EVENT_COUNTERS.values())
+    kwargs = {"ProjectionExpression": projection}
+    while True:
+        response = table.scan(**kwargs)
+        for item in response["Items"]:
+            counts = {event_type: int(item.get(counter, 0)) for event_type, counter in EVENT_COUNTERS.items()}
+            if not any(counts.values()):
+                # Records written before the counters existed hold the last event only
+                counts[item["eventType"]] = 1
+            users.append(item["userId"])
+            items.append(item["productId"])
+            weights.append(sum(EVENT_WEIGHTS[event_type] * count for event_type, count in counts.items()))
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return users, items, weights
+
+
+def weights_from_archive(arrays):
+    """Archived events (load_interactions arrays) as (user ids, product ids, weights)"""
+    from load_interactions import EVENT_TYPES
+
+    event_weights = np.array([EVENT_WEIGHTS[event_type] for event_type in EVENT_TYPES], dtype=np.float32)
+    return arrays["users"][arrays["user"]], arrays["items"][arrays["item"]], event_weights[arrays["event"]]
+
+
+def interaction_matrix(users, items, weights, max_items_per_user=200):
+    """Sparse user x product matrix of log-damped weights.
+
+    Repeated (user, product) pairs are summed. Only each user's
+    max_items_per_user strongest products are kept, which bounds the cost of
+    X^T X (quadratic in the products per user). Returns (matrix, product ids).
+    """
+    user_ids, user_codes = np.unique(np.asarray(users, dtype=str), return_inverse=True)
+    item_ids, item_codes = np.unique(np.asarray(items, dtype=str), return_inverse=True)
+    matrix = sparse.coo_matrix(
+        (np.asarray(weights, dtype=np.float32), (user_codes, item_codes)),
+        shape=(len(user_ids), len(item_ids))
+    ).tocsr()
+    matrix.sum_duplicates()
+    matrix.data = np.log1p(matrix.data)
+
+    row_lengths = np.diff(matrix.indptr)
+    if row_lengths.size and row_lengths.max() > max_items_per_user:
+        for row in np.flatnonzero(row_lengths > max_items_per_user):
+            start, end = matrix.indptr[row], matrix.indptr[row + 1]
+            weakest = np.argpartition(matrix.data[start:end], -max_items_per_user)[:-max_items_per_user]
+            matrix.data[start + weakest] = 0
+        matrix.eliminate_zeros()
+    return matrix, item_ids
+
+
+def item_similarity(matrix):
+    """Cosine similarity between the product columns, without the diagonal"""
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    norms[norms == 0] = 1
+    normalized = matrix.multiply(1 / norms).tocsc()
+    similarity = (normalized.T @ normalized).tocsr()
+    similarity.setdiag(0)
+    similarity.eliminate_zeros()
+    return similarity
+
+
+def top_neighbours(similarity, item_ids, top_k=20, min_score=0.01):
+    """{productId: [(neighbour productId, score), ...]} best first"""
+    neighbours = {}
+    for row in range(similarity.shape[0]):
+        start, end = similarity.indptr[row], similarity.indptr[row + 1]
+        scores, columns = similarity.data[start:end], similarity.indices[start:end]
+        keep = scores >= min_score
+        scores, columns = scores[keep], columns[keep]
+        if not scores.size:
+            continue
+        if scores.size > top_k:
+            best = np.argpartition(scores, -top_k)[-top_k:]
+            scores, columns = scores[best], columns[best]
+        order = np.argsort(-scores, kind="stable")
+        neighbours[str(item_ids[row])] = [(str(item_ids[columns[i]]), round(float(scores[i]), 4)) for i in order]
+    return neighbours
+
+
+def stored_product_ids(table):
+    """The productId of every item in the neighbours table"""
+    product_ids = []
+    kwargs = {"ProjectionExpression": "productId"}
+    while True:
+        response = table.scan(**kwargs)
+        product_ids.extend(item["productId"] for item in response["Items"])
+        if "LastEvaluatedKey" not in response:
+            return product_ids
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def write_neighbours(table, neighbours):
+    """Replace the table's neighbour lists with these, batching the writes.
+
+    Products this build has no list for are deleted, so get_recommendations
+    never serves neighbours from an older build. Returns how many were.
+    """
+    stale = [product_id for product_id in stored_product_ids(table) if product_id not in neighbours]
+    with table.batch_writer() as batch:
+        for product_id, ranked in neighbours.items():
+            batch.put_item(Item={
+                "productId": product_id,
+                "neighbours": [{"productId": neighbour, "score": Decimal(str(score))} for neighbour, score in ranked],
+            })
+        for product_id in stale:
+            batch.delete_item(Key={"productId": product_id})
+    return len(stale)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build item-to-item neighbour lists from interactions")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--table", help="Scan this user-interactions table")
+    source.add_argument("--root", help="Read a local copy of the interaction archive")
+    source.add_argument("--bucket", help="Read the interaction archive bucket")
+    parser.add_argument("--start", type=date.fromisoformat, help="First archive date (YYYY-MM-DD)")
+    parser.add_argument("--end", type=date.fromisoformat, help="Last archive date, inclusive")
+    parser.add_argument("--top-k", type=int, default=20, help="Neighbours kept per product (default: 20)")
+    parser.add_argument("--max-items-per-user", type=int, default=200,
+                        help="Strongest products kept per user (default: 200)")
+    parser.add_argument("--min-score", type=float, default=0.01, help="Smallest similarity kept (default: 0.01)")
+    parser.add_argument("--neighbours-table", help="Write the lists to this DynamoDB table")
+    parser.add_argument("--output", help="Also write the lists to this JSON file")
+    parser.add_argument("--dry-run", action="store_true", help="Build and print a sample without writing")
+    parser.add_argument("--region", default="us-east-1", help="AWS region (default: us-east-1)")
+    args = parser.parse_args()
+
+    import boto3
+    started = time.perf_counter()
+    if args.table:
+        dynamodb = boto3.resource("dynamodb", region_name=args.region)
+        users, items, weights = weights_from_table(dynamodb.Table(args.table))
+    else:
+        if not args.start or not args.end:
+            parser.error("--start and --end are required when reading the archive")
+        from load_interactions import load_interactions
+        s3 = boto3.client("s3", region_name=args.region) if args.bucket else None
+        arrays = load_interactions(args.start, args.end, args.bucket, args.root, s3)
+        users, items, weights = weights_from_archive(arrays)
+    loaded = time.perf_counter()
+
+    matrix, item_ids = interaction_matrix(users, items, weights, args.max_items_per_user)
+    similarity = item_similarity(matrix)
+    neighbours = top_neighbours(similarity, item_ids, args.top_k, args.min_score)
+    built = time.perf_counter()
+
+    print(f"{matrix.shape[0]} users x {matrix.shape[1]} products, {matrix.nnz} pairs "
+          f"(loaded in {loaded - started:.1f}s)")
+    print(f"{similarity.nnz} similar pairs, {len(neighbours)} products with neighbours "
+          f"(built in {built - loaded:.1f}s)")
+
+    if args.dry_run or not (args.neighbours_table or args.output):
+        for product_id, ranked in list(neighbours.items())[:5]:
+            print(f"  {product_id}: {', '.join(f'{n} ({s:.2f})' for n, s in ranked[:5])}")
+        return
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(neighbours, f, separators=(",", ":"))
+        print(f"Wrote {args.output}")
+    if args.neighbours_table and not neighbours:
+        # Most likely an empty source, which should not wipe the table
+        print(f"No neighbour lists built, leaving {args.neighbours_table} unchanged")
+    elif args.neighbours_table:
+        deleted = write_neighbours(boto3.resource("dynamodb", region_name=args.region).Table(args.neighbours_table),
+                                   neighbours)
+        print(f"Wrote {len(neighbours)} items to {args.neighbours_table} and deleted {deleted} stale ones "
+              f"in {time.perf_counter() - built:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
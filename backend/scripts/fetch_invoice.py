@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Fetch a single archived invoice from the invoice bucket.
+
+Invoices stored individually live at invoices/YYYY/MM/DD/<orderId>.txt.
+Invoices archived in bundle mode live inside gzip NDJSON bundles, and the
+order records the bundle, byte offset and length of its gzip member in
+invoiceLocation. With --orders-table this script reads that location and
+fetches the invoice with one ranged GET. Otherwise it checks the per-order
+object, then falls back to the .index.json objects of that day's bundles,
+which also covers bundles archived before orders recorded their location.
+
+Usage:
+    python fetch_invoice.py --bucket <invoice-bucket> --order-id <orderId> --date YYYY-MM-DD \\
+        [--orders-table <orders-table>]
+
+Example:
+    python fetch_invoice.py --bucket aws-ecommerce-dev-invoices-1a2b3c4d --orders-table aws-ecommerce-dev-orders \\
+        --order-id 01JC5Z8Q8M3V2T4X6Y7Z9A0B1C --date 2025-01-31
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambdas", "process_order"))
+
+from invoice_archive import read_bundled_invoice  # noqa: E402
+
+
+def find_invoice(s3, bucket, order_id, date, orders_table=None):
+    """Return the invoice text for an order processed on the given date"""
+    if orders_table is not None:
+        item = orders_table.get_item(Key={'orderId': order_id}, ProjectionExpression='invoiceLocation').get('Item')
+        location = (item or {}).get('invoiceLocation')
+        if location:
+            invoice = read_bundled_invoice(s3, bucket, location['bundle'], int(location['offset']),
+                                           int(location['length']))
+            return invoice['content']
+
+    prefix = f"invoices/{date.replace('-', '/')}/"
+
+    try:
+        response = s3.get_object(Bucket=bucket, Key=f"{prefix}{order_id}.txt")
+        return response['Body'].read().decode('utf-8')
+    except s3.exceptions.NoSuchKey:
+        pass
+
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}bundle-"):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('.index.json'):
+                continue
+            index = json.loads(s3.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read())
+            location = index['invoices'].get(order_id)
+            if location:
+                invoice = read_bundled_invoice(s3, bucket, index['bundle'], location['offset'], location['length'])
+                return invoice['content']
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch one archived invoice")
+    parser.add_argument("--bucket", required=True, help="Name of the invoice bucket")
+    parser.add_argument("--order-id", required=True, help="Order ID of the invoice")
+    parser.add_argument("--date", required=True, help="Date the order was processed (YYYY-MM-DD, UTC)")
+    parser.add_argument("--orders-table", help="Orders table, to read the bundled invoice's location from the order")
+    parser.add_argument("--region", default="us-east-1", help="AWS region (default: us-east-1)")
+    args = parser.parse_args()
+
+    s3 = boto3.client('s3', region_name=args.region)
+    orders_table = None
+    if args.orders_table:
+        orders_table = boto3.resource('dynamodb', region_name=args.region).Table(args.orders_table)
+    content = find_invoice(s3, args.bucket, args.order_id, args.date, orders_table)
+    if content is None:
+        print(f"No invoice found for order {args.order_id} on {args.date}")
+        sys.exit(1)
+    print(content)
+
+
+if __name__ == "__main__":
+    main()
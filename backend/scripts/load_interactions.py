@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Load archived interaction events for a date range into NumPy arrays.
+
+aggregate_events archives every accepted event under
+interactions/date=YYYY-MM-DD/hour=HH/ in the archive bucket, as Parquet
+(when pyarrow is packaged) or gzip NDJSON. This script reads the partitions
+of a date range, from S3 or from a local copy made with `aws s3 sync`, and
+turns them into integer-coded columns for batch jobs:
+
+    arrays = load_interactions(date(2025, 6, 1), date(2025, 6, 7), root="archive/")
+    arrays['user'], arrays['item']      # int32 codes into arrays['users'], arrays['items']
+    arrays['event']                     # int8 codes into EVENT_TYPES
+    arrays['timestamp']                 # int64 epoch seconds
+    to_dataframe(arrays)                # the same as a pandas DataFrame
+
+Usage:
+    python load_interactions.py (--bucket <archive-bucket> | --root <dir>) --start YYYY-MM-DD --end YYYY-MM-DD
+                                [--output events.npz] [--region us-east-1]
+
+Example:
+    aws s3 sync s3://aws-ecommerce-dev-interaction-archive-1a2b3c4d/interactions archive/interactions
+    python load_interactions.py --root archive --start 2025-06-01 --end 2025-06-07 --output week.npz
+"""
+
+import argparse
+import os
+import sys
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambdas", "aggregate_events"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "layers", "common", "python"))
+
+from event_archive import decode_events  # noqa: E402
+from interactions import VALID_EVENT_TYPES as EVENT_TYPES, parse_timestamp  # noqa: E402
+
+
+def days(start, end):
+    """Dates from start to end, inclusive"""
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+def read_files(start, end, bucket=None, root=None, s3=None, prefix="interactions"):
+    """Yield (key, body) of every archive file in the date partitions"""
+    for day in days(start, end):
+        partition = f"{prefix}/date={day.isoformat()}/"
+        if root is not None:
+            directory = os.path.join(root, partition)
+            for dirpath, _, filenames in sorted(os.walk(directory)):
+                for filename in sorted(filenames):
+                    with open(os.path.join(dirpath, filename), 'rb') as f:
+                        yield filename, f.read()
+            continue
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=partition):
+            for obj in page.get('Contents', []):
+                yield obj['Key'], s3.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read()
+
+
+def load_interactions(start, end, bucket=None, root=None, s3=None, prefix="interactions"):
+    """Load the events of start..end (UTC dates, inclusive) as coded arrays"""
+    users, items, events, categories, timestamps = [], [], [], [], []
+    event_codes = {event_type: code for code, event_type in enumerate(EVENT_TYPES)}
+    first = datetime.combine(start, datetime.min.time(), timezone.utc).timestamp()
+    last = datetime.combine(end + timedelta(days=1), datetime.min.time(), timezone.utc).timestamp()
+
+    for key, body in read_files(start, end, bucket, root, s3, prefix):
+        for record in decode_events(body, key):
+            timestamp = parse_timestamp(record['timestamp']).timestamp()
+            if not first <= timestamp < last:
+                continue
+            users.append(record['userId'])
+            items.append(record['productId'])
+            events.append(event_codes[record['eventType']])
+            categories.append(record['category'])
+            timestamps.append(int(timestamp))
+
+    user_ids, user_codes = np.unique(np.array(users, dtype=str), return_inverse=True)
+    item_ids, item_codes = np.unique(np.array(items, dtype=str), return_inverse=True)
+    category_names, category_codes = np.unique(np.array(categories, dtype=str), return_inverse=True)
+    order = np.argsort(np.array(timestamps, dtype=np.int64), kind='stable')
+    return {
+        'user': user_codes.astype(np.int32)[order],
+        'item': item_codes.astype(np.int32)[order],
+        'event': np.array(events, dtype=np.int8)[order],
+        'category': category_codes.astype(np.int32)[order],
+        'timestamp': np.array(timestamps, dtype=np.int64)[order],
+        'users': user_ids,
+        'items': item_ids,
+        'categories': category_names,
+    }
+
+
+def to_dataframe(arrays):
+    """The events as a pandas DataFrame with categorical columns"""
+    import pandas as pd
+
+    return pd.DataFrame({
+        'userId': pd.Categorical.from_codes(arrays['user'], arrays['users']),
+        'productId': pd.Categorical.from_codes(arrays['item'], arrays['items']),
+        'eventType': pd.Categorical.from_codes(arrays['event'], EVENT_TYPES),
+        'category': pd.Categorical.from_codes(arrays['category'], arrays['categories']),
+        'timestamp': pd.to_datetime(arrays['timestamp'], unit='s', utc=True),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load archived interaction events into NumPy arrays")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--bucket", help="Name of the interaction archive bucket")
+    source.add_argument("--root", help="Local directory holding a copy of the archive")
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="First date (YYYY-MM-DD, UTC)")
+    parser.add_argument("--end", required=True, type=date.fromisoformat, help="Last date, inclusive")
+    parser.add_argument("--prefix", default="interactions", help="Key prefix of the archive (default: interactions)")
+    parser.add_argument("--output", help="Save the arrays to this .npz file")
+    parser.add_argument("--region", default="us-east-1", help="AWS region (default: us-east-1)")
+    args = parser.parse_args()
+
+    s3 = None
+    if args.bucket:
+        import boto3
+        s3 = boto3.client('s3', region_name=args.region)
+    arrays = load_interactions(args.start, args.end, args.bucket, args.root, s3, args.prefix)
+
+    print(f"{len(arrays['user'])} events, {len(arrays['users'])} users, {len(arrays['items'])} products")
+    counts = np.bincount(arrays['event'], minlength=len(EVENT_TYPES))
+    for event_type, count in zip(EVENT_TYPES, counts):
+        print(f"  {event_type:<14} {count}")
+
+    if args.output:
+        np.savez_compressed(args.output, **arrays)
+        print(f"Saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
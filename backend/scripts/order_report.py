@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Reconciliation report for recently created orders.
+
+Orders created with time-ordered (ULID) IDs carry an hourly `createdBucket`
+attribute and are indexed by the sparse `createdBucket-index` GSI, with the
+order ID as the range key. Each hour is spread over a few shard keys (see
+order_ids in the common layer). This script walks the hourly buckets covering
+the requested window and range-queries every shard of each one, so the cost
+is proportional to the number of orders in the window rather than the size
+of the table.
+
+Orders created before ULIDs were introduced (uuid4 IDs) are not in the index
+and are not reported.
+
+Usage:
+    python order_report.py --table-name <orders-table> [--hours 1] [--stale-minutes 15]
+
+Example:
+    python order_report.py --table-name aws-ecommerce-dev-orders --hours 24
+"""
+
+import argparse
+import os
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.conditions import Key
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "layers", "common", "python"))
+
+from order_ids import CREATED_INDEX, created_buckets, ulid_bound, ulid_timestamp_ms  # noqa: E402
+
+
+def ulid_timestamp(order_id):
+    """Creation time encoded in the first 10 characters of a ULID"""
+    return datetime.utcfromtimestamp(ulid_timestamp_ms(order_id) / 1000)
+
+
+def hourly_buckets(start, end):
+    """Yield the createdBucket keys covering [start, end], every shard of
+    each hour"""
+    current = start.replace(minute=0, second=0, microsecond=0)
+    while current <= end:
+        yield from created_buckets(current.strftime('%Y-%m-%dT%H'))
+        current += timedelta(hours=1)
+
+
+def to_epoch_ms(moment):
+    return int((moment - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def query_orders(table, start, end):
+    """Range-query every hourly bucket in the window, following pagination"""
+    lower = ulid_bound(to_epoch_ms(start))
+    upper = ulid_bound(to_epoch_ms(end), upper=True)
+
+    for bucket in hourly_buckets(start, end):
+        query_kwargs = {
+            'IndexName': CREATED_INDEX,
+            'KeyConditionExpression': Key('createdBucket').eq(bucket) & Key('orderId').between(lower, upper),
+        }
+        while True:
+            response = table.query(**query_kwargs)
+            for order in response['Items']:
+                yield order
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def build_report(orders, now, stale_minutes):
+    """Summarise orders by status and flag ones stuck in PENDING"""
+    status_counts = Counter()
+    revenue = Decimal('0')
+    stale = []
+    stale_before = now - timedelta(minutes=stale_minutes)
+
+    for order in orders:
+        status = order.get('status', 'UNKNOWN')
+        status_counts[status] += 1
+        if status == 'PROCESSED':
+            revenue += Decimal(str(order.get('total', 0)))
+        if status == 'PENDING' and ulid_timestamp(order['orderId']) < stale_before:
+            stale.append(order)
+
+    return {
+        'total': sum(status_counts.values()),
+        'status_counts': status_counts,
+        'processed_revenue': revenue,
+        'stale_pending': stale,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report on orders created within a recent time window"
+    )
+    parser.add_argument(
+        "--table-name",
+        required=True,
+        help="Name of the DynamoDB orders table"
+    )
+    parser.add_argument(
+        "--region",
+        default="us-east-1",
+        help="AWS region (default: us-east-1)"
+    )
+    parser.add_argument(
+        "--hours",
+        type=float,
+        default=1,
+        help="Size of the reporting window in hours, ending now (default: 1)"
+    )
+    parser.add_argument(
+        "--stale-minutes",
+        type=int,
+        default=15,
+        help="Flag PENDING orders older than this many minutes (default: 15)"
+    )
+
+    args = parser.parse_args()
+
+    table = boto3.resource('dynamodb', region_name=args.region).Table(args.table_name)
+    end = datetime.utcnow()
+    start = end - timedelta(hours=args.hours)
+
+    report = build_report(query_orders(table, start, end), end, args.stale_minutes)
+
+    print(f"\n{'='*60}")
+    print(f"Orders created {start.isoformat()}Z -> {end.isoformat()}Z")
+    print(f"  Total: {report['total']}")
+    for status, count in sorted(report['status_counts'].items()):
+        print(f"  {status}: {count}")
+    print(f"  Processed revenue: ${report['processed_revenue']:.2f}")
+    print(f"  Stale PENDING (> {args.stale_minutes} min): {len(report['stale_pending'])}")
+    for order in report['stale_pending']:
+        print(f"    - {order['orderId']} (user {order.get('userId')}, created {order.get('createdAt')})")
+    print(f"{'='*60}")
+
+
+if __name__ == "__main__":
+    main()
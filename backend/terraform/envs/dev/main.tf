@@ -7,8 +7,11 @@ locals {
   environment          = var.env
   common_tags          = merge({ Project = var.project_name, Environment = var.env, ManagedBy = "terraform" }, var.additional_tags)
   lambda_source_root   = abspath("${path.root}/../../../lambdas")
+  layer_source_root    = abspath("${path.root}/../../../layers")
   static_bucket_name   = "${var.project_name}-${var.env}-frontend-is458-2025-${random_id.bucket_suffix.hex}"
   invoice_bucket_name  = "${var.project_name}-${var.env}-invoices-${random_id.bucket_suffix.hex}"
+  archive_bucket_name  = "${var.project_name}-${var.env}-interaction-archive-${random_id.bucket_suffix.hex}"
+  content_index_key    = "indexes/content-similarity.bin"
   ses_identity_defined = var.ses_sender_email != ""
 }
 
@@ -118,6 +121,51 @@ resource "aws_s3_bucket_lifecycle_configuration" "invoice" {
   }
 }
 
+resource "aws_s3_bucket" "interaction_archive" {
+  bucket        = local.archive_bucket_name
+  force_destroy = false
+
+  tags = merge(local.common_tags, { Purpose = "interaction-archive" })
+}
+
+resource "aws_s3_bucket_public_access_block" "interaction_archive" {
+  bucket = aws_s3_bucket.interaction_archive.id
+
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+resource "aws_s3_bucket_server_side_encryption_configuration" "interaction_archive" {
+  bucket = aws_s3_bucket.interaction_archive.id
+
+  rule {
+    apply_server_side_encryption_by_default {
+      sse_algorithm = "AES256"
+    }
+  }
+}
+
+resource "aws_s3_bucket_lifecycle_configuration" "interaction_archive" {
+  bucket = aws_s3_bucket.interaction_archive.id
+
+  rule {
+    id     = "infrequent-access"
+    status = "Enabled"
+
+    # Training jobs mostly read recent partitions
+    filter {
+      prefix = "interactions/"
+    }
+
+    transition {
+      days          = var.interaction_archive_ia_days
+      storage_class = "STANDARD_IA"
+    }
+  }
+}
+
 module "dynamodb" {
   source = "../../modules/dynamodb"
 
@@ -137,6 +185,15 @@ module "order_queue" {
   tags        = var.additional_tags
 }
 
+module "events_queue" {
+  source = "../../modules/sqs"
+
+  project     = local.project
+  environment = local.environment
+  queue_name  = "interaction-events"
+  tags        = var.additional_tags
+}
+
 module "ses" {
   count  = local.ses_identity_defined ? 1 : 0
   source = "../../modules/ses"
@@ -151,6 +208,24 @@ locals {
   ses_sender_email = var.ses_sender_email
   dynamodb_arns    = module.dynamodb.table_arns
   dynamodb_names   = module.dynamodb.table_names
+  # No delivery outlives the function, so this is also how long a claimed
+  # order is held before another delivery may take it over
+  process_order_timeout = 30
+}
+
+# Modules shared by every function (EMF metrics), importable from /opt/python
+data "archive_file" "common_layer" {
+  type        = "zip"
+  source_dir  = "${local.layer_source_root}/common"
+  output_path = "${path.module}/tmp/common-layer.zip"
+}
+
+resource "aws_lambda_layer_version" "common" {
+  layer_name          = "${local.project}-${local.environment}-common"
+  description         = "Shared Python modules for the CloudShop functions."
+  filename            = data.archive_file.common_layer.output_path
+  source_code_hash    = data.archive_file.common_layer.output_base64sha256
+  compatible_runtimes = ["python3.12"]
 }
 
 module "lambda_get_products" {
@@ -161,6 +236,7 @@ module "lambda_get_products" {
   function_name = "get-products"
   description   = "Return catalog products for the store frontend."
   source_dir    = "${local.lambda_source_root}/get_products"
+  layers        = [aws_lambda_layer_version.common.arn]
 
   environment_variables = {
     PRODUCTS_TABLE = local.dynamodb_names["products"]
@@ -186,6 +262,7 @@ module "lambda_manage_cart" {
   function_name = "manage-cart"
   description   = "Create or update a user's shopping cart."
   source_dir    = "${local.lambda_source_root}/manage_cart"
+  layers        = [aws_lambda_layer_version.common.arn]
 
   environment_variables = {
     CARTS_TABLE    = local.dynamodb_names["carts"]
@@ -214,6 +291,7 @@ module "lambda_create_order" {
   function_name = "create-order"
   description   = "Persist new orders and enqueue them for processing."
   source_dir    = "${local.lambda_source_root}/create_order"
+  layers        = [aws_lambda_layer_version.common.arn]
 
   environment_variables = {
     ORDERS_TABLE     = local.dynamodb_names["orders"]
@@ -259,13 +337,22 @@ module "lambda_process_order" {
   function_name = "process-order"
   description   = "Process queued orders, send confirmation emails, and archive invoices."
   source_dir    = "${local.lambda_source_root}/process_order"
+  timeout       = local.process_order_timeout
+  layers        = [aws_lambda_layer_version.common.arn]
 
   environment_variables = {
-    ORDERS_TABLE     = local.dynamodb_names["orders"]
-    CARTS_TABLE      = local.dynamodb_names["carts"]
-    ORDER_QUEUE_ARN  = module.order_queue.queue_arn
-    INVOICE_BUCKET   = aws_s3_bucket.invoice.bucket
-    SES_SENDER_EMAIL = local.ses_sender_email
+    ORDERS_TABLE              = local.dynamodb_names["orders"]
+    CARTS_TABLE               = local.dynamodb_names["carts"]
+    ORDER_QUEUE_ARN           = module.order_queue.queue_arn
+    INVOICE_BUCKET            = aws_s3_bucket.invoice.bucket
+    SES_SENDER_EMAIL          = local.ses_sender_email
+    ORDER_CONCURRENCY         = tostring(var.order_processing_concurrency)
+    EMAIL_SEND_MODE           = var.order_email_send_mode
+    INVOICE_ARCHIVE_MODE      = var.invoice_archive_mode
+    RETRY_QUEUE_URL           = module.order_queue.queue_url
+    CIRCUIT_FAILURE_THRESHOLD = tostring(var.order_circuit_failure_threshold)
+    CIRCUIT_RESET_SECONDS     = tostring(var.order_circuit_reset_seconds)
+    ORDER_CLAIM_LEASE_SECONDS = tostring(local.process_order_timeout)
   }
 
   policy_statements = [
@@ -281,7 +368,7 @@ module "lambda_process_order" {
     },
     {
       sid       = "ManageQueue"
-      actions   = ["sqs:DeleteMessage", "sqs:GetQueueAttributes", "sqs:ReceiveMessage"]
+      actions   = ["sqs:DeleteMessage", "sqs:GetQueueAttributes", "sqs:ReceiveMessage", "sqs:SendMessage"]
       resources = [module.order_queue.queue_arn]
     },
     {
@@ -291,7 +378,12 @@ module "lambda_process_order" {
     },
     {
       sid       = "SendEmails"
-      actions   = ["ses:SendEmail", "ses:SendRawEmail"]
+      actions   = ["ses:SendEmail", "ses:SendRawEmail", "ses:SendBulkTemplatedEmail"]
+      resources = ["*"]
+    },
+    {
+      sid       = "ManageEmailTemplates"
+      actions   = ["ses:CreateTemplate", "ses:UpdateTemplate"]
       resources = ["*"]
     },
     {
@@ -310,16 +402,66 @@ module "lambda_track_event" {
   function_name = "track-event"
   description   = "Capture product interaction events."
   source_dir    = "${local.lambda_source_root}/track_event"
+  layers        = [aws_lambda_layer_version.common.arn]
 
   environment_variables = {
-    INTERACTIONS_TABLE = local.dynamodb_names["interactions"]
+    INTERACTIONS_TABLE         = local.dynamodb_names["interactions"]
+    EVENT_INGEST_MODE          = var.event_ingest_mode
+    EVENTS_QUEUE_URL           = module.events_queue.queue_url
+    AFFINITY_HALF_LIFE_DAYS    = tostring(var.affinity_half_life_days)
+    DEBOUNCE_WINDOW_SECONDS    = tostring(var.event_debounce_window_seconds)
+    ARCHIVE_EVENTS             = tostring(var.archive_interaction_events)
+    RECOMMENDATION_STATE_TABLE = local.dynamodb_names["recommendation_state"]
   }
 
   policy_statements = [
     {
       sid       = "WriteInteractions"
-      actions   = ["dynamodb:PutItem"]
-      resources = [local.dynamodb_arns["interactions"]]
+      actions   = ["dynamodb:UpdateItem"]
+      resources = [local.dynamodb_arns["interactions"], local.dynamodb_arns["recommendation_state"]]
+    },
+    {
+      sid       = "EnqueueEvents"
+      actions   = ["sqs:SendMessage"]
+      resources = [module.events_queue.queue_arn]
+    }
+  ]
+}
+
+module "lambda_aggregate_events" {
+  source = "../../modules/lambda_function"
+
+  project       = local.project
+  environment   = local.environment
+  function_name = "aggregate-events"
+  description   = "Aggregate queued interaction events and write them in batches."
+  source_dir    = "${local.lambda_source_root}/aggregate_events"
+  layers        = [aws_lambda_layer_version.common.arn]
+
+  environment_variables = {
+    INTERACTIONS_TABLE         = local.dynamodb_names["interactions"]
+    AFFINITY_HALF_LIFE_DAYS    = tostring(var.affinity_half_life_days)
+    DEBOUNCE_WINDOW_SECONDS    = tostring(var.event_debounce_window_seconds)
+    ARCHIVE_BUCKET             = var.archive_interaction_events ? aws_s3_bucket.interaction_archive.bucket : ""
+    RECOMMENDATION_STATE_TABLE = local.dynamodb_names["recommendation_state"]
+    EVENTS_QUEUE_URL           = module.events_queue.queue_url
+  }
+
+  policy_statements = [
+    {
+      sid       = "WriteInteractions"
+      actions   = ["dynamodb:UpdateItem"]
+      resources = [local.dynamodb_arns["interactions"], local.dynamodb_arns["recommendation_state"]]
+    },
+    {
+      sid       = "ConsumeEvents"
+      actions   = ["sqs:DeleteMessage", "sqs:GetQueueAttributes", "sqs:ReceiveMessage", "sqs:SendMessage"]
+      resources = [module.events_queue.queue_arn]
+    },
+    {
+      sid       = "ArchiveEvents"
+      actions   = ["s3:PutObject"]
+      resources = ["${aws_s3_bucket.interaction_archive.arn}/*"]
     }
   ]
 }
@@ -332,11 +474,21 @@ module "lambda_get_recommendations" {
   function_name = "get-recommendations"
   description   = "Return product recommendations based on user interaction history."
   source_dir    = "${local.lambda_source_root}/get_recommendations"
+  layers        = [aws_lambda_layer_version.common.arn]
 
   environment_variables = {
-    INTERACTIONS_TABLE = local.dynamodb_names["interactions"]
-    PRODUCTS_TABLE     = local.dynamodb_names["products"]
-    PRODUCT_TYPE_GSI   = "category-index"
+    INTERACTIONS_TABLE               = local.dynamodb_names["interactions"]
+    RECENT_INTERACTIONS_INDEX        = "userId-timestamp-index"
+    PRODUCTS_TABLE                   = local.dynamodb_names["products"]
+    PRODUCT_TYPE_GSI                 = "category-index"
+    AFFINITY_HALF_LIFE_DAYS          = tostring(var.affinity_half_life_days)
+    NEIGHBOURS_TABLE                 = local.dynamodb_names["item_neighbours"]
+    RECOMMENDATION_STATE_TABLE       = var.cache_recommendations ? local.dynamodb_names["recommendation_state"] : ""
+    RECOMMENDATION_CACHE_TTL_SECONDS = tostring(var.recommendation_cache_ttl_seconds)
+    LEADERBOARDS_TABLE               = local.dynamodb_names["leaderboards"]
+    CONTENT_INDEX_BUCKET             = var.content_similarity_weight > 0 ? aws_s3_bucket.interaction_archive.bucket : ""
+    CONTENT_INDEX_KEY                = local.content_index_key
+    CONTENT_SIMILARITY_WEIGHT        = tostring(var.content_similarity_weight)
   }
 
   policy_statements = [
@@ -350,11 +502,79 @@ module "lambda_get_recommendations" {
     },
     {
       sid     = "ReadProducts"
-      actions = ["dynamodb:Query", "dynamodb:Scan", "dynamodb:GetItem"]
+      actions = ["dynamodb:Query", "dynamodb:Scan", "dynamodb:GetItem", "dynamodb:BatchGetItem"]
       resources = [
         local.dynamodb_arns["products"],
         "${local.dynamodb_arns["products"]}/index/*"
       ]
+    },
+    {
+      sid       = "ReadNeighbours"
+      actions   = ["dynamodb:BatchGetItem"]
+      resources = [local.dynamodb_arns["item_neighbours"]]
+    },
+    {
+      sid       = "CacheRecommendations"
+      actions   = ["dynamodb:GetItem", "dynamodb:UpdateItem"]
+      resources = [local.dynamodb_arns["recommendation_state"]]
+    },
+    {
+      sid       = "ReadLeaderboards"
+      actions   = ["dynamodb:GetItem"]
+      resources = [local.dynamodb_arns["leaderboards"]]
+    },
+    {
+      sid       = "ReadContentIndex"
+      actions   = ["s3:GetObject"]
+      resources = ["${aws_s3_bucket.interaction_archive.arn}/${local.content_index_key}"]
+    }
+  ]
+}
+
+module "lambda_build_leaderboards" {
+  source = "../../modules/lambda_function"
+
+  project       = local.project
+  environment   = local.environment
+  function_name = "build-leaderboards"
+  description   = "Rebuild the popularity leaderboards from interactions and processed orders."
+  source_dir    = "${local.lambda_source_root}/build_leaderboards"
+  layers        = [aws_lambda_layer_version.common.arn]
+  timeout       = 300
+  memory_size   = 512
+
+  environment_variables = {
+    INTERACTIONS_TABLE          = local.dynamodb_names["interactions"]
+    ORDERS_TABLE                = local.dynamodb_names["orders"]
+    PRODUCTS_TABLE              = local.dynamodb_names["products"]
+    LEADERBOARDS_TABLE          = local.dynamodb_names["leaderboards"]
+    LEADERBOARD_WINDOWS         = var.leaderboard_windows
+    INTERACTIONS_ACTIVITY_INDEX = "activeBucket-index"
+  }
+
+  policy_statements = [
+    {
+      sid       = "QueryInteractions"
+      actions   = ["dynamodb:Query"]
+      resources = ["${local.dynamodb_arns["interactions"]}/index/activeBucket-index"]
+    },
+    {
+      sid     = "ReadOrders"
+      actions = ["dynamodb:Query", "dynamodb:BatchGetItem"]
+      resources = [
+        local.dynamodb_arns["orders"],
+        "${local.dynamodb_arns["orders"]}/index/createdBucket-index"
+      ]
+    },
+    {
+      sid       = "ScanProducts"
+      actions   = ["dynamodb:Scan"]
+      resources = [local.dynamodb_arns["products"]]
+    },
+    {
+      sid       = "WriteLeaderboards"
+      actions   = ["dynamodb:PutItem"]
+      resources = [local.dynamodb_arns["leaderboards"]]
     }
   ]
 }
@@ -419,5 +639,41 @@ resource "aws_lambda_event_source_mapping" "process_order_queue" {
   event_source_arn = module.order_queue.queue_arn
   function_name    = module.lambda_process_order.function_arn
   enabled          = true
-  batch_size       = 1
+  batch_size       = var.order_queue_batch_size
+
+  # Wait briefly to fill larger batches, and let the handler report the
+  # individual messages that failed instead of retrying the whole batch.
+  maximum_batching_window_in_seconds = var.order_queue_batching_window_seconds
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+
+resource "aws_lambda_event_source_mapping" "aggregate_events_queue" {
+  event_source_arn = module.events_queue.queue_arn
+  function_name    = module.lambda_aggregate_events.function_arn
+  enabled          = true
+  batch_size       = var.events_queue_batch_size
+
+  # A longer window gathers more events per invocation, so repeated events
+  # for the same user and product collapse into a single write.
+  maximum_batching_window_in_seconds = var.events_queue_batching_window_seconds
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+
+resource "aws_cloudwatch_event_rule" "build_leaderboards" {
+  name                = "${local.project}-${local.environment}-build-leaderboards"
+  description         = "Rebuild the popularity leaderboards."
+  schedule_expression = var.leaderboard_schedule
+}
+
+resource "aws_cloudwatch_event_target" "build_leaderboards" {
+  rule = aws_cloudwatch_event_rule.build_leaderboards.name
+  arn  = module.lambda_build_leaderboards.function_arn
+}
+
+resource "aws_lambda_permission" "build_leaderboards_schedule" {
+  statement_id  = "AllowLeaderboardSchedule"
+  action        = "lambda:InvokeFunction"
+  function_name = module.lambda_build_leaderboards.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.build_leaderboards.arn
 }
@@ -13,6 +13,11 @@ output "invoice_bucket" {
   value       = aws_s3_bucket.invoice.bucket
 }
 
+output "interaction_archive_bucket" {
+  description = "Name of the bucket archiving interaction events."
+  value       = aws_s3_bucket.interaction_archive.bucket
+}
+
 output "api_endpoint" {
   description = "Base invoke URL for the HTTP API."
   value       = module.http_api.api_endpoint
@@ -23,6 +28,11 @@ output "order_queue_url" {
   value       = module.order_queue.queue_url
 }
 
+output "events_queue_url" {
+  description = "URL of the interaction events queue."
+  value       = module.events_queue.queue_url
+}
+
 output "dynamodb_tables" {
   description = "Map of logical table keys to names."
   value       = module.dynamodb.table_names
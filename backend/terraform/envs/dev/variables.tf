@@ -32,6 +32,149 @@ variable "invoice_bucket_lifecycle_days" {
   default     = 30
 }
 
+variable "order_queue_batch_size" {
+  description = "Maximum number of order messages delivered to process-order per invocation."
+  type        = number
+  default     = 10
+}
+
+variable "order_queue_batching_window_seconds" {
+  description = "Maximum time to wait while gathering a batch of order messages."
+  type        = number
+  default     = 1
+}
+
+variable "order_processing_concurrency" {
+  description = "Number of order messages process-order handles in parallel within a batch."
+  type        = number
+  default     = 5
+}
+
+variable "order_email_send_mode" {
+  description = "How process-order sends confirmation emails: \"single\" (one SendEmail per order) or \"bulk\" (one SendBulkTemplatedEmail per batch)."
+  type        = string
+  default     = "single"
+  validation {
+    condition     = contains(["single", "bulk"], var.order_email_send_mode)
+    error_message = "Email send mode must be single or bulk."
+  }
+}
+
+variable "invoice_archive_mode" {
+  description = "How process-order stores invoices: \"object\" (one S3 object per order) or \"bundle\" (one gzip NDJSON bundle plus index per batch)."
+  type        = string
+  default     = "object"
+  validation {
+    condition     = contains(["object", "bundle"], var.invoice_archive_mode)
+    error_message = "Invoice archive mode must be object or bundle."
+  }
+}
+
+variable "order_circuit_failure_threshold" {
+  description = "Consecutive transient failures of SES, S3 or DynamoDB after which process-order stops calling it and defers the affected stages."
+  type        = number
+  default     = 5
+}
+
+variable "order_circuit_reset_seconds" {
+  description = "Seconds an open circuit waits before process-order lets a trial call through."
+  type        = number
+  default     = 30
+}
+
+variable "event_ingest_mode" {
+  description = "How track-event stores interactions: \"direct\" (written before responding) or \"queue\" (sent to the events queue and written in aggregated batches by aggregate-events)."
+  type        = string
+  default     = "direct"
+  validation {
+    condition     = contains(["direct", "queue"], var.event_ingest_mode)
+    error_message = "Event ingest mode must be direct or queue."
+  }
+}
+
+variable "events_queue_batch_size" {
+  description = "Maximum number of event messages delivered to aggregate-events per invocation."
+  type        = number
+  default     = 100
+}
+
+variable "events_queue_batching_window_seconds" {
+  description = "Maximum time to wait while gathering a batch of event messages."
+  type        = number
+  default     = 5
+}
+
+variable "affinity_half_life_days" {
+  description = "Half-life of the decayed affinity score kept on interaction records. Writers and readers must agree, so changing it skews scores already stored."
+  type        = number
+  default     = 14
+
+  validation {
+    condition     = var.affinity_half_life_days >= 1 && var.affinity_half_life_days <= 365
+    error_message = "Affinity half-life must be between 1 and 365 days."
+  }
+}
+
+variable "event_debounce_window_seconds" {
+  description = "Repeat product-view events for the same user and product inside this many seconds are dropped instead of written (0 disables)."
+  type        = number
+  default     = 30
+}
+
+variable "archive_interaction_events" {
+  description = "Archive every accepted interaction event to the interaction archive bucket (hourly partitions, gzip NDJSON or Parquet) for offline analytics."
+  type        = bool
+  default     = true
+}
+
+variable "interaction_archive_ia_days" {
+  description = "Days after which archived interaction files move to S3 Standard-IA."
+  type        = number
+  default     = 30
+}
+
+variable "cache_recommendations" {
+  description = "Cache each user's recommendation list in the recommendation state table until their interactions change."
+  type        = bool
+  default     = true
+}
+
+variable "recommendation_cache_ttl_seconds" {
+  description = "Longest a cached recommendation list is served, even if the user's interactions have not changed."
+  type        = number
+  default     = 3600
+  validation {
+    condition     = var.recommendation_cache_ttl_seconds > 0
+    error_message = "recommendation_cache_ttl_seconds must be positive."
+  }
+}
+
+variable "leaderboard_schedule" {
+  description = "EventBridge schedule on which the popularity leaderboards are rebuilt."
+  type        = string
+  default     = "rate(15 minutes)"
+}
+
+variable "leaderboard_windows" {
+  description = "Comma-separated sliding windows of the popularity leaderboards, in hours (h) or days (d)."
+  type        = string
+  default     = "1d,7d,30d"
+  validation {
+    condition     = can(regex("^[0-9]+[hd](,[0-9]+[hd])*$", var.leaderboard_windows))
+    error_message = "Leaderboard windows must look like 12h,7d,30d."
+  }
+}
+
+variable "content_similarity_weight" {
+  description = "Weight of the content similarity index against the interaction neighbour lists in recommendations; 0 disables it."
+  type        = number
+  default     = 0.5
+  validation {
+    condition     = var.content_similarity_weight >= 0
+    error_message = "Content similarity weight must not be negative."
+  }
+}
+
 variable "additional_tags" {
   description = "Additional tags to merge into all resources."
   type        = map(string)
@@ -43,6 +43,10 @@ locals {
         {
           name = "userId"
           type = "S"
+        },
+        {
+          name = "createdBucket"
+          type = "S"
         }
       ]
       global_secondary_indexes = [
@@ -50,6 +54,16 @@ locals {
           name            = "userId-index"
           hash_key        = "userId"
           projection_type = "ALL"
+        },
+        {
+          # Sparse index: only ULID-keyed orders carry createdBucket, so the
+          # range key sorts them by creation time within each hourly bucket.
+          # Each hour is sharded over several bucket keys (see order_ids).
+          name               = "createdBucket-index"
+          hash_key           = "createdBucket"
+          range_key          = "orderId"
+          projection_type    = "INCLUDE"
+          non_key_attributes = ["userId", "status", "total", "createdAt"]
         }
       ]
     }
@@ -69,6 +83,14 @@ locals {
         {
           name = "category"
           type = "S"
+        },
+        {
+          name = "timestamp"
+          type = "S"
+        },
+        {
+          name = "activeBucket"
+          type = "S"
         }
       ]
       global_secondary_indexes = [
@@ -76,9 +98,82 @@ locals {
           name            = "category-index"
           hash_key        = "category"
           projection_type = "ALL"
+        },
+        {
+          # A user's interactions newest first (ISO 8601 UTC timestamps sort
+          # chronologically), with just what get_recommendations scores.
+          # A GSI rather than an LSI, which could only be added by
+          # recreating the table.
+          name               = "userId-timestamp-index"
+          hash_key           = "userId"
+          range_key          = "timestamp"
+          projection_type    = "INCLUDE"
+          non_key_attributes = ["eventType", "category", "affinity", "affinityEra"]
+        },
+        {
+          # Each record under the hour of its latest event, so
+          # build_leaderboards reads only the records active in its windows
+          # instead of scanning the table.
+          name               = "activeBucket-index"
+          hash_key           = "activeBucket"
+          projection_type    = "INCLUDE"
+          non_key_attributes = ["eventType", "timestamp", "viewCount", "cartCount", "purchaseCount"]
         }
       ]
     }
+    item_neighbours = {
+      # Top-K similar products per product, rebuilt offline by
+      # scripts/build_item_neighbours.py
+      name     = "${var.project}-${var.environment}-item-neighbours"
+      hash_key = "productId"
+      attributes = [
+        {
+          name = "productId"
+          type = "S"
+        }
+      ]
+      global_secondary_indexes = []
+    }
+    batch_recommendations = {
+      # Top-K lists for every user, written offline by
+      # scripts/batch_recommendations.py and expiring through TTL
+      name          = "${var.project}-${var.environment}-batch-recommendations"
+      hash_key      = "userId"
+      ttl_attribute = "expiresAt"
+      attributes = [
+        {
+          name = "userId"
+          type = "S"
+        }
+      ]
+      global_secondary_indexes = []
+    }
+    leaderboards = {
+      # One item, rebuilt on a schedule by build_leaderboards
+      name     = "${var.project}-${var.environment}-leaderboards"
+      hash_key = "name"
+      attributes = [
+        {
+          name = "name"
+          type = "S"
+        }
+      ]
+      global_secondary_indexes = []
+    }
+    recommendation_state = {
+      # Per-user interaction version and cached recommendation list; the
+      # cache expires through TTL on expiresAt
+      name          = "${var.project}-${var.environment}-recommendation-state"
+      hash_key      = "userId"
+      ttl_attribute = "expiresAt"
+      attributes = [
+        {
+          name = "userId"
+          type = "S"
+        }
+      ]
+      global_secondary_indexes = []
+    }
   }
 }
 
@@ -107,6 +202,15 @@ resource "aws_dynamodb_table" "this" {
       write_capacity     = var.billing_mode == "PROVISIONED" ? var.provisioned_write_capacity : null
       read_capacity      = var.billing_mode == "PROVISIONED" ? var.provisioned_read_capacity : null
       range_key          = try(global_secondary_index.value.range_key, null)
+      non_key_attributes = try(global_secondary_index.value.non_key_attributes, null)
+    }
+  }
+
+  dynamic "ttl" {
+    for_each = try(each.value.ttl_attribute, null) == null ? [] : [each.value.ttl_attribute]
+    content {
+      attribute_name = ttl.value
+      enabled        = true
     }
   }
 
@@ -0,0 +1,616 @@
+"""
+In-memory stand-ins for the AWS services used by the Lambda handlers,
+so handler logic can be exercised locally without an AWS account
+"""
+
+import html
+import importlib.util
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(__file__), "..", "lambdas")
+SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), "..", "scripts")
+COMMON_LAYER_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "layers", "common", "python"))
+
+# Layer modules are importable in Lambda from /opt/python
+if COMMON_LAYER_DIR not in sys.path:
+    sys.path.append(COMMON_LAYER_DIR)
+
+
+def load_lambda(name):
+    """Import lambdas/<name>/app.py under a unique module name, with its
+    directory on sys.path so sibling modules resolve as they do in Lambda"""
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    lambda_dir = os.path.abspath(os.path.join(LAMBDAS_DIR, name))
+    if lambda_dir not in sys.path:
+        sys.path.insert(0, lambda_dir)
+    path = os.path.join(lambda_dir, "app.py")
+    spec = importlib.util.spec_from_file_location(f"{name}_app", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_script(name):
+    """Import scripts/<name>.py as a module"""
+    path = os.path.join(SCRIPTS_DIR, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def sqs_record(body, message_id=None):
+    """Build an SQS event record the way Lambda delivers it"""
+    return {
+        "messageId": message_id or str(uuid.uuid4()),
+        "receiptHandle": str(uuid.uuid4()),
+        "body": json.dumps(body),
+    }
+
+
+def conditional_check_failed(item=None):
+    """The ClientError boto3 raises when a ConditionExpression is not met"""
+    from boto3.dynamodb.types import TypeSerializer
+    from botocore.exceptions import ClientError
+    response = {"Error": {"Code": "ConditionalCheckFailedException",
+                          "Message": "The conditional request failed"}}
+    if item is not None:
+        serializer = TypeSerializer()
+        response["Item"] = {key: serializer.serialize(value) for key, value in item.items()}
+    return ClientError(response, "UpdateItem")
+
+
+def throttling_error(operation):
+    """The ClientError a throttled AWS call raises once botocore gives up"""
+    from botocore.exceptions import ClientError
+    return ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"},
+                        "ResponseMetadata": {"HTTPStatusCode": 400}}, operation)
+
+
+class ExpressionEvaluator:
+    """Evaluates the subset of DynamoDB expression syntax used by the handlers.
+
+    Update expressions: SET (with if_not_exists, + and -), ADD, REMOVE and
+    DELETE. Conditions: comparisons, BETWEEN, AND/OR/NOT, parentheses,
+    attribute_exists, attribute_not_exists, contains and begins_with.
+    """
+
+    TOKEN = re.compile(r"\s*(<>|<=|>=|[=<>(),+\-]|[#:]?[A-Za-z_][\w\-]*)")
+
+    def __init__(self, names, values):
+        self.names = names or {}
+        self.values = values or {}
+
+    def _tokenize(self, expression):
+        tokens, position = [], 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = self.TOKEN.match(expression, position)
+            if not match:
+                raise ValueError(f"Cannot parse expression at: {expression[position:]}")
+            tokens.append(match.group(1))
+            position = match.end()
+        return tokens
+
+    def _name(self, token):
+        return self.names.get(token, token)
+
+    # Conditions
+
+    def check(self, expression, item):
+        self.tokens, self.position = self._tokenize(expression), 0
+        result = self._or(item)
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected token {self.tokens[self.position]}")
+        return result
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _expect(self, expected):
+        token = self._next()
+        if token != expected:
+            raise ValueError(f"Expected {expected}, got {token}")
+
+    def _or(self, item):
+        result = self._and(item)
+        while self._peek() == "OR":
+            self._next()
+            right = self._and(item)
+            result = result or right
+        return result
+
+    def _and(self, item):
+        result = self._not(item)
+        while self._peek() == "AND":
+            self._next()
+            right = self._not(item)
+            result = result and right
+        return result
+
+    def _not(self, item):
+        if self._peek() == "NOT":
+            self._next()
+            return not self._not(item)
+        return self._primary(item)
+
+    def _primary(self, item):
+        token = self._peek()
+        if token == "(":
+            self._next()
+            result = self._or(item)
+            self._expect(")")
+            return result
+        if token in ("attribute_exists", "attribute_not_exists", "contains", "begins_with"):
+            self._next()
+            self._expect("(")
+            path = self._name(self._next())
+            argument = None
+            if self._peek() == ",":
+                self._next()
+                argument = self._operand(item)
+            self._expect(")")
+            if token == "attribute_exists":
+                return path in item
+            if token == "attribute_not_exists":
+                return path not in item
+            if path not in item:
+                return False
+            if token == "contains":
+                return argument in item[path]
+            return str(item[path]).startswith(argument)
+        left = self._operand(item)
+        operator = self._next()
+        if operator == "BETWEEN":
+            low = self._operand(item)
+            self._expect("AND")
+            high = self._operand(item)
+            return left is not None and low <= left <= high
+        right = self._operand(item)
+        if left is None or right is None:
+            return operator == "<>" and left != right
+        return {
+            "=": left == right, "<>": left != right, "<": left < right,
+            "<=": left <= right, ">": left > right, ">=": left >= right,
+        }[operator]
+
+    def _operand(self, item):
+        token = self._next()
+        if token.startswith(":"):
+            return self.values[token]
+        return item.get(self._name(token))
+
+    # Updates
+
+    def apply(self, expression, item):
+        tokens = self._tokenize(expression)
+        clauses, current = [], None
+        for token in tokens:
+            if token in ("SET", "ADD", "REMOVE", "DELETE"):
+                current = (token, [])
+                clauses.append(current)
+            else:
+                current[1].append(token)
+        for action, clause_tokens in clauses:
+            for part in self._split_commas(clause_tokens):
+                getattr(self, f"_{action.lower()}")(part, item)
+
+    def _split_commas(self, tokens):
+        parts, current, depth = [], [], 0
+        for token in tokens:
+            if token == "," and depth == 0:
+                parts.append(current)
+                current = []
+                continue
+            depth += token == "("
+            depth -= token == ")"
+            current.append(token)
+        parts.append(current)
+        return parts
+
+    def _set(self, tokens, item):
+        path = self._name(tokens[0])
+        assert tokens[1] == "="
+        self.tokens, self.position = tokens[2:], 0
+        value = self._value(item)
+        while self._peek() in ("+", "-"):
+            operator = self._next()
+            other = self._value(item)
+            value = value + other if operator == "+" else value - other
+        item[path] = value
+
+    def _value(self, item):
+        token = self._next()
+        if token == "if_not_exists":
+            self._expect("(")
+            path = self._name(self._next())
+            self._expect(",")
+            default = self._value(item)
+            self._expect(")")
+            return item.get(path, default)
+        if token.startswith(":"):
+            return self.values[token]
+        return item[self._name(token)]
+
+    def _add(self, tokens, item):
+        path, value = self._name(tokens[0]), self.values[tokens[1]]
+        if isinstance(value, set):
+            item[path] = set(item.get(path, set())) | value
+        else:
+            item[path] = item.get(path, 0) + value
+
+    def _remove(self, tokens, item):
+        item.pop(self._name(tokens[0]), None)
+
+    def _delete(self, tokens, item):
+        path, value = self._name(tokens[0]), self.values[tokens[1]]
+        remaining = set(item.get(path, set())) - value
+        if remaining:
+            item[path] = remaining
+        else:
+            item.pop(path, None)
+
+
+class FakeBatchWriter:
+    """The context manager returned by Table.batch_writer, writing at once"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+
+class FakeTable:
+    """Dictionary-backed DynamoDB table supporting the calls the handlers make.
+
+    indexes maps index names to their sort key (or None) for query; key
+    conditions are evaluated per item, so any index hash key works.
+    """
+
+    def __init__(self, name, key_names, indexes=None):
+        self.name = name
+        self.key_names = key_names
+        self.indexes = indexes or {}
+        self.items = {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        return tuple(key[name] for name in self.key_names)
+
+    def _check(self, item, kwargs):
+        condition = kwargs.get("ConditionExpression")
+        if condition is None:
+            return
+        evaluator = ExpressionEvaluator(kwargs.get("ExpressionAttributeNames"),
+                                        kwargs.get("ExpressionAttributeValues"))
+        if not evaluator.check(condition, item or {}):
+            returned = item if kwargs.get("ReturnValuesOnConditionCheckFailure") == "ALL_OLD" else None
+            raise conditional_check_failed(returned)
+
+    def put_item(self, Item, **kwargs):
+        with self._lock:
+            self.calls.append(("put_item", Item))
+            self._check(self.items.get(self._key(Item)), kwargs)
+            self.items[self._key(Item)] = dict(Item)
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        with self._lock:
+            self.calls.append(("delete_item", Key))
+            self.items.pop(self._key(Key), None)
+        return {}
+
+    def batch_writer(self):
+        return FakeBatchWriter(self)
+
+    def get_item(self, Key, **kwargs):
+        with self._lock:
+            self.calls.append(("get_item", Key))
+            item = self.items.get(self._key(Key))
+        return {"Item": dict(item)} if item is not None else {}
+
+    def query(self, KeyConditionExpression, IndexName=None, ScanIndexForward=True, Limit=None, **kwargs):
+        with self._lock:
+            self.calls.append(("query", IndexName, KeyConditionExpression))
+            evaluator = ExpressionEvaluator(kwargs.get("ExpressionAttributeNames"),
+                                            kwargs.get("ExpressionAttributeValues"))
+            matches = [dict(item) for item in self.items.values() if evaluator.check(KeyConditionExpression, item)]
+        sort_key = self.indexes.get(IndexName) if IndexName else (self.key_names[1:] or [None])[0]
+        if sort_key:
+            matches = [item for item in matches if sort_key in item]
+            matches.sort(key=lambda item: item[sort_key], reverse=not ScanIndexForward)
+        if Limit is not None and len(matches) > Limit:
+            last = matches[Limit - 1]
+            return {"Items": matches[:Limit], "Count": Limit,
+                    "LastEvaluatedKey": {name: last[name] for name in self.key_names}}
+        return {"Items": matches, "Count": len(matches)}
+
+    def scan(self, Segment=0, TotalSegments=1, **kwargs):
+        with self._lock:
+            self.calls.append(("scan",))
+            items = list(self.items.values())[Segment::TotalSegments]
+            return {"Items": [dict(item) for item in items]}
+
+    def update_item(self, Key, UpdateExpression, **kwargs):
+        with self._lock:
+            self.calls.append(("update_item", Key, UpdateExpression))
+            existing = self.items.get(self._key(Key))
+            self._check(existing, kwargs)
+            item = dict(existing) if existing is not None else dict(Key)
+            evaluator = ExpressionEvaluator(kwargs.get("ExpressionAttributeNames"),
+                                            kwargs.get("ExpressionAttributeValues"))
+            evaluator.apply(UpdateExpression, item)
+            self.items[self._key(Key)] = item
+        return {"Attributes": dict(item)}
+
+
+class FakeDynamoDBClient:
+    """Stand-in for the resource's meta.client: typed values in and out,
+    delegating to the tables, so patches of a table's calls still apply"""
+
+    def __init__(self, resource):
+        from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+        self.resource = resource
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+    def _deserialize(self, values):
+        return {key: self._deserializer.deserialize(value) for key, value in values.items()}
+
+    def update_item(self, TableName, Key, ExpressionAttributeValues=None, **kwargs):
+        if ExpressionAttributeValues is not None:
+            kwargs["ExpressionAttributeValues"] = self._deserialize(ExpressionAttributeValues)
+        response = self.resource.tables[TableName].update_item(Key=self._deserialize(Key), **kwargs)
+        if "Attributes" in response:
+            response = dict(response, Attributes={key: self._serializer.serialize(value)
+                                                  for key, value in response["Attributes"].items()})
+        return response
+
+
+class FakeDynamoDB:
+    """Stand-in for boto3.resource('dynamodb').
+
+    batch_write_item leaves the first `unprocessed_rounds` calls' last item
+    unprocessed, to exercise the callers' retry of UnprocessedItems.
+    """
+
+    def __init__(self, tables, unprocessed_rounds=0):
+        self.tables = {table.name: table for table in tables}
+        self.meta = types.SimpleNamespace(client=FakeDynamoDBClient(self))
+        self.unprocessed_rounds = unprocessed_rounds
+        self.batch_writes = []
+        self.batch_gets = []
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        for name, request in RequestItems.items():
+            if len(request["Keys"]) > 100:
+                raise ValueError("Too many items requested for the BatchGetItem call")
+            table = self.tables[name]
+            self.batch_gets.append((name, len(request["Keys"])))
+            responses[name] = [dict(table.items[table._key(key)]) for key in request["Keys"]
+                               if table._key(key) in table.items]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        unprocessed = {}
+        for name, requests in RequestItems.items():
+            if len(requests) > 25:
+                raise ValueError("Too many items requested for the BatchWriteItem call")
+            table = self.tables[name]
+            keys = [table._key(request["PutRequest"]["Item"]) for request in requests]
+            if len(set(keys)) != len(keys):
+                raise ValueError("Provided list of item keys contains duplicates")
+            self.batch_writes.append(len(requests))
+            if self.unprocessed_rounds and requests:
+                self.unprocessed_rounds -= 1
+                requests, unprocessed[name] = requests[:-1], requests[-1:]
+            for request in requests:
+                table.put_item(Item=request["PutRequest"]["Item"])
+        return {"UnprocessedItems": unprocessed}
+
+
+class FakeSESError(Exception):
+    pass
+
+
+class FakeSES:
+    """Stand-in for boto3.client('ses') with a set of verified identities.
+
+    Templates are stored and rendered with the subset of Handlebars used by
+    the handlers ({{field}} and {{#each list}}...{{/each}}), so bulk sends can
+    be checked end to end. Recipients in `rejected` fail per destination.
+    """
+
+    class exceptions:
+        class TemplateDoesNotExistException(FakeSESError):
+            pass
+
+    def __init__(self, verified=(), rejected=()):
+        self.verified = set(verified)
+        self.rejected = set(rejected)
+        self.templates = {}
+        self.sent = []
+        self.bulk_calls = []
+        self.verification_calls = []
+
+    def get_identity_verification_attributes(self, Identities):
+        self.verification_calls.append(list(Identities))
+        return {
+            "VerificationAttributes": {
+                identity: {"VerificationStatus": "Success"}
+                for identity in Identities
+                if identity in self.verified
+            }
+        }
+
+    def send_email(self, Source, Destination, Message, **kwargs):
+        self.sent.append({"Source": Source, "Destination": Destination, "Message": Message})
+        return {"MessageId": str(uuid.uuid4())}
+
+    def create_template(self, Template):
+        self.templates[Template["TemplateName"]] = Template
+        return {}
+
+    def update_template(self, Template):
+        if Template["TemplateName"] not in self.templates:
+            raise self.exceptions.TemplateDoesNotExistException(Template["TemplateName"])
+        self.templates[Template["TemplateName"]] = Template
+        return {}
+
+    def send_bulk_templated_email(self, Source, Template, DefaultTemplateData, Destinations, **kwargs):
+        self.bulk_calls.append(len(Destinations))
+        template = self.templates[Template]
+        statuses = []
+        for destination in Destinations:
+            recipient = destination["Destination"]["ToAddresses"][0]
+            if recipient in self.rejected:
+                statuses.append({"Status": "MessageRejected", "Error": "Rejected"})
+                continue
+            data = {**json.loads(DefaultTemplateData), **json.loads(destination["ReplacementTemplateData"])}
+            self.sent.append({
+                "Source": Source,
+                "Destination": destination["Destination"],
+                "Message": {
+                    "Subject": {"Data": render_handlebars(template["SubjectPart"], data)},
+                    "Body": {
+                        "Text": {"Data": render_handlebars(template["TextPart"], data)},
+                        "Html": {"Data": render_handlebars(template["HtmlPart"], data, escape=True)},
+                    },
+                },
+            })
+            statuses.append({"Status": "Success", "MessageId": str(uuid.uuid4())})
+        return {"Status": statuses}
+
+
+def render_handlebars(template, data, escape=False):
+    """Render {{field}} and {{#each list}}...{{/each}} blocks"""
+    def each(match):
+        return "".join(render_handlebars(match.group(2), item, escape) for item in data[match.group(1)])
+
+    def field(match):
+        value = str(data[match.group(1)])
+        return html.escape(value) if escape else value
+
+    template = re.sub(r"{{#each (\w+)}}(.*?){{/each}}", each, template, flags=re.S)
+    return re.sub(r"{{(\w+)}}", field, template)
+
+
+class FakeS3:
+    """Stand-in for boto3.client('s3') storing objects in memory"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = {"Body": Body, **kwargs}
+        return {"ETag": str(uuid.uuid4())}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        body = self.objects[(Bucket, Key)]["Body"]
+        if Range:
+            start, end = Range[len("bytes="):].split("-")
+            body = body[int(start):int(end) + 1]
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+
+class FakeSQS:
+    """Stand-in for boto3.client('sqs') with a single in-memory queue.
+
+    Sent messages are recorded in `messages` and can be received again, with
+    DelaySeconds, visibility timeouts and receipt handles behaving as in
+    SQS. receive_message long-polls for at most `max_wait` seconds so tests
+    don't block for the full WaitTimeSeconds.
+    """
+
+    def __init__(self, max_wait=0.05):
+        self.max_wait = max_wait
+        self.messages = []
+        self.queue = {}  # MessageId -> message state
+        self.deleted = []
+        self.delete_batches = []
+        self.visibility_changes = []
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        message_id = str(uuid.uuid4())
+        with self._lock:
+            self.messages.append({"QueueUrl": QueueUrl, "MessageBody": MessageBody,
+                                  "DelaySeconds": DelaySeconds, **kwargs})
+            self.queue[message_id] = {"Body": MessageBody, "ReceiptHandle": None,
+                                      "visible_at": time.monotonic() + DelaySeconds, "receives": 0}
+        return {"MessageId": message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=30, **kwargs):
+        deadline = time.monotonic() + min(WaitTimeSeconds, self.max_wait)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                visible = [(message_id, state) for message_id, state in self.queue.items()
+                           if state["visible_at"] <= now][:MaxNumberOfMessages]
+                messages = []
+                for message_id, state in visible:
+                    state.update(ReceiptHandle=str(uuid.uuid4()), visible_at=now + VisibilityTimeout,
+                                 receives=state["receives"] + 1)
+                    messages.append({"MessageId": message_id, "ReceiptHandle": state["ReceiptHandle"],
+                                     "Body": state["Body"]})
+            if messages or time.monotonic() >= deadline:
+                return {"Messages": messages} if messages else {}
+            time.sleep(0.005)
+
+    def _find(self, message_id, receipt_handle):
+        state = self.queue.get(message_id)
+        return state if state is not None and state["ReceiptHandle"] == receipt_handle else None
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        successful, failed = [], []
+        with self._lock:
+            for entry in Entries:
+                state = self._find(entry["Id"], entry["ReceiptHandle"])
+                if state is None:
+                    failed.append({"Id": entry["Id"], "Code": "ReceiptHandleIsInvalid"})
+                    continue
+                state["visible_at"] = time.monotonic() + entry["VisibilityTimeout"]
+                self.visibility_changes.append(entry["Id"])
+                successful.append({"Id": entry["Id"]})
+        return {"Successful": successful, "Failed": failed}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        successful, failed = [], []
+        with self._lock:
+            self.delete_batches.append(len(Entries))
+            for entry in Entries:
+                if self._find(entry["Id"], entry["ReceiptHandle"]) is None:
+                    failed.append({"Id": entry["Id"], "Code": "ReceiptHandleIsInvalid"})
+                    continue
+                del self.queue[entry["Id"]]
+                self.deleted.append(entry["Id"])
+                successful.append({"Id": entry["Id"]})
+        return {"Successful": successful, "Failed": failed}
@@ -0,0 +1,288 @@
+"""
+Local tests for the aggregate_events Lambda using in-memory AWS stand-ins
+"""
+
+import json
+from datetime import date
+
+import pytest
+
+from local_aws import (FakeDynamoDB, FakeS3, FakeSQS, FakeTable, load_lambda, load_script, sqs_record,
+                       throttling_error)
+
+QUEUE_URL = "https://sqs.local/events"
+
+
+def view(user_id="user-1", product_id="prod-1", event_type="product-view"):
+    return {"userId": user_id, "productId": product_id, "eventType": event_type, "productType": "Electronics"}
+
+
+@pytest.fixture
+def interactions():
+    return FakeTable("interactions", ["userId", "productId"])
+
+
+@pytest.fixture
+def fake_dynamodb(interactions):
+    return FakeDynamoDB([interactions])
+
+
+@pytest.fixture
+def queue():
+    return FakeSQS()
+
+
+@pytest.fixture
+def track_event(monkeypatch, fake_dynamodb, queue):
+    app = load_lambda("track_event")
+    monkeypatch.setattr(app, "dynamodb", fake_dynamodb)
+    monkeypatch.setattr(app, "sqs", queue)
+    monkeypatch.setattr(app, "EVENT_INGEST_MODE", "queue")
+    monkeypatch.setenv("EVENTS_QUEUE_URL", QUEUE_URL)
+    return app
+
+
+@pytest.fixture
+def aggregate_events(monkeypatch, fake_dynamodb, queue):
+    app = load_lambda("aggregate_events")
+    monkeypatch.setattr(app, "dynamodb", fake_dynamodb)
+    monkeypatch.setattr(app, "s3", FakeS3())
+    monkeypatch.setattr(app, "sqs", queue)
+    monkeypatch.setenv("INTERACTIONS_TABLE", "interactions")
+    monkeypatch.setenv("EVENTS_QUEUE_URL", QUEUE_URL)
+    return app
+
+
+def throttle(table, product_id):
+    """Make every update of product_id fail"""
+    update_item = table.update_item
+
+    def throttled(Key, **kwargs):
+        if Key["productId"] == product_id:
+            raise throttling_error("UpdateItem")
+        return update_item(Key=Key, **kwargs)
+
+    table.update_item = throttled
+
+
+def deliver(queue):
+    """Receive everything on the queue as one Lambda SQS event"""
+    messages = queue.receive_message(QueueUrl=QUEUE_URL, MaxNumberOfMessages=10).get("Messages", [])
+    return {"Records": [{"messageId": message["MessageId"], "body": message["Body"]} for message in messages]}
+
+
+def deliver_now(queue):
+    """deliver, without waiting out the messages' DelaySeconds"""
+    for state in queue.queue.values():
+        state["visible_at"] = 0
+    return deliver(queue)
+
+
+class TestAggregation:
+    """Events from many requests are written once per (userId, productId)"""
+
+    def test_end_to_end_through_the_queue(self, track_event, aggregate_events, queue, interactions):
+        for _ in range(3):
+            track_event.lambda_handler({"body": json.dumps([view(), view(product_id="prod-2")])}, None)
+        track_event.lambda_handler({"body": json.dumps(view(event_type="add-to-cart"))}, None)
+
+        response = aggregate_events.lambda_handler(deliver(queue), None)
+
+        assert response == {"batchItemFailures": []}
+        assert len(interactions.calls) == 2
+        record = interactions.items[("user-1", "prod-1")]
+        # The repeated views fall inside the debounce window
+        assert (record["viewCount"], record["cartCount"], record["eventType"]) == (1, 1, "add-to-cart")
+        assert interactions.items[("user-1", "prod-2")]["viewCount"] == 1
+
+    def test_latest_timestamp_wins_regardless_of_arrival(self, aggregate_events, interactions):
+        newer = dict(view(event_type="purchase"), category="Electronics", timestamp="2025-01-02T00:00:00Z")
+        older = dict(view(), category="Electronics", timestamp="2025-01-01T00:00:00Z")
+        event = {"Records": [sqs_record({"events": [newer]}), sqs_record({"events": [older]})]}
+
+        aggregate_events.lambda_handler(event, None)
+
+        assert interactions.items[("user-1", "prod-1")]["eventType"] == "purchase"
+
+    def test_unwritten_keys_are_retried_without_their_messages(self, aggregate_events, interactions, queue):
+        record = dict(view(), category="Electronics", timestamp="2025-01-01T00:00:00Z")
+        message = sqs_record({"events": [record, dict(record, productId="prod-2", eventType="purchase")]},
+                             message_id="msg-1")
+        malformed = {"messageId": "msg-2", "body": "not json"}
+        throttle(interactions, "prod-2")
+
+        response = aggregate_events.lambda_handler({"Records": [message, malformed]}, None)
+
+        # Redelivering msg-1 would count prod-1 twice
+        assert response == {"batchItemFailures": [{"itemIdentifier": "msg-2"}]}
+        [retry] = queue.messages
+        body = json.loads(retry["MessageBody"])
+        assert body["attempt"] == 1 and retry["DelaySeconds"] == aggregate_events.RETRY_DELAY_SECONDS
+        assert [event["productId"] for event in body["events"]] == ["prod-2"]
+
+        del interactions.update_item  # writes succeed again
+        aggregate_events.lambda_handler({"Records": [sqs_record(body)]}, None)
+
+        assert interactions.items[("user-1", "prod-1")]["viewCount"] == 1
+        assert interactions.items[("user-1", "prod-2")]["purchaseCount"] == 1
+
+    def test_retries_give_up_after_the_last_attempt(self, aggregate_events, interactions, queue, capsys):
+        record = dict(view(), category="Electronics", timestamp="2025-01-01T00:00:00Z")
+        attempt = aggregate_events.MAX_RETRY_ATTEMPTS
+        throttle(interactions, "prod-1")
+
+        response = aggregate_events.lambda_handler({"Records": [sqs_record({"events": [record], "attempt": attempt})]},
+                                                   None)
+
+        assert response == {"batchItemFailures": []}
+        assert queue.messages == []
+        assert '"DroppedEvents": 1' in capsys.readouterr().out
+
+    def test_messages_redelivered_if_the_retry_cannot_be_queued(self, aggregate_events, interactions, monkeypatch):
+        record = dict(view(), category="Electronics", timestamp="2025-01-01T00:00:00Z")
+        first = sqs_record({"events": [record]}, message_id="msg-1")
+        second = sqs_record({"events": [dict(record, productId="prod-2")]}, message_id="msg-2")
+        throttle(interactions, "prod-2")
+
+        def unavailable(**kwargs):
+            raise throttling_error("SendMessage")
+
+        monkeypatch.setattr(aggregate_events.sqs, "send_message", unavailable)
+
+        response = aggregate_events.lambda_handler({"Records": [first, second]}, None)
+
+        assert response == {"batchItemFailures": [{"itemIdentifier": "msg-2"}]}
+
+    def test_users_with_new_events_get_a_new_version(self, aggregate_events, fake_dynamodb, monkeypatch):
+        monkeypatch.setenv("RECOMMENDATION_STATE_TABLE", "state")
+        state = fake_dynamodb.tables["state"] = FakeTable("state", ["userId"])
+        record = dict(view(), category="Electronics", timestamp="2025-01-01T00:00:00Z")
+        events = [record, dict(record, productId="prod-2"), dict(record, userId="user-2")]
+
+        aggregate_events.lambda_handler({"Records": [sqs_record({"events": events}),
+                                                     sqs_record({"events": [record], "stored": True})]}, None)
+
+        assert {key: item["interactionVersion"] for key, item in state.items.items()} == \
+            {("user-1",): 1, ("user-2",): 1}
+        assert state.items[("user-1",)]["seenProducts"] == {"prod-1", "prod-2"}
+
+    def test_unwritten_keys_keep_the_version(self, aggregate_events, fake_dynamodb, interactions, monkeypatch):
+        monkeypatch.setenv("RECOMMENDATION_STATE_TABLE", "state")
+        state = fake_dynamodb.tables["state"] = FakeTable("state", ["userId"])
+        throttle(interactions, "prod-2")
+        record = dict(view(), category="Electronics", timestamp="2025-01-01T00:00:00Z")
+        events = [record, dict(record, productId="prod-2"), dict(record, userId="user-2", productId="prod-2")]
+
+        aggregate_events.lambda_handler({"Records": [sqs_record({"events": events})]}, None)
+
+        assert set(state.items) == {("user-1",)}
+        assert state.items[("user-1",)]["seenProducts"] == {"prod-1"}
+
+
+def event_at(timestamp, product_id="prod-1"):
+    return dict(view(product_id=product_id), category="Electronics", timestamp=timestamp)
+
+
+class TestArchive:
+    """With ARCHIVE_BUCKET set every accepted event lands in S3"""
+
+    def test_events_archived_per_hour_partition(self, aggregate_events, monkeypatch):
+        monkeypatch.setenv("ARCHIVE_BUCKET", "archive")
+        events = [event_at("2025-06-01T10:15:00Z"), event_at("2025-06-01T10:45:00Z", "prod-2"),
+                  event_at("2025-06-01T11:05:00Z", "prod-3")]
+
+        aggregate_events.lambda_handler({"Records": [sqs_record({"events": events})]}, None)
+
+        objects = aggregate_events.s3.objects
+        prefixes = sorted(key.rsplit("/", 1)[0] for _, key in objects)
+        assert prefixes == ["interactions/date=2025-06-01/hour=10", "interactions/date=2025-06-01/hour=11"]
+        from event_archive import decode_events  # on the path once aggregate_events is loaded
+        archived = [record for (_, key), obj in sorted(objects.items()) for record in decode_events(obj["Body"], key)]
+        assert [record["productId"] for record in archived] == ["prod-1", "prod-2", "prod-3"]
+
+    def test_stored_events_are_archived_but_not_written(self, aggregate_events, interactions, monkeypatch):
+        monkeypatch.setenv("ARCHIVE_BUCKET", "archive")
+        record = sqs_record({"events": [event_at("2025-06-01T10:15:00Z")], "stored": True})
+
+        response = aggregate_events.lambda_handler({"Records": [record]}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert len(aggregate_events.s3.objects) == 1
+        assert interactions.items == {}
+
+    def test_only_acknowledged_events_archived_after_the_write(self, aggregate_events, interactions, queue,
+                                                               monkeypatch):
+        monkeypatch.setenv("ARCHIVE_BUCKET", "archive")
+        events = [event_at("2025-06-01T10:15:00Z"), event_at("2025-06-01T10:16:00Z", "prod-2")]
+        throttle(interactions, "prod-2")
+
+        aggregate_events.lambda_handler({"Records": [sqs_record({"events": events})]}, None)
+
+        from event_archive import decode_events
+        [((_, key), obj)] = aggregate_events.s3.objects.items()
+        assert [record["productId"] for record in decode_events(obj["Body"], key)] == ["prod-1"]
+
+        # prod-2 is archived once its retry is written
+        del interactions.update_item
+        aggregate_events.lambda_handler(deliver_now(queue), None)
+
+        assert len(aggregate_events.s3.objects) == 2
+
+    def test_archive_failure_queues_written_events_for_later(self, aggregate_events, interactions, queue,
+                                                             monkeypatch):
+        monkeypatch.setenv("ARCHIVE_BUCKET", "archive")
+        s3 = aggregate_events.s3
+        put_object = s3.put_object
+
+        def unavailable(**kwargs):
+            raise throttling_error("PutObject")
+
+        monkeypatch.setattr(s3, "put_object", unavailable)
+        record = sqs_record({"events": [event_at("2025-06-01T10:15:00Z")]}, message_id="msg-1")
+
+        response = aggregate_events.lambda_handler({"Records": [record]}, None)
+
+        # Written, so not redelivered, but archived from a stored message
+        assert response == {"batchItemFailures": []}
+        assert interactions.items[("user-1", "prod-1")]["viewCount"] == 1
+        monkeypatch.setattr(s3, "put_object", put_object)
+        aggregate_events.lambda_handler(deliver_now(queue), None)
+
+        assert len(s3.objects) == 1
+        assert interactions.items[("user-1", "prod-1")]["viewCount"] == 1
+
+    def test_stored_messages_redelivered_if_nothing_can_archive(self, aggregate_events, monkeypatch):
+        monkeypatch.setenv("ARCHIVE_BUCKET", "archive")
+        monkeypatch.delenv("EVENTS_QUEUE_URL")
+
+        def unavailable(**kwargs):
+            raise throttling_error("PutObject")
+
+        monkeypatch.setattr(aggregate_events.s3, "put_object", unavailable)
+        stored = sqs_record({"events": [event_at("2025-06-01T10:15:00Z")], "stored": True}, message_id="msg-1")
+        written = sqs_record({"events": [event_at("2025-06-01T10:15:00Z", "prod-2")]}, message_id="msg-2")
+
+        response = aggregate_events.lambda_handler({"Records": [stored, written]}, None)
+
+        assert response == {"batchItemFailures": [{"itemIdentifier": "msg-1"}]}
+
+    def test_reader_loads_a_date_range(self, aggregate_events, tmp_path):
+        s3 = FakeS3()
+        aggregate_events.archive_events(s3, "archive", [
+            event_at("2025-05-31T23:59:00Z", "prod-0"),
+            event_at("2025-06-01T10:15:00Z", "prod-2"),
+            dict(event_at("2025-06-02T08:00:00Z", "prod-1"), eventType="purchase", userId="user-2"),
+            event_at("2025-06-03T00:00:00Z", "prod-3"),
+        ])
+        for (_, key), obj in s3.objects.items():
+            path = tmp_path / key
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(obj["Body"])
+
+        reader = load_script("load_interactions")
+        arrays = reader.load_interactions(date(2025, 6, 1), date(2025, 6, 2), root=str(tmp_path))
+
+        assert list(arrays["items"][arrays["item"]]) == ["prod-2", "prod-1"]
+        assert list(arrays["users"][arrays["user"]]) == ["user-1", "user-2"]
+        assert [reader.EVENT_TYPES[code] for code in arrays["event"]] == ["product-view", "purchase"]
+        assert list(arrays["timestamp"]) == [1748772900, 1748851200]
@@ -0,0 +1,78 @@
+"""
+Local tests for scripts/batch_recommendations.py
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from local_aws import load_script
+
+
+@pytest.fixture(scope="module")
+def batch():
+    return load_script("batch_recommendations")
+
+
+def recommend(batch, interactions, top_k=3, memory_mb=512):
+    users, items, weights = zip(*interactions)
+    matrix, item_ids = batch.interaction_matrix(users, items, weights)
+    similarity = batch.prune_similarity(batch.item_similarity(matrix), 50)
+    user_ids = np.unique(users)
+    records = {}
+    for start, top, top_scores in batch.score_users(matrix.astype(np.float32), similarity, top_k, memory_mb):
+        for record in batch.to_records(user_ids, item_ids, start, top, top_scores, "now"):
+            records[record["userId"]] = record["products"]
+    return records
+
+
+class TestBatchRecommendations:
+    """Every user scored with X S in chunks, seen products masked out"""
+
+    INTERACTIONS = [
+        ("user-1", "prod-1", 5), ("user-1", "prod-2", 1),
+        ("user-2", "prod-1", 1), ("user-2", "prod-2", 1), ("user-2", "prod-3", 3),
+        ("user-3", "prod-2", 1), ("user-3", "prod-3", 1), ("user-3", "prod-4", 1),
+        ("user-4", "prod-1", 1),
+    ]
+
+    def test_similar_unseen_products_first(self, batch):
+        records = recommend(batch, self.INTERACTIONS)
+
+        assert records["user-1"] == ["prod-3", "prod-4"]
+        assert records["user-4"][:2] == ["prod-2", "prod-3"]
+        for user, product, _ in self.INTERACTIONS:
+            assert product not in records[user]
+
+    def test_chunks_give_the_same_lists(self, batch, monkeypatch):
+        whole = recommend(batch, self.INTERACTIONS)
+        monkeypatch.setattr(batch, "chunk_rows", lambda products, memory_mb: 1)
+
+        assert recommend(batch, self.INTERACTIONS) == whole
+
+    def test_prune_keeps_strongest_neighbours(self, batch):
+        users, items, weights = zip(*self.INTERACTIONS)
+        matrix, _ = batch.interaction_matrix(users, items, weights)
+        similarity = batch.item_similarity(matrix).toarray()
+        pruned = batch.prune_similarity(batch.item_similarity(matrix), 1).toarray()
+
+        assert (np.count_nonzero(pruned, axis=1) <= 1).all()
+        assert np.allclose(pruned.max(axis=1), similarity.max(axis=1))
+
+    def test_writer_bounds_in_flight_slices(self, batch, monkeypatch):
+        writer = batch.TableWriter("recommendations", workers=2, region="us-east-1", ttl_days=1)
+        submit = writer.executor.submit
+        in_flight = []
+
+        def track(fn, records):
+            in_flight.append(len(writer.pending))
+            return submit(fn, records)
+
+        monkeypatch.setattr(writer, "_write", lambda records: time.sleep(0.01) or len(records))
+        monkeypatch.setattr(writer.executor, "submit", track)
+        for _ in range(3):
+            writer.submit(list(range(10)), slice_size=2)
+
+        assert max(in_flight) < writer.max_pending
+        assert writer.wait() == 30
@@ -0,0 +1,92 @@
+"""
+Local tests for scripts/build_content_index.py and the content_index layer module
+"""
+
+import numpy as np
+import pytest
+
+from local_aws import load_script
+
+
+@pytest.fixture(scope="module")
+def build():
+    return load_script("build_content_index")
+
+
+PRODUCTS = [
+    {"productId": "prod-1", "name": "Wireless Headphones",
+     "description": "High-quality wireless headphones with noise cancellation"},
+    {"productId": "prod-2", "name": "Noise Cancelling Earbuds",
+     "description": "Compact wireless earbuds with active noise cancellation"},
+    {"productId": "book-1", "name": "Cooking for Beginners", "description": "Simple recipes for every day"},
+    {"productId": "book-2", "name": "Everyday Recipes", "description": "Quick recipes for beginners"},
+    {"productId": "prod-3", "name": "Laptop Backpack", "description": "Durable backpack with multiple compartments"},
+]
+
+
+def build_index(build, products, **kwargs):
+    matrix = build.hashed_tfidf(products)
+    neighbours, scores = build.nearest_neighbours(matrix, top_k=2, **kwargs)
+    return build.ContentIndex(build.pack([p["productId"] for p in products], neighbours, scores, 2))
+
+
+class TestContentIndex:
+    """Hashed TF-IDF vectors, neighbours within partitions, packed for Lambda"""
+
+    def test_vectors_are_normalized(self, build):
+        matrix = build.hashed_tfidf(PRODUCTS)
+
+        assert np.allclose(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel(), 1, atol=1e-5)
+
+    def test_similar_text_are_neighbours(self, build):
+        index = build_index(build, PRODUCTS)
+
+        assert len(index) == 5
+        assert index.similar("prod-1")[0][0] == "prod-2"
+        assert [product_id for product_id, _ in index.similar("book-1")] == ["book-2"]
+        assert index.similar("prod-3") == []
+        assert index.similar("unknown") == []
+        assert 0 < index.similar("prod-2", 1)[0][1] <= 1
+
+    def test_partitions_find_the_same_neighbours(self, build):
+        products = build.synthetic_products(3000, topics=30)
+        matrix = build.hashed_tfidf(products)
+        exact = (matrix[:50] @ matrix.T).toarray()
+        exact[np.arange(50), np.arange(50)] = 0
+
+        neighbours, scores = build.nearest_neighbours(matrix, top_k=5, min_score=0, partition_size=100)
+
+        # Partitioned search is approximate, but finds nearly as similar products
+        found = scores[:50].sum(axis=1) / build.SCORE_SCALE
+        best = np.sort(exact, axis=1)[:, -5:].sum(axis=1)
+        assert (found / best).mean() > 0.8
+        assert (neighbours[:50] != np.arange(50)[:, None]).all()
+
+    def test_default_probes_find_most_of_the_exact_neighbours(self, build):
+        matrix = build.hashed_tfidf(build.synthetic_products(3000))
+        exact = (matrix @ matrix.T).toarray()
+        np.fill_diagonal(exact, 0)
+
+        def recall(**kwargs):
+            neighbours, _ = build.nearest_neighbours(matrix, top_k=10, **kwargs)
+            found = total = 0
+            for row, candidates in enumerate(neighbours):
+                best = np.argsort(-exact[row])[:10]
+                best = set(best[exact[row, best] >= 0.05])
+                found += len(best & set(candidates[candidates >= 0]))
+                total += len(best)
+            return found / total
+
+        assert recall() > 0.85
+        assert recall(probes=1) < recall()
+
+    def test_truncated_index_rejected(self, build):
+        data = build.pack(["prod-1", "prod-2"], np.array([[1], [0]], dtype="<i4"), np.array([[1], [1]], dtype="<u2"), 1)
+
+        assert build.ContentIndex(data).similar("prod-2") == [("prod-1", 1 / build.SCORE_SCALE)]
+        with pytest.raises(ValueError):
+            build.ContentIndex(data[:-2])
+
+    def test_empty_catalog_gives_empty_index(self, build):
+        assert len(build_index(build, [])) == 0
+        assert build_index(build, PRODUCTS[:1]).similar("prod-1") == []
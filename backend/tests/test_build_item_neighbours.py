@@ -0,0 +1,43 @@
+"""
+Local tests for scripts/build_item_neighbours.py
+"""
+
+import pytest
+
+from local_aws import FakeTable, load_script
+
+
+@pytest.fixture(scope="module")
+def build():
+    return load_script("build_item_neighbours")
+
+
+class TestItemNeighbours:
+    """Neighbour lists from co-interactions, replacing the previous build"""
+
+    INTERACTIONS = [
+        ("user-1", "prod-1", 5), ("user-1", "prod-2", 1),
+        ("user-2", "prod-1", 1), ("user-2", "prod-2", 3),
+        ("user-3", "prod-3", 1),
+    ]
+
+    def neighbours(self, build, interactions):
+        matrix, item_ids = build.interaction_matrix(*zip(*interactions))
+        return build.top_neighbours(build.item_similarity(matrix), item_ids)
+
+    def test_co_interacted_products_are_neighbours(self, build):
+        neighbours = self.neighbours(build, self.INTERACTIONS)
+
+        assert [product_id for product_id, _ in neighbours["prod-1"]] == ["prod-2"]
+        assert "prod-3" not in neighbours
+
+    def test_rebuild_deletes_products_without_a_list(self, build):
+        table = FakeTable("neighbours", ["productId"])
+        build.write_neighbours(table, self.neighbours(build, self.INTERACTIONS + [("user-3", "prod-4", 1)]))
+        assert set(table.items) == {("prod-1",), ("prod-2",), ("prod-3",), ("prod-4",)}
+
+        deleted = build.write_neighbours(table, self.neighbours(build, self.INTERACTIONS))
+
+        assert deleted == 2
+        assert set(table.items) == {("prod-1",), ("prod-2",)}
+        assert table.items[("prod-1",)]["neighbours"][0]["productId"] == "prod-2"
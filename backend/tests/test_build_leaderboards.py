@@ -0,0 +1,151 @@
+"""
+Local tests for the build_leaderboards Lambda using in-memory AWS stand-ins
+"""
+
+import json
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+from local_aws import FakeDynamoDB, FakeTable, load_lambda
+
+from order_ids import CREATED_BUCKET_SHARDS, created_bucket  # noqa: E402
+
+
+def hours_ago(hours):
+    return (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
+
+
+def product(product_id, category="Electronics", stock=5):
+    return {"productId": product_id, "name": product_id, "category": category,
+            "price": Decimal("9.99"), "stock": Decimal(stock)}
+
+
+def interaction(user_id, product_id, hours, event_type="product-view"):
+    counters = {"product-view": "viewCount", "add-to-cart": "cartCount", "purchase": "purchaseCount"}
+    return {"userId": user_id, "productId": product_id, "eventType": event_type, "timestamp": hours_ago(hours),
+            counters[event_type]: Decimal(1)}
+
+
+def order(order_id, hours, status, *items):
+    created = datetime.now(timezone.utc) - timedelta(hours=hours)
+    return {"orderId": order_id, "status": status, "createdAt": created.isoformat(),
+            "createdBucket": created_bucket(order_id, created),
+            "items": [{"productId": product_id, "quantity": Decimal(quantity)} for product_id, quantity in items]}
+
+
+@pytest.fixture
+def tables():
+    return {
+        "interactions": FakeTable("interactions", ["userId", "productId"]),
+        "orders": FakeTable("orders", ["orderId"], indexes={"createdBucket-index": "orderId"}),
+        "products": FakeTable("products", ["productId"]),
+        "leaderboards": FakeTable("leaderboards", ["name"]),
+    }
+
+
+@pytest.fixture
+def build_leaderboards(monkeypatch, tables):
+    app = load_lambda("build_leaderboards")
+    monkeypatch.setattr(app, "dynamodb", FakeDynamoDB(tables.values()))
+    for name in ("interactions", "orders", "products", "leaderboards"):
+        monkeypatch.setenv(f"{name.upper()}_TABLE", name)
+    return app
+
+
+def put(table, *items):
+    for item in items:
+        table.put_item(Item=item)
+
+
+def build(build_leaderboards, tables):
+    assert build_leaderboards.lambda_handler({}, None)["built"]
+    item = tables["leaderboards"].items[("popular",)]
+    return json.loads(item["leaderboards"])
+
+
+class TestLeaderboards:
+    """Interactions and processed orders ranked per sliding window"""
+
+    @pytest.fixture(autouse=True)
+    def catalog(self, tables):
+        put(tables["products"], *[product(f"prod-{i}") for i in range(1, 5)],
+            product("book-1", "Books"), product("book-2", "Books", stock=0))
+
+    def test_windows_rank_interactions_and_orders(self, build_leaderboards, tables):
+        put(tables["interactions"],
+            interaction("user-1", "prod-1", 2),
+            interaction("user-2", "prod-1", 72),
+            interaction("user-3", "prod-2", 240, "purchase"),
+            interaction("user-1", "book-1", 1))
+        put(tables["orders"],
+            order("order-1", 5, "PROCESSED", ("prod-3", 2)),
+            order("order-2", 5, "PENDING", ("prod-4", 10)))
+
+        leaderboards = build(build_leaderboards, tables)
+
+        assert leaderboards["windows"] == ["1d", "7d", "30d"]
+        assert leaderboards["global"]["1d"][0] == "prod-3"
+        assert sorted(leaderboards["global"]["1d"][1:]) == ["book-1", "prod-1"]
+        assert leaderboards["global"]["7d"] == ["prod-3", "prod-1", "book-1"]
+        assert leaderboards["global"]["30d"] == ["prod-3", "prod-2", "prod-1", "book-1"]
+        assert leaderboards["categories"]["Books"] == {"1d": ["book-1"], "7d": ["book-1"], "30d": ["book-1"]}
+        assert leaderboards["products"]["prod-3"] == {"id": "prod-3", "name": "prod-3", "category": "Electronics",
+                                                     "price": 9.99, "stock": 5}
+
+    def test_out_of_stock_products_left_out(self, build_leaderboards, tables):
+        put(tables["interactions"], interaction("user-1", "book-2", 1, "purchase"), interaction("user-1", "book-1", 1))
+
+        leaderboards = build(build_leaderboards, tables)
+
+        assert leaderboards["global"]["1d"] == ["book-1"]
+        assert "book-2" not in leaderboards["products"]
+
+    def test_orders_outside_the_windows_are_ignored(self, build_leaderboards, tables, monkeypatch):
+        monkeypatch.setattr(build_leaderboards, "LEADERBOARD_WINDOWS", [("1d", timedelta(days=1))])
+        put(tables["orders"], order("order-1", 30, "PROCESSED", ("prod-3", 2)),
+            order("order-2", 3, "PROCESSED", ("prod-4", 1)))
+        tables["orders"].calls.clear()
+
+        leaderboards = build(build_leaderboards, tables)
+
+        assert leaderboards["global"] == {"1d": ["prod-4"]}
+        # One query per shard of each hourly bucket of the window, never a scan of the orders
+        assert {call[0] for call in tables["orders"].calls} == {"query"}
+        assert len(tables["orders"].calls) == 25 * CREATED_BUCKET_SHARDS
+
+    def test_recent_interactions_read_from_the_activity_index(self, build_leaderboards, tables, monkeypatch):
+        monkeypatch.setattr(build_leaderboards, "LEADERBOARD_WINDOWS", [("1d", timedelta(days=1))])
+        monkeypatch.setattr(build_leaderboards, "INTERACTIONS_ACTIVITY_INDEX", "activeBucket-index")
+        records = [interaction("user-1", "prod-1", 2), interaction("user-2", "prod-2", 72, "purchase")]
+        for record in records:
+            record["activeBucket"] = datetime.fromisoformat(record["timestamp"]).strftime("%Y-%m-%dT%H")
+        put(tables["interactions"], *records)
+
+        leaderboards = build(build_leaderboards, tables)
+
+        assert leaderboards["global"] == {"1d": ["prod-1"]}
+        # One query per hourly bucket of the window, never a scan
+        assert {call[0] for call in tables["interactions"].calls} == {"put_item", "query"}
+
+    def test_oversized_leaderboards_trimmed_longest_window_first(self, build_leaderboards, tables, monkeypatch,
+                                                                 capsys):
+        put(tables["products"], dict(product("prod-9"), description="x" * 2000, supplier="internal"))
+        put(tables["interactions"], interaction("user-1", "prod-1", 2), interaction("user-2", "prod-9", 240))
+        monkeypatch.setattr(build_leaderboards, "LEADERBOARD_MAX_BYTES", 1000)
+
+        leaderboards = build(build_leaderboards, tables)
+
+        assert leaderboards["windows"] == ["1d", "7d"]
+        assert set(leaderboards["products"]) == {"prod-1"}
+        assert "LeaderboardTrims" in capsys.readouterr().out
+
+    def test_only_response_fields_stored(self, build_leaderboards, tables):
+        put(tables["products"], dict(product("prod-9"), imageUrl="https://img/9.png", supplier="internal"))
+        put(tables["interactions"], interaction("user-1", "prod-9", 2))
+
+        leaderboards = build(build_leaderboards, tables)
+
+        assert leaderboards["products"]["prod-9"] == {"id": "prod-9", "name": "prod-9", "category": "Electronics",
+                                                     "price": 9.99, "stock": 5, "imageUrl": "https://img/9.png"}
@@ -0,0 +1,408 @@
+"""
+Local tests for the get_recommendations Lambda using in-memory AWS stand-ins
+"""
+
+import json
+from array import array
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+from local_aws import FakeDynamoDB, FakeS3, FakeTable, load_lambda
+from content_index import SCORE_SCALE, pack  # noqa: E402  (local_aws puts the common layer on sys.path)
+from recommendation_state import record_interactions  # noqa: E402
+
+
+def product(product_id, category="Electronics"):
+    return {"productId": product_id, "name": product_id, "category": category,
+            "price": Decimal("9.99"), "stock": Decimal("5")}
+
+
+def interaction(product_id, timestamp, event_type="product-view", category="Electronics"):
+    return {"userId": "user-1", "productId": product_id, "eventType": event_type,
+            "category": category, "timestamp": timestamp}
+
+
+def neighbours(product_id, *ranked):
+    return {"productId": product_id,
+            "neighbours": [{"productId": neighbour, "score": Decimal(str(score))} for neighbour, score in ranked]}
+
+
+@pytest.fixture
+def tables():
+    return {
+        "interactions": FakeTable("interactions", ["userId", "productId"]),
+        "products": FakeTable("products", ["productId"], indexes={"category-index": None}),
+        "neighbours": FakeTable("neighbours", ["productId"]),
+    }
+
+
+@pytest.fixture
+def fake_dynamodb(tables):
+    return FakeDynamoDB(tables.values())
+
+
+@pytest.fixture
+def get_recommendations(monkeypatch, fake_dynamodb):
+    app = load_lambda("get_recommendations")
+    monkeypatch.setattr(app, "dynamodb", fake_dynamodb)
+    monkeypatch.setenv("INTERACTIONS_TABLE", "interactions")
+    monkeypatch.setenv("PRODUCTS_TABLE", "products")
+    return app
+
+
+def put(table, *items):
+    for item in items:
+        table.put_item(Item=item)
+
+
+def recommend(get_recommendations, user_id="user-1"):
+    response = get_recommendations.lambda_handler({"queryStringParameters": {"userId": user_id}}, None)
+    assert response["statusCode"] == 200
+    return [product["id"] for product in json.loads(response["body"])]
+
+
+class TestNeighbours:
+    """Precomputed neighbour lists are merged ahead of the category fallback"""
+
+    @pytest.fixture(autouse=True)
+    def catalog(self, tables, monkeypatch):
+        monkeypatch.setenv("NEIGHBOURS_TABLE", "neighbours")
+        put(tables["products"], *[product(f"prod-{i}") for i in range(1, 8)], product("book-1", "Books"))
+
+    def test_neighbours_ranked_by_similarity_and_interest(self, get_recommendations, tables):
+        put(tables["interactions"],
+            interaction("prod-1", "2025-06-01T10:00:00Z", "purchase"),
+            interaction("prod-2", "2025-06-01T11:00:00Z"))
+        put(tables["neighbours"],
+            neighbours("prod-1", ("prod-3", 0.5), ("book-1", 0.4), ("prod-2", 0.9)),
+            neighbours("prod-2", ("prod-4", 0.9), ("book-1", 0.3)))
+
+        ids = recommend(get_recommendations)
+
+        # book-1: 5 x 0.4 + 1 x 0.3, prod-3: 5 x 0.5, prod-4: 1 x 0.9; prod-2 was seen
+        assert ids[:3] == ["prod-3", "book-1", "prod-4"]
+        assert "prod-1" not in ids and "prod-2" not in ids
+
+    def test_category_fills_the_rest_without_duplicates(self, get_recommendations, tables):
+        put(tables["interactions"], interaction("prod-1", "2025-06-01T10:00:00Z"))
+        put(tables["neighbours"], neighbours("prod-1", ("prod-3", 0.5)))
+
+        ids = recommend(get_recommendations)
+
+        assert ids[0] == "prod-3"
+        assert sorted(ids[1:]) == ["prod-2", "prod-4", "prod-5", "prod-6", "prod-7"]
+
+    def test_lookups_are_batched(self, get_recommendations, tables, fake_dynamodb):
+        put(tables["interactions"], *[interaction(f"prod-{i}", f"2025-06-01T1{i}:00:00Z") for i in range(1, 4)])
+        put(tables["neighbours"], neighbours("prod-1", ("prod-5", 0.5)), neighbours("prod-3", ("prod-6", 0.5)))
+
+        recommend(get_recommendations)
+
+        assert fake_dynamodb.batch_gets == [("neighbours", 3), ("products", 2)]
+
+    def test_missing_table_falls_back_to_category(self, get_recommendations, tables, monkeypatch):
+        monkeypatch.setenv("NEIGHBOURS_TABLE", "no-such-table")
+        put(tables["interactions"], interaction("prod-1", "2025-06-01T10:00:00Z"))
+
+        assert sorted(recommend(get_recommendations)) == [f"prod-{i}" for i in range(2, 8)]
+
+
+def days_ago(days):
+    return (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+
+
+class TestScoring:
+    """Categories are weighted by event type and recency, then interleaved"""
+
+    @pytest.fixture(autouse=True)
+    def catalog(self, tables):
+        put(tables["products"], *[product(f"prod-{i}") for i in range(1, 8)],
+            *[product(f"book-{i}", "Books") for i in range(1, 8)],
+            *[product(f"toy-{i}", "Toys") for i in range(1, 8)])
+
+    def test_older_purchase_outweighs_a_recent_view(self, get_recommendations, tables):
+        put(tables["interactions"],
+            interaction("book-1", days_ago(7), "purchase", "Books"),
+            interaction("prod-1", days_ago(0)))
+
+        ids = recommend(get_recommendations)
+
+        assert ids[0].startswith("book-")
+        assert len(ids) == 10
+        books = [product_id for product_id in ids if product_id.startswith("book-")]
+        assert len(books) > len(ids) - len(books) > 0
+        assert "book-1" not in ids and "prod-1" not in ids
+
+    def test_only_the_top_categories_are_queried(self, get_recommendations, tables, monkeypatch):
+        monkeypatch.setattr(get_recommendations, "CATEGORY_FANOUT", 2)
+        put(tables["interactions"],
+            interaction("book-1", days_ago(1), "add-to-cart", "Books"),
+            interaction("prod-1", days_ago(1)),
+            interaction("toy-1", days_ago(60), category="Toys"))
+
+        ids = recommend(get_recommendations)
+
+        assert not [product_id for product_id in ids if product_id.startswith("toy-")]
+        queried = [call for call in tables["products"].calls if call[0] == "query"]
+        assert len(queried) == 2
+
+    def test_interleave_follows_the_weights(self, get_recommendations):
+        import scoring
+
+        merged = scoring.interleave([["a1", "a2", "a3", "a4"], ["b1", "b2"]], [2, 1], limit=6)
+
+        assert merged == ["a1", "b1", "a2", "a3", "b2", "a4"]
+
+    def test_counters_take_precedence_over_the_last_event(self, get_recommendations):
+        import interactions
+        import scoring
+
+        now = datetime(2025, 6, 1, tzinfo=timezone.utc)
+        for era in (0, 2):
+            record = {"productId": "prod-1", "eventType": "product-view", "timestamp": now.isoformat(),
+                      "affinity": Decimal(str(interactions.affinity_weight("purchase", now.isoformat(), era))),
+                      "affinityEra": era}
+
+            assert scoring.interest(record, now) == pytest.approx(5)
+
+
+def bump(tables, user_id="user-1"):
+    """What track_event and aggregate_events do after writing interactions"""
+    tables["state"].update_item(Key={"userId": user_id}, UpdateExpression="ADD interactionVersion :one",
+                                ExpressionAttributeValues={":one": 1})
+
+
+class TestCache:
+    """Lists are cached per user until the interaction version changes"""
+
+    @pytest.fixture(autouse=True)
+    def state(self, tables, fake_dynamodb, monkeypatch):
+        monkeypatch.setenv("RECOMMENDATION_STATE_TABLE", "state")
+        tables["state"] = FakeTable("state", ["userId"])
+        fake_dynamodb.tables["state"] = tables["state"]
+        put(tables["products"], *[product(f"prod-{i}") for i in range(1, 8)],
+            *[product(f"book-{i}", "Books") for i in range(1, 8)])
+        put(tables["interactions"], interaction("prod-1", days_ago(1)))
+
+    def interaction_queries(self, tables):
+        return [call for call in tables["interactions"].calls if call[0] == "query"]
+
+    def test_repeat_request_costs_one_read(self, get_recommendations, tables):
+        first = recommend(get_recommendations)
+        tables["state"].calls.clear()
+
+        assert recommend(get_recommendations) == first
+        assert len(self.interaction_queries(tables)) == 1
+        assert [call[0] for call in tables["state"].calls] == ["get_item"]
+
+    def test_served_from_the_table_by_a_new_container(self, get_recommendations, tables, monkeypatch):
+        first = recommend(get_recommendations)
+        get_recommendations._recommendation_cache.clear()
+
+        assert recommend(get_recommendations) == first
+        assert len(self.interaction_queries(tables)) == 1
+
+    def test_new_interactions_invalidate_the_list(self, get_recommendations, tables):
+        recommend(get_recommendations)
+        put(tables["interactions"], interaction("book-1", days_ago(0), "purchase", "Books"))
+        bump(tables)
+
+        ids = recommend(get_recommendations)
+
+        assert ids[0].startswith("book-") and "book-1" not in ids
+        assert len(self.interaction_queries(tables)) == 2
+        assert tables["state"].items[("user-1",)]["cachedVersion"] == 1
+
+    def test_list_cached_by_another_container_is_served(self, get_recommendations, tables):
+        recommend(get_recommendations)
+        remembered = dict(get_recommendations._recommendation_cache)
+        put(tables["interactions"], interaction("book-1", days_ago(0), "purchase", "Books"))
+        bump(tables)
+        get_recommendations._recommendation_cache.clear()
+        second = recommend(get_recommendations)
+        # This container still remembers the list of the old version
+        get_recommendations._recommendation_cache.update(remembered)
+
+        assert recommend(get_recommendations) == second
+        assert len(self.interaction_queries(tables)) == 2
+
+    def test_list_computed_during_a_bump_is_not_cached(self, get_recommendations, tables, monkeypatch):
+        compute = get_recommendations.recommend
+
+        def bumped_meanwhile(*args):
+            bump(tables)
+            return compute(*args)
+
+        monkeypatch.setattr(get_recommendations, "recommend", bumped_meanwhile)
+        recommend(get_recommendations)
+        monkeypatch.setattr(get_recommendations, "recommend", compute)
+
+        assert "recommendations" not in tables["state"].items[("user-1",)]
+        recommend(get_recommendations)
+        assert len(self.interaction_queries(tables)) == 2
+
+    def test_list_read_right_after_a_write_is_not_cached(self, get_recommendations, tables):
+        # The index may not show the write yet, so the list is not kept for its version
+        record_interactions(get_recommendations.dynamodb, "state", [{"userId": "user-1", "productId": "prod-1"}])
+
+        recommend(get_recommendations)
+
+        assert "recommendations" not in tables["state"].items[("user-1",)]
+        tables["state"].items[("user-1",)]["lastWriteAt"] -= Decimal(get_recommendations.RECOMMENDATION_CACHE_SETTLE_SECONDS)
+        recommend(get_recommendations)
+        assert tables["state"].items[("user-1",)]["cachedVersion"] == 1
+
+    def test_expired_list_is_recomputed(self, get_recommendations, tables):
+        recommend(get_recommendations)
+        get_recommendations._recommendation_cache.clear()
+        tables["state"].items[("user-1",)]["expiresAt"] = Decimal(1)
+
+        recommend(get_recommendations)
+
+        assert len(self.interaction_queries(tables)) == 2
+
+
+class TestRecentInteractions:
+    """Only the newest interactions are read; seenProducts covers the rest"""
+
+    @pytest.fixture(autouse=True)
+    def recent_index(self, tables, fake_dynamodb, monkeypatch):
+        monkeypatch.setenv("RECENT_INTERACTIONS_INDEX", "userId-timestamp-index")
+        monkeypatch.setattr(tables["interactions"], "indexes", {"userId-timestamp-index": "timestamp"})
+        put(tables["products"], *[product(f"book-{i}", "Books") for i in range(1, 8)],
+            *[product(f"toy-{i}", "Toys") for i in range(1, 8)])
+
+    def test_newest_interactions_read_in_one_query(self, get_recommendations, tables, monkeypatch):
+        monkeypatch.setattr(get_recommendations, "RECENT_INTERACTIONS_LIMIT", 2)
+        put(tables["interactions"],
+            interaction("toy-1", days_ago(30), "purchase", "Toys"),
+            interaction("book-1", days_ago(2), category="Books"),
+            interaction("book-2", days_ago(1), category="Books"))
+
+        ids = recommend(get_recommendations)
+
+        assert sorted(ids) == ["book-3", "book-4", "book-5", "book-6", "book-7"]
+        queries = [call for call in tables["interactions"].calls if call[0] == "query"]
+        assert queries == [("query", "userId-timestamp-index", "userId = :userId")]
+
+    def test_seen_products_excluded_beyond_the_window(self, get_recommendations, tables, fake_dynamodb,
+                                                      monkeypatch):
+        monkeypatch.setattr(get_recommendations, "RECENT_INTERACTIONS_LIMIT", 1)
+        monkeypatch.setenv("RECOMMENDATION_STATE_TABLE", "state")
+        fake_dynamodb.tables["state"] = FakeTable("state", ["userId"])
+        put(fake_dynamodb.tables["state"], {"userId": "user-1", "interactionVersion": Decimal(2),
+                                            "seenProducts": {"book-1", "book-2"}})
+        put(tables["interactions"],
+            interaction("book-1", days_ago(2), category="Books"),
+            interaction("book-2", days_ago(1), category="Books"))
+
+        ids = recommend(get_recommendations)
+
+        assert sorted(ids) == ["book-3", "book-4", "book-5", "book-6", "book-7"]
+
+
+def leaderboards_item(global_ids, categories=None):
+    """A leaderboards item as build_leaderboards writes it, for one window"""
+    categories = categories or {}
+    ids = set(global_ids).union(*categories.values())
+    board = {
+        "windows": ["1d"],
+        "global": {"1d": global_ids},
+        "categories": {category: {"1d": ranked} for category, ranked in categories.items()},
+        "products": {product_id: {"id": product_id, "name": product_id, "price": 9.99, "stock": 5}
+                     for product_id in ids},
+    }
+    return {"name": "popular", "leaderboards": json.dumps(board)}
+
+
+class TestLeaderboards:
+    """Popular products for users without history, and to top up short lists"""
+
+    @pytest.fixture(autouse=True)
+    def leaderboards(self, tables, fake_dynamodb, monkeypatch):
+        monkeypatch.setenv("LEADERBOARDS_TABLE", "leaderboards")
+        tables["leaderboards"] = fake_dynamodb.tables["leaderboards"] = FakeTable("leaderboards", ["name"])
+        return tables["leaderboards"]
+
+    def test_cold_start_gets_the_popular_products(self, get_recommendations, leaderboards):
+        put(leaderboards, leaderboards_item([f"prod-{i}" for i in range(1, 13)]))
+
+        assert recommend(get_recommendations, "new-user") == [f"prod-{i}" for i in range(1, 11)]
+
+    def test_short_list_topped_up_by_category_then_globally(self, get_recommendations, tables, leaderboards):
+        put(tables["products"], product("book-1", "Books"), product("book-2", "Books"))
+        put(tables["interactions"], interaction("book-1", days_ago(1), category="Books"))
+        put(leaderboards, leaderboards_item(["prod-1", "book-2", "prod-2"],
+                                            {"Books": ["book-1", "book-3"]}))
+
+        ids = recommend(get_recommendations)
+
+        # book-2 from the category query, then the Books leaderboard, then the global one
+        assert ids == ["book-2", "book-3", "prod-1", "prod-2"]
+
+    def test_leaderboards_read_once_per_container(self, get_recommendations, leaderboards):
+        put(leaderboards, leaderboards_item(["prod-1"]))
+
+        recommend(get_recommendations, "new-user")
+        recommend(get_recommendations, "other-user")
+
+        assert [call[0] for call in leaderboards.calls if call[0] == "get_item"] == ["get_item"]
+
+    def test_empty_before_the_first_build(self, get_recommendations):
+        assert recommend(get_recommendations, "new-user") == []
+
+
+def content_index(similar, k=3):
+    """A packed index from {productId: [(similar productId, score), ...]}"""
+    product_ids = sorted(set(similar) | {other for ranked in similar.values() for other, _ in ranked})
+    positions = {product_id: position for position, product_id in enumerate(product_ids)}
+    neighbours, scores = array("i"), array("H")
+    for product_id in product_ids:
+        ranked = similar.get(product_id, [])[:k]
+        neighbours.extend([positions[other] for other, _ in ranked] + [-1] * (k - len(ranked)))
+        scores.extend([round(score * SCORE_SCALE) for _, score in ranked] + [0] * (k - len(ranked)))
+    return pack(product_ids, neighbours, scores, k)
+
+
+class TestContentIndex:
+    """Products similar in text are merged with the neighbour lists"""
+
+    @pytest.fixture(autouse=True)
+    def s3(self, get_recommendations, tables, monkeypatch):
+        s3 = FakeS3()
+        monkeypatch.setattr(get_recommendations, "s3", s3)
+        monkeypatch.setenv("CONTENT_INDEX_BUCKET", "archive")
+        put(tables["products"], *[product(f"prod-{i}") for i in range(1, 4)], product("new-book", "Books"))
+        return s3
+
+    def test_new_product_recommended_beyond_its_category(self, get_recommendations, tables, s3):
+        s3.put_object(Bucket="archive", Key="indexes/content-similarity.bin",
+                      Body=content_index({"prod-1": [("new-book", 0.8), ("prod-1", 0.5)]}))
+        put(tables["interactions"], interaction("prod-1", days_ago(1)))
+
+        ids = recommend(get_recommendations)
+
+        assert ids[0] == "new-book"
+        assert sorted(ids[1:]) == ["prod-2", "prod-3"]
+
+    def test_merged_with_neighbour_lists(self, get_recommendations, tables, s3, monkeypatch):
+        monkeypatch.setenv("NEIGHBOURS_TABLE", "neighbours")
+        s3.put_object(Bucket="archive", Key="indexes/content-similarity.bin",
+                      Body=content_index({"prod-1": [("new-book", 0.9), ("prod-3", 0.9)]}))
+        put(tables["neighbours"], neighbours("prod-1", ("prod-2", 0.5), ("prod-3", 0.2)))
+        put(tables["interactions"], interaction("prod-1", days_ago(1)))
+
+        # prod-3: 0.2 + 0.5 x 0.9, new-book: 0.5 x 0.9, prod-2: 0.5
+        assert recommend(get_recommendations) == ["prod-3", "prod-2", "new-book"]
+
+    def test_missing_index_falls_back(self, get_recommendations, tables, s3):
+        put(tables["interactions"], interaction("prod-1", days_ago(1)))
+
+        assert sorted(recommend(get_recommendations)) == ["prod-2", "prod-3"]
+        recommend(get_recommendations)
+
+        # Not retried on every request
+        assert get_recommendations._content_index[0] is None
+        assert get_recommendations._content_index[1] > 0
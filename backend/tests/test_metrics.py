@@ -0,0 +1,99 @@
+"""
+Local tests for the EMF metrics module in the common Lambda layer
+"""
+
+import json
+import threading
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import local_aws  # noqa: F401  (puts the common layer on sys.path)
+import metrics  # noqa: E402
+
+
+def emf_lines(output):
+    return [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(metrics, "_timings", {})
+    monkeypatch.setattr(metrics, "_route", "-")
+    monkeypatch.setattr(metrics, "_cold_start", True)
+
+
+class TestTimed:
+    """Context manager and decorator timing"""
+
+    def test_samples_are_batched_per_stage(self, capsys):
+        @metrics.timed("render")
+        def render():
+            pass
+
+        for _ in range(3):
+            render()
+        with metrics.timed("payment"):
+            pass
+        metrics.flush()
+
+        lines = {line["stage"]: line for line in emf_lines(capsys.readouterr().out)}
+        assert len(lines["render"]["Latency"]) == 3
+        assert len(lines["payment"]["Latency"]) == 1
+        directive = lines["render"]["_aws"]["CloudWatchMetrics"][0]
+        assert directive["Dimensions"] == [["function", "route", "stage"]]
+        assert directive["Metrics"] == [{"Name": "Latency", "Unit": "Milliseconds"}]
+
+    def test_decorated_function_on_many_threads(self, capsys):
+        timer = metrics.timed("work")
+        threads = [threading.Thread(target=timer(lambda: None)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics.flush()
+
+        [line] = emf_lines(capsys.readouterr().out)
+        assert len(line["Latency"]) == 8
+
+
+class TestInstrumentHandler:
+    """Route dimension, cold start and flushing around a handler"""
+
+    def test_cold_start_reported_once(self, capsys):
+        @metrics.instrument_handler
+        def handler(event, context):
+            with metrics.timed("load"):
+                return {"statusCode": 200}
+
+        handler({"routeKey": "GET /products"}, None)
+        handler({"routeKey": "GET /products"}, None)
+
+        lines = emf_lines(capsys.readouterr().out)
+        init = [line for line in lines if "InitDuration" in line]
+        assert len(init) == 1 and init[0]["InitDuration"] >= 0
+        stages = [(line["route"], line["stage"]) for line in lines if "Latency" in line]
+        assert stages.count(("GET /products", "handler")) == 2
+        assert stages.count(("GET /products", "load")) == 2
+
+    def test_sqs_route(self):
+        assert metrics.route_of({"Records": [{"eventSource": "aws:sqs"}]}) == "aws:sqs"
+
+
+class TestInstrumentClient:
+    """Every boto3 call is timed as <service>.<operation>"""
+
+    def test_stubbed_calls_are_recorded(self, capsys):
+        client = metrics.instrument_client(boto3.client("sqs", region_name="us-east-1"))
+        with Stubber(client) as stubber:
+            stubber.add_response("send_message", {"MessageId": "1"})
+            stubber.add_client_error("send_message", "ThrottlingException")
+            client.send_message(QueueUrl="https://sqs.local/q", MessageBody="{}")
+            with pytest.raises(Exception):
+                client.send_message(QueueUrl="https://sqs.local/q", MessageBody="{}")
+        metrics.flush()
+
+        [line] = emf_lines(capsys.readouterr().out)
+        assert line["stage"] == "sqs.SendMessage"
+        assert len(line["Latency"]) == 2
@@ -0,0 +1,665 @@
+"""
+Local tests for the process_order Lambda using in-memory AWS stand-ins
+"""
+
+import gzip
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+from local_aws import (FakeDynamoDB, FakeS3, FakeSES, FakeSQS, FakeTable, load_lambda,
+                       sqs_record, throttling_error)
+
+CUSTOMER_EMAIL = "customer@example.com"
+
+
+def order_message(order_id, email=CUSTOMER_EMAIL):
+    return {
+        "orderId": order_id,
+        "userId": "user-1",
+        "total": 59.99,
+        "items": [{"productId": "prod-100", "quantity": 1,
+                   "product": {"name": "Wireless Headphones", "price": 59.99}}],
+        "shippingInfo": {"name": "Test User", "email": email, "address": "1 Test St",
+                         "city": "Test City", "zipCode": "12345"},
+    }
+
+
+def pending_record(orders, message, message_id=None):
+    """Store the order as create_order does and return its SQS record"""
+    orders.put_item(Item={"orderId": message["orderId"], "userId": message["userId"], "status": "PENDING"})
+    return sqs_record(message, message_id)
+
+
+@pytest.fixture
+def orders():
+    return FakeTable("orders", ["orderId"])
+
+
+@pytest.fixture
+def process_order(monkeypatch, orders):
+    app = load_lambda("process_order")
+    carts = FakeTable("carts", ["userId"])
+    fake_dynamodb = FakeDynamoDB([orders, carts])
+    monkeypatch.setattr(app, "dynamodb", fake_dynamodb)
+    monkeypatch.setattr(app, "get_dynamodb", lambda: fake_dynamodb)
+    monkeypatch.setattr(app, "ses", FakeSES(verified=[CUSTOMER_EMAIL]))
+    monkeypatch.setattr(app, "s3", FakeS3())
+    monkeypatch.setattr(app, "sqs", FakeSQS())
+    monkeypatch.setattr(app, "RETRY_QUEUE_URL", "https://sqs.local/orders")
+    monkeypatch.setattr(app, "STAGE_RETRY_BASE_DELAY", 0)
+    monkeypatch.setenv("ORDERS_TABLE", "orders")
+    monkeypatch.setenv("CARTS_TABLE", "carts")
+    monkeypatch.setenv("INVOICE_BUCKET", "invoices")
+    monkeypatch.setenv("SES_SENDER_EMAIL", "shop@example.com")
+    return app
+
+
+class TestBatchItemFailures:
+    """Partial batch responses for the SQS event source"""
+
+    def test_all_records_succeed(self, process_order, orders):
+        records = [pending_record(orders, order_message(f"order-{i}")) for i in range(3)]
+
+        response = process_order.lambda_handler({"Records": records}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert orders.items[("order-1",)]["status"] == "PROCESSED"
+
+    def test_only_failed_records_are_reported(self, process_order, monkeypatch, orders):
+        original = process_order.update_order_status
+
+        def flaky_update(order_id, new_status, **kwargs):
+            if order_id == "order-bad":
+                return False
+            return original(order_id, new_status, **kwargs)
+
+        monkeypatch.setattr(process_order, "update_order_status", flaky_update)
+        good = pending_record(orders, order_message("order-good"), message_id="msg-good")
+        bad = pending_record(orders, order_message("order-bad"), message_id="msg-bad")
+
+        response = process_order.lambda_handler({"Records": [good, bad]}, None)
+
+        assert response == {"batchItemFailures": [{"itemIdentifier": "msg-bad"}]}
+
+    def test_malformed_records_are_reported(self, process_order):
+        missing_id = sqs_record({"userId": "user-1"}, message_id="msg-no-id")
+        not_json = {"messageId": "msg-not-json", "body": "{not json"}
+
+        response = process_order.lambda_handler({"Records": [missing_id, not_json]}, None)
+
+        assert response["batchItemFailures"] == [
+            {"itemIdentifier": "msg-no-id"},
+            {"itemIdentifier": "msg-not-json"},
+        ]
+
+
+class TestConcurrentBatch:
+    """Thread-pool execution of the records in a batch"""
+
+    def test_records_processed_concurrently_with_isolated_failures(self, process_order,
+                                                                    orders, monkeypatch):
+        monkeypatch.setattr(process_order, "ORDER_CONCURRENCY", 4)
+        original = process_order.process_single_order
+
+        def process_or_raise(order_id, *args, **kwargs):
+            if order_id == "order-3":
+                raise RuntimeError("boom")
+            return original(order_id, *args, **kwargs)
+
+        monkeypatch.setattr(process_order, "process_single_order", process_or_raise)
+        records = [pending_record(orders, order_message(f"order-{i}"), message_id=f"msg-{i}")
+                   for i in range(8)]
+
+        response = process_order.lambda_handler({"Records": records}, None)
+
+        assert response == {"batchItemFailures": [{"itemIdentifier": "msg-3"}]}
+        processed = [key for key, item in orders.items.items() if item["status"] == "PROCESSED"]
+        assert len(processed) == 7
+
+
+class TestVerificationCache:
+    """Cached, batched SES identity verification lookups"""
+
+    def test_batch_resolves_recipients_in_one_call(self, process_order, orders):
+        records = [pending_record(orders, order_message(f"order-{i}", email=email))
+                   for i, email in enumerate([CUSTOMER_EMAIL, "other@example.com", CUSTOMER_EMAIL])]
+
+        process_order.lambda_handler({"Records": records}, None)
+        process_order.lambda_handler({"Records": records}, None)
+
+        calls = process_order.ses.verification_calls
+        assert calls == [[CUSTOMER_EMAIL, "other@example.com"]]
+        assert len(process_order.ses.sent) == 2
+
+    def test_unverified_results_expire_sooner(self, process_order, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(process_order.time, "monotonic", lambda: now[0])
+        emails = [CUSTOMER_EMAIL, "other@example.com"]
+
+        process_order.get_verification_statuses(emails)
+        now[0] += process_order.SES_UNVERIFIED_TTL_SECONDS + 1
+        statuses = process_order.get_verification_statuses(emails)
+
+        assert statuses == {CUSTOMER_EMAIL: "Success", "other@example.com": None}
+        assert process_order.ses.verification_calls == [emails, ["other@example.com"]]
+
+
+class TestTemplates:
+    """Email and invoice rendering from the precompiled templates"""
+
+    def test_confirmation_email_content(self, process_order, orders):
+        message = order_message("order-1")
+        message["shippingInfo"]["name"] = "Ann <Admin>"
+        process_order.lambda_handler({"Records": [pending_record(orders, message)]}, None)
+
+        body = process_order.ses.sent[0]["Message"]["Body"]
+        assert "- Wireless Headphones (Qty: 1) - $59.99" in body["Text"]["Data"]
+        assert "Dear Ann <Admin>," in body["Text"]["Data"]
+        assert "<li>Wireless Headphones (Qty: 1) - $59.99</li>" in body["Html"]["Data"]
+        assert "Dear Ann &lt;Admin&gt;," in body["Html"]["Data"]
+
+    def test_invoice_totals(self, process_order, orders):
+        message = order_message("order-1")
+        message["items"].append({"productId": "prod-200", "quantity": 2,
+                                 "product": {"name": "Notebook", "price": 12.5}})
+        process_order.lambda_handler({"Records": [pending_record(orders, message)]}, None)
+
+        (invoice,) = process_order.s3.objects.values()
+        content = invoice["Body"].decode("utf-8")
+        assert f"{'Notebook':<30} Qty:   2 @ $   12.50 = $   25.00" in content
+        assert "Subtotal: $   84.99" in content
+
+
+class TestBulkEmail:
+    """Bulk templated confirmation emails for a whole batch"""
+
+    def test_batch_sent_with_one_bulk_call(self, process_order, monkeypatch, orders):
+        monkeypatch.setattr(process_order, "EMAIL_SEND_MODE", "bulk")
+        records = [pending_record(orders, order_message(f"order-{i}")) for i in range(3)]
+
+        response = process_order.lambda_handler({"Records": records}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert process_order.ses.bulk_calls == [3]
+        bulk = process_order.ses.sent[1]["Message"]
+        assert bulk["Subject"]["Data"] == "Order Confirmation - Order #order-1"
+        assert "- Wireless Headphones (Qty: 1) - $59.99" in bulk["Body"]["Text"]["Data"]
+        assert "<li>Wireless Headphones (Qty: 1) - $59.99</li>" in bulk["Body"]["Html"]["Data"]
+
+    def test_rejected_destinations_are_reported(self, process_order, monkeypatch, orders):
+        monkeypatch.setattr(process_order, "EMAIL_SEND_MODE", "bulk")
+        process_order.ses.verified.add("bounce@example.com")
+        process_order.ses.rejected.add("bounce@example.com")
+        good = pending_record(orders, order_message("order-good"), message_id="msg-good")
+        bad = pending_record(orders, order_message("order-bad", email="bounce@example.com"), message_id="msg-bad")
+
+        response = process_order.lambda_handler({"Records": [good, bad]}, None)
+
+        assert response == {"batchItemFailures": [{"itemIdentifier": "msg-bad"}]}
+
+
+class TestInvoiceBundles:
+    """Batch-level invoice bundles with ranged retrieval"""
+
+    def test_batch_archived_as_one_bundle(self, process_order, monkeypatch, orders):
+        monkeypatch.setattr(process_order, "INVOICE_ARCHIVE_MODE", "bundle")
+        records = [pending_record(orders, order_message(f"order-{i}")) for i in range(4)]
+
+        response = process_order.lambda_handler({"Records": records}, None)
+
+        assert response == {"batchItemFailures": []}
+        keys = sorted(key for _, key in process_order.s3.objects)
+        assert len(keys) == 2
+        bundle_key, index_key = keys[1], keys[0]
+        assert bundle_key.endswith(".ndjson.gz") and index_key.endswith(".index.json")
+
+        index = json.loads(process_order.s3.objects[("invoices", index_key)]["Body"])
+        assert index["bundle"] == bundle_key
+        assert sorted(index["invoices"]) == [f"order-{i}" for i in range(4)]
+
+        location = index["invoices"]["order-2"]
+        from invoice_archive import read_bundled_invoice
+        invoice = read_bundled_invoice(
+            process_order.s3, "invoices", bundle_key, location["offset"], location["length"])
+        assert invoice["orderId"] == "order-2"
+        assert "Order ID: order-2" in invoice["content"]
+        assert orders.items[("order-2",)]["invoiceLocation"] == dict(location, bundle=bundle_key)
+
+        whole = gzip.decompress(process_order.s3.objects[("invoices", bundle_key)]["Body"])
+        assert len(whole.decode("utf-8").splitlines()) == 4
+
+
+class TestIdempotency:
+    """Conditional status transitions and completed-stage tracking"""
+
+    def test_duplicate_delivery_is_skipped_after_one_write(self, process_order, orders):
+        record = pending_record(orders, order_message("order-1"))
+        process_order.lambda_handler({"Records": [record]}, None)
+        orders.calls.clear()
+
+        response = process_order.lambda_handler({"Records": [record]}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert len(orders.calls) == 1
+        assert len(process_order.ses.sent) == 1
+        assert len(process_order.s3.objects) == 1
+        assert orders.items[("order-1",)]["completedStages"] == {"payment", "email", "invoice", "cart"}
+
+    def test_redelivery_resumes_unfinished_stages(self, process_order, orders, monkeypatch):
+        record = pending_record(orders, order_message("order-1"))
+        original = process_order.generate_and_store_invoice
+        monkeypatch.setattr(process_order, "generate_and_store_invoice", lambda *args: False)
+        process_order.lambda_handler({"Records": [record]}, None)
+        monkeypatch.setattr(process_order, "generate_and_store_invoice", original)
+        payments = []
+        monkeypatch.setattr(process_order, "process_payment",
+                            lambda *args: payments.append(args) or True)
+
+        process_order.lambda_handler({"Records": [record]}, None)
+
+        assert payments == []
+        assert len(process_order.ses.sent) == 1
+        assert len(process_order.s3.objects) == 1
+        assert orders.items[("order-1",)]["status"] == "PROCESSED"
+
+    def test_duplicate_of_an_order_in_flight_retries_later(self, process_order, orders, monkeypatch):
+        record = pending_record(orders, order_message("order-1"), "msg-1")
+        orders.items[("order-1",)].update(status="PROCESSING", claimedAt=datetime.utcnow().isoformat() + "Z")
+        payments = []
+        monkeypatch.setattr(process_order, "process_payment", lambda *args: payments.append(args) or True)
+
+        response = process_order.lambda_handler({"Records": [record]}, None)
+
+        assert response == {"batchItemFailures": [{"itemIdentifier": "msg-1"}]}
+        assert payments == [] and process_order.ses.sent == []
+
+    def test_expired_claim_is_taken_over(self, process_order, orders):
+        record = pending_record(orders, order_message("order-1"))
+        stale = (datetime.utcnow() - timedelta(seconds=process_order.ORDER_CLAIM_LEASE_SECONDS + 1)).isoformat() + "Z"
+        orders.items[("order-1",)].update(status="PROCESSING", claimedAt=stale)
+
+        response = process_order.lambda_handler({"Records": [record]}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert len(process_order.ses.sent) == 1
+        order = orders.items[("order-1",)]
+        assert order["status"] == "PROCESSED" and order["claimedAt"] > stale
+
+    def test_only_one_late_delivery_takes_over(self, process_order, orders):
+        pending_record(orders, order_message("order-1"))
+        stale = (datetime.utcnow() - timedelta(seconds=process_order.ORDER_CLAIM_LEASE_SECONDS + 1)).isoformat() + "Z"
+        orders.items[("order-1",)].update(status="PROCESSING", claimedAt=stale)
+
+        assert process_order.claim_order("order-1") is not None
+        assert process_order.claim_order("order-1") is None
+
+    def test_redelivery_after_an_error_resumes_at_once(self, process_order, orders, monkeypatch):
+        record = pending_record(orders, order_message("order-1"), "msg-1")
+        run_stages = process_order.run_stages
+
+        def crash(*args, **kwargs):
+            raise RuntimeError("stage pool unavailable")
+
+        monkeypatch.setattr(process_order, "run_stages", crash)
+        first = process_order.lambda_handler({"Records": [record]}, None)
+        monkeypatch.setattr(process_order, "run_stages", run_stages)
+        second = process_order.lambda_handler({"Records": [record]}, None)
+
+        assert first == {"batchItemFailures": [{"itemIdentifier": "msg-1"}]}
+        assert second == {"batchItemFailures": []}
+        assert orders.items[("order-1",)]["status"] == "PROCESSED"
+
+    def test_redelivery_after_a_failed_bundle_resumes_at_once(self, process_order, orders, monkeypatch):
+        monkeypatch.setattr(process_order, "INVOICE_ARCHIVE_MODE", "bundle")
+        record = pending_record(orders, order_message("order-1"), "msg-1")
+        store_invoice_bundle = process_order.store_invoice_bundle
+
+        monkeypatch.setattr(process_order, "store_invoice_bundle", lambda invoices: {"msg-1"})
+        first = process_order.lambda_handler({"Records": [record]}, None)
+        monkeypatch.setattr(process_order, "store_invoice_bundle", store_invoice_bundle)
+        second = process_order.lambda_handler({"Records": [record]}, None)
+
+        assert first == {"batchItemFailures": [{"itemIdentifier": "msg-1"}]}
+        assert second == {"batchItemFailures": []}
+        assert "invoice" in orders.items[("order-1",)]["completedStages"]
+
+    def test_declined_payment_is_final(self, process_order, orders, monkeypatch):
+        monkeypatch.setattr(process_order, "process_payment", lambda *args: False)
+        record = pending_record(orders, order_message("order-1"))
+
+        first = process_order.lambda_handler({"Records": [record]}, None)
+        second = process_order.lambda_handler({"Records": [record]}, None)
+
+        assert first == second == {"batchItemFailures": []}
+        assert orders.items[("order-1",)]["status"] == "PAYMENT_FAILED"
+        assert process_order.ses.sent == []
+
+
+class TestStagePipeline:
+    """Post-payment stages run concurrently through the stage graph"""
+
+    def test_side_effect_stages_overlap(self, process_order, orders, monkeypatch):
+        barrier = threading.Barrier(3, timeout=2)
+
+        def stage(original):
+            def run(*args):
+                barrier.wait()
+                return original(*args)
+            return run
+
+        for name in ("send_confirmation_email", "generate_and_store_invoice", "clear_user_cart"):
+            monkeypatch.setattr(process_order, name, stage(getattr(process_order, name)))
+
+        response = process_order.lambda_handler({"Records": [pending_record(orders, order_message("order-1"))]}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert orders.items[("order-1",)]["completedStages"] == {"payment", "email", "invoice", "cart"}
+
+    def test_failed_dependency_skips_dependents(self, process_order):
+        from pipeline import Stage, run_stages
+        ran = []
+        stages = [
+            Stage("payment", lambda: False),
+            Stage("email", lambda: ran.append("email") or True, depends_on=["payment"], required=False),
+        ]
+
+        with ThreadPoolExecutor(2) as executor:
+            succeeded, results = run_stages(stages, executor)
+
+        assert not succeeded
+        assert results == {"payment": False, "email": False}
+        assert ran == []
+
+    def test_slow_optional_stage_times_out(self, process_order):
+        from pipeline import Stage, run_stages
+        stages = [
+            Stage("payment", lambda: True),
+            Stage("email", lambda: time.sleep(1) or True, depends_on=["payment"], timeout=0.05, required=False),
+            Stage("cart", lambda: True, depends_on=["payment"], required=False),
+        ]
+
+        with ThreadPoolExecutor(3) as executor:
+            started = time.monotonic()
+            succeeded, results = run_stages(stages, executor, completed=["payment"])
+            elapsed = time.monotonic() - started
+
+        assert succeeded
+        assert results == {"payment": True, "email": False, "cart": True}
+        assert elapsed < 0.5
+
+
+class TestResilience:
+    """Jittered retries, circuit breakers and deferral of unavailable stages"""
+
+    def test_throttled_invoice_put_is_retried(self, process_order, orders, monkeypatch):
+        put_object = process_order.s3.put_object
+        attempts = []
+
+        def throttled_once(**kwargs):
+            attempts.append(kwargs["Key"])
+            if len(attempts) == 1:
+                raise throttling_error("PutObject")
+            return put_object(**kwargs)
+
+        monkeypatch.setattr(process_order.s3, "put_object", throttled_once)
+
+        response = process_order.lambda_handler({"Records": [pending_record(orders, order_message("order-1"))]}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert len(attempts) == 2
+        assert "invoice" in orders.items[("order-1",)]["completedStages"]
+        assert process_order.sqs.messages == []
+
+    def test_breaker_opens_and_recovers(self, process_order):
+        from resilience import CircuitBreaker, DependencyUnavailable
+        now = [0.0]
+        breaker = CircuitBreaker("ses", failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+
+        def throttled():
+            raise throttling_error("SendEmail")
+
+        for _ in range(2):
+            with pytest.raises(Exception):
+                breaker.call(throttled)
+        assert breaker.state == "open"
+        with pytest.raises(DependencyUnavailable):
+            breaker.call(lambda: "not called")
+
+        now[0] = 10
+        assert breaker.state == "half-open"
+        assert breaker.call(lambda: "ok") == "ok"
+        assert breaker.state == "closed"
+
+    def test_open_circuit_defers_stage_to_retry_queue(self, process_order, orders):
+        process_order.breakers["ses"].opened_at = process_order.breakers["ses"].clock()
+        record = pending_record(orders, order_message("order-1"))
+
+        response = process_order.lambda_handler({"Records": [record]}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert process_order.ses.sent == []
+        assert orders.items[("order-1",)]["completedStages"] == {"payment", "invoice", "cart"}
+        [deferred] = process_order.sqs.messages
+        assert deferred["QueueUrl"] == "https://sqs.local/orders"
+        assert 0 < deferred["DelaySeconds"] <= 900
+        body = json.loads(deferred["MessageBody"])
+        assert body["orderId"] == "order-1" and body["deferrals"] == 1
+
+        process_order.breakers["ses"].record_success()
+        response = process_order.lambda_handler({"Records": [sqs_record(body)]}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert len(process_order.ses.sent) == 1
+        assert len(process_order.s3.objects) == 1
+        assert orders.items[("order-1",)]["completedStages"] == {"payment", "email", "invoice", "cart"}
+
+    def test_order_is_redelivered_after_max_deferrals(self, process_order, orders):
+        process_order.breakers["s3"].opened_at = process_order.breakers["s3"].clock()
+        message = dict(order_message("order-1"), deferrals=process_order.ORDER_MAX_DEFERRALS)
+
+        response = process_order.lambda_handler({"Records": [pending_record(orders, message, "msg-1")]}, None)
+
+        assert response == {"batchItemFailures": [{"itemIdentifier": "msg-1"}]}
+        assert process_order.sqs.messages == []
+
+
+class TestWorker:
+    """Long-polling worker mode against the in-memory queue"""
+
+    QUEUE_URL = "https://sqs.local/orders"
+
+    def run_worker(self, worker, until):
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        deadline = time.monotonic() + 5
+        while not until() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        worker.stop()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+    def test_processes_and_deletes_in_batches(self, process_order, orders):
+        from worker import Worker
+        queue = process_order.sqs
+        for i in range(25):
+            message = order_message(f"order-{i}")
+            orders.put_item(Item={"orderId": message["orderId"], "status": "PENDING"})
+            queue.send_message(QueueUrl=self.QUEUE_URL, MessageBody=json.dumps(message))
+        worker = Worker(queue, self.QUEUE_URL, process_order.process_record, workers=8, delete_interval=0.05)
+
+        self.run_worker(worker, until=lambda: len(queue.deleted) == 25)
+
+        assert queue.queue == {}
+        assert worker.processed == 25
+        assert max(queue.delete_batches) <= 10
+        assert len(queue.delete_batches) < 25
+        assert all(item["status"] == "PROCESSED" for item in orders.items.values())
+
+    def test_slow_message_visibility_is_extended(self, process_order, orders, monkeypatch):
+        from worker import Worker
+        queue = process_order.sqs
+        original = process_order.process_record
+        calls = []
+
+        def slow_process_record(record):
+            calls.append(record["messageId"])
+            time.sleep(1.2)
+            return original(record)
+
+        message = order_message("order-1")
+        orders.put_item(Item={"orderId": "order-1", "status": "PENDING"})
+        queue.send_message(QueueUrl=self.QUEUE_URL, MessageBody=json.dumps(message))
+        worker = Worker(queue, self.QUEUE_URL, slow_process_record, workers=2,
+                        visibility_timeout=1, delete_interval=0.05)
+
+        self.run_worker(worker, until=lambda: queue.deleted)
+
+        assert len(calls) == 1
+        assert queue.visibility_changes
+        assert queue.queue == {}
+
+    def test_failed_message_stays_on_queue(self, process_order):
+        from worker import Worker
+        queue = process_order.sqs
+        queue.send_message(QueueUrl=self.QUEUE_URL, MessageBody=json.dumps({"userId": "user-1"}))
+        worker = Worker(queue, self.QUEUE_URL, process_order.process_record, workers=2, delete_interval=0.05)
+
+        self.run_worker(worker, until=lambda: worker.failed)
+
+        assert worker.failed == 1
+        assert queue.deleted == []
+        assert len(queue.queue) == 1
+
+    def test_stop_finishes_in_flight_orders(self, process_order, orders):
+        from worker import Worker
+        queue = process_order.sqs
+        started = threading.Event()
+        original = process_order.process_record
+
+        def process_record(record):
+            started.set()
+            time.sleep(0.2)
+            return original(record)
+
+        orders.put_item(Item={"orderId": "order-1", "status": "PENDING"})
+        queue.send_message(QueueUrl=self.QUEUE_URL, MessageBody=json.dumps(order_message("order-1")))
+        worker = Worker(queue, self.QUEUE_URL, process_record, workers=2, delete_interval=0.05)
+
+        self.run_worker(worker, until=started.is_set)
+
+        assert worker.processed == 1
+        assert queue.deleted and queue.queue == {}
+
+
+    def test_metrics_are_flushed_while_running(self, process_order, monkeypatch):
+        import worker
+        flushes = []
+        monkeypatch.setattr(worker, "flush", lambda: flushes.append(time.monotonic()))
+        runner = worker.Worker(process_order.sqs, self.QUEUE_URL, process_order.process_record, workers=2,
+                               wait_seconds=0, delete_interval=0.01, metrics_interval=0.05)
+
+        self.run_worker(runner, until=lambda: len(flushes) >= 2)
+
+        assert len(flushes) >= 3
+
+    def test_refuses_batched_modes(self, process_order, monkeypatch):
+        from worker import batched_modes
+        assert batched_modes(process_order) == []
+
+        monkeypatch.setattr(process_order, "EMAIL_SEND_MODE", "bulk")
+        monkeypatch.setattr(process_order, "INVOICE_ARCHIVE_MODE", "bundle")
+
+        assert batched_modes(process_order) == ["EMAIL_SEND_MODE=bulk", "INVOICE_ARCHIVE_MODE=bundle"]
+
+class TestPayments:
+    """Pluggable payment client and the gateway simulator"""
+
+    def simulator(self, **kwargs):
+        from payments import SimulatedPaymentGateway
+        return SimulatedPaymentGateway(sleep=lambda seconds: None, **kwargs)
+
+    def outcomes(self, gateway, count):
+        from payments import PaymentTimeout
+        results = []
+        for i in range(count):
+            try:
+                results.append(gateway.charge(f"order-{i}", 10))
+            except PaymentTimeout:
+                results.append("timeout")
+        return results
+
+    def test_seeded_runs_are_reproducible(self, process_order):
+        settings = dict(decline_rate=0.2, timeout_seconds=0.3, median_ms=150, sigma=0.8, seed=7)
+
+        first = self.outcomes(self.simulator(**settings), 200)
+        second = self.outcomes(self.simulator(**settings), 200)
+
+        assert first == second
+        assert {True, False, "timeout"} <= set(first)
+
+    def test_decline_rate(self, process_order):
+        results = self.outcomes(self.simulator(distribution="fixed", decline_rate=0.25, seed=1), 2000)
+
+        assert 0.2 < results.count(False) / len(results) < 0.3
+
+    def test_declined_payment_is_recorded(self, process_order, orders, monkeypatch):
+        monkeypatch.setattr(process_order, "payment_client", self.simulator(distribution="fixed", decline_rate=1))
+
+        response = process_order.lambda_handler({"Records": [pending_record(orders, order_message("order-1"))]}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert orders.items[("order-1",)]["status"] == "PAYMENT_FAILED"
+
+    def test_gateway_timeout_defers_instead_of_failing_payment(self, process_order, orders, monkeypatch):
+        from payments import ApprovingPaymentClient
+        monkeypatch.setattr(process_order, "payment_client",
+                            self.simulator(distribution="fixed", median_ms=500, timeout_seconds=0.1))
+        record = pending_record(orders, order_message("order-1"))
+
+        response = process_order.lambda_handler({"Records": [record]}, None)
+
+        assert response == {"batchItemFailures": []}
+        assert orders.items[("order-1",)]["status"] == "PROCESSING"
+        assert process_order.ses.sent == []
+        [deferred] = process_order.sqs.messages
+
+        monkeypatch.setattr(process_order, "payment_client", ApprovingPaymentClient())
+        process_order.lambda_handler({"Records": [sqs_record(json.loads(deferred["MessageBody"]))]}, None)
+
+        assert orders.items[("order-1",)]["status"] == "PROCESSED"
+        assert len(process_order.ses.sent) == 1
+
+    def test_settled_orders_are_forgotten(self, process_order):
+        from payments import PaymentTimeout
+        gateway = self.simulator(distribution="fixed", median_ms=500, timeout_seconds=0.1, seed=3)
+        gateway.MAX_TRACKED_ORDERS = 5
+
+        for i in range(10):
+            with pytest.raises(PaymentTimeout):
+                gateway.charge(f"order-{i}", 10)
+        gateway.timeout_seconds = 1
+        gateway.charge("order-9", 10)
+
+        assert list(gateway._attempts) == ["order-5", "order-6", "order-7", "order-8"]
+
+    def test_payment_stage_outlasts_its_retries(self, monkeypatch):
+        monkeypatch.setenv("PAYMENT_GATEWAY", "simulated")
+        monkeypatch.setenv("PAYMENT_TIMEOUT_SECONDS", "5")
+        monkeypatch.delenv("PAYMENT_STAGE_TIMEOUT_SECONDS", raising=False)
+        app = load_lambda("process_order")
+
+        assert app.STAGE_TIMEOUTS['payment'] > app.STAGE_RETRY_ATTEMPTS * 5
+
+    def test_client_without_charge_cannot_be_created(self, process_order):
+        from payments import PaymentClient
+
+        class Incomplete(PaymentClient):
+            pass
+
+        with pytest.raises(TypeError):
+            Incomplete()
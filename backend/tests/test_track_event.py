@@ -0,0 +1,337 @@
+"""
+Local tests for the track_event Lambda using in-memory AWS stand-ins
+"""
+
+import json
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+from local_aws import FakeDynamoDB, FakeSQS, FakeTable, load_lambda, throttling_error
+
+import interactions as interaction_store  # noqa: E402
+
+
+def view(user_id="user-1", product_id="prod-1", event_type="product-view"):
+    return {"userId": user_id, "productId": product_id, "eventType": event_type, "productType": "Electronics"}
+
+
+def post(track_event, body):
+    response = track_event.lambda_handler({"body": json.dumps(body)}, None)
+    return response["statusCode"], json.loads(response["body"])
+
+
+@pytest.fixture
+def interactions():
+    return FakeTable("interactions", ["userId", "productId"])
+
+
+@pytest.fixture
+def fake_dynamodb(interactions):
+    return FakeDynamoDB([interactions])
+
+
+@pytest.fixture
+def track_event(monkeypatch, fake_dynamodb):
+    app = load_lambda("track_event")
+    monkeypatch.setattr(app, "dynamodb", fake_dynamodb)
+    monkeypatch.setattr(app, "sqs", FakeSQS())
+    monkeypatch.setenv("INTERACTIONS_TABLE", "interactions")
+    return app
+
+
+# Midnight UTC three days ago: events must be recent to be accepted
+BASE = (int(datetime.now(timezone.utc).timestamp()) // 86400 - 3) * 86400
+HOUR = 3600
+
+
+class TestBatchIngestion:
+    """Single events and event batches on POST /events"""
+
+    def test_single_event_still_accepted(self, track_event, interactions):
+        status, body = post(track_event, view())
+
+        assert status == 200
+        assert interactions.items[("user-1", "prod-1")]["category"] == "Electronics"
+
+    def test_one_update_per_key(self, track_event, interactions):
+        events = [view(product_id=f"prod-{i}") for i in range(60)]
+
+        status, body = post(track_event, {"events": events})
+
+        assert status == 200 and body["count"] == 60
+        assert len(interactions.items) == 60
+        assert len([call for call in interactions.calls if call[0] == "update_item"]) == 60
+
+    def test_update_threads_share_only_the_client(self, track_event, fake_dynamodb, interactions, monkeypatch):
+        # Table resources are not thread-safe, so the threads must not use one
+        monkeypatch.setattr(fake_dynamodb, "Table", lambda name: pytest.fail("Table resource used"))
+        monkeypatch.setenv("RECOMMENDATION_STATE_TABLE", "state")
+        fake_dynamodb.tables["state"] = FakeTable("state", ["userId"])
+
+        status, _ = post(track_event, [view(user_id=f"user-{i}", product_id=f"prod-{i}") for i in range(20)])
+
+        assert status == 200
+        assert len(interactions.items) == len(fake_dynamodb.tables["state"].items) == 20
+
+    def test_failed_updates_ask_for_a_retry(self, track_event, interactions, monkeypatch):
+        update_item = interactions.update_item
+
+        def throttle_prod_2(Key, **kwargs):
+            if Key["productId"] == "prod-2":
+                raise throttling_error("UpdateItem")
+            return update_item(Key=Key, **kwargs)
+
+        monkeypatch.setattr(interactions, "update_item", throttle_prod_2)
+
+        status, body = post(track_event, [view(product_id=f"prod-{i}") for i in range(5)])
+
+        assert status == 503 and body["unprocessed"] == 1
+        assert body["unprocessedEvents"] == [2]
+        assert len(interactions.items) == 4
+
+    def test_cached_recommendations_invalidated(self, track_event, fake_dynamodb, monkeypatch):
+        monkeypatch.setenv("RECOMMENDATION_STATE_TABLE", "state")
+        state = fake_dynamodb.tables["state"] = FakeTable("state", ["userId"])
+
+        post(track_event, [view(), view(product_id="prod-2")])
+        post(track_event, view(event_type="purchase"))
+
+        assert state.items[("user-1",)]["interactionVersion"] == 2
+        assert state.items[("user-1",)]["seenProducts"] == {"prod-1", "prod-2"}
+        assert len(state.calls) == 2
+
+    def test_invalid_batch_lists_every_error(self, track_event, interactions):
+        events = [view(), {"userId": "user-1"}, view(event_type="hover")]
+
+        status, body = post(track_event, events)
+
+        assert status == 400
+        assert [error["index"] for error in body["errors"]] == [1, 2]
+        assert interactions.items == {}
+
+    def test_invalid_timestamp_rejected(self, track_event):
+        status, body = post(track_event, dict(view(), timestamp="yesterday"))
+
+        assert status == 400
+        assert "timestamp" in body["error"]
+
+    def test_timestamps_out_of_range_rejected(self, track_event, interactions):
+        future = (datetime.now(timezone.utc) + timedelta(days=1)).isoformat()
+        stale = (datetime.now(timezone.utc) - timedelta(days=365)).isoformat()
+
+        status, body = post(track_event, [dict(view(), timestamp="2099-01-01T00:00:00Z"),
+                                          dict(view(), timestamp=future), dict(view(), timestamp=stale), view()])
+
+        assert status == 400
+        assert [error["index"] for error in body["errors"]] == [0, 1, 2]
+        assert "future" in body["errors"][0]["error"] and "last 30 days" in body["errors"][2]["error"]
+        assert interactions.items == {}
+
+    def test_unaggregatable_key_does_not_fail_the_others(self, track_event, interactions, monkeypatch):
+        aggregate = interaction_store.aggregate_interactions
+
+        def broken_for_prod_2(records):
+            if records[0]["productId"] == "prod-2":
+                raise OverflowError("math range error")
+            return aggregate(records)
+
+        monkeypatch.setattr(interaction_store, "aggregate_interactions", broken_for_prod_2)
+
+        status, body = post(track_event, [view(product_id=f"prod-{i}") for i in range(3)])
+
+        assert status == 503 and body["unprocessed"] == 1
+        assert sorted(interactions.items) == [("user-1", "prod-0"), ("user-1", "prod-1")]
+
+    def test_oversized_batch_rejected(self, track_event):
+        status, _ = post(track_event, [view(product_id=f"prod-{i}") for i in range(101)])
+
+        assert status == 413
+
+
+class TestCounters:
+    """Records accumulate every event for the pair instead of the last one"""
+
+    def test_counts_per_event_type(self, track_event, interactions):
+        post(track_event, [at(10 * HOUR), at(9 * HOUR)])
+        post(track_event, at(34 * HOUR, event_type="add-to-cart"))
+        post(track_event, at(58 * HOUR, event_type="purchase"))
+
+        record = interactions.items[("user-1", "prod-1")]
+        assert (record["viewCount"], record["cartCount"], record["purchaseCount"]) == (2, 1, 1)
+        assert record["firstSeen"] == at(9 * HOUR)["timestamp"]
+        assert record["lastSeen"] == record["timestamp"] == at(58 * HOUR)["timestamp"]
+        assert record["eventType"] == "purchase"
+
+    def test_batch_costs_one_update(self, track_event, interactions):
+        post(track_event, [view(), view(), view(event_type="add-to-cart")])
+
+        assert len(interactions.calls) == 1
+        assert interactions.items[("user-1", "prod-1")]["eventType"] == "add-to-cart"
+
+    def test_affinity_decays_with_the_half_life(self, track_event, interactions):
+        half_life = interaction_store.AFFINITY_HALF_LIFE_DAYS
+        purchased = datetime.fromtimestamp(BASE, timezone.utc)
+        post(track_event, dict(view(event_type="purchase"), timestamp=purchased.isoformat()))
+        record = interactions.items[("user-1", "prod-1")]
+
+        now = purchased.timestamp() + half_life * 86400
+        score = interaction_store.current_affinity(record, datetime.fromtimestamp(now, timezone.utc))
+
+        assert score == pytest.approx(interaction_store.EVENT_WEIGHTS["purchase"] / 2)
+
+    def test_score_of_an_older_era_rescaled_on_write(self, track_event, interactions):
+        purchased = datetime.fromtimestamp(BASE, timezone.utc)
+        # A record written before eras, whose score grew from AFFINITY_EPOCH
+        interactions.items[("user-1", "prod-1")] = {
+            "userId": "user-1", "productId": "prod-1", "purchaseCount": 1,
+            "affinity": Decimal(f"{interaction_store.affinity_weight('purchase', purchased.isoformat(), 0):.15g}")}
+
+        status, _ = post(track_event, at(0))
+
+        record = interactions.items[("user-1", "prod-1")]
+        era = interaction_store.affinity_era()
+        assert status == 200
+        assert (record["affinityEra"], record["viewCount"], record["purchaseCount"]) == (era, 1, 1)
+        assert float(record["affinity"]) < 2 ** interaction_store.AFFINITY_ERA_HALF_LIVES * 6
+        assert interaction_store.current_affinity(record, purchased) == pytest.approx(6)
+
+
+def at(seconds, **fields):
+    """An event the given number of seconds after BASE"""
+    timestamp = datetime.fromtimestamp(BASE + seconds, timezone.utc).isoformat()
+    return dict(view(**fields), timestamp=timestamp)
+
+
+def emf_lines(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+
+
+class TestDebouncing:
+    """Repeats of (userId, productId, eventType) inside the window are dropped"""
+
+    def test_repeat_view_answered_from_the_container_cache(self, track_event, interactions):
+        post(track_event, at(0))
+        status, _ = post(track_event, at(10))
+
+        assert status == 200
+        assert len(interactions.calls) == 1
+        assert interactions.items[("user-1", "prod-1")]["viewCount"] == 1
+
+    def test_repeat_view_rejected_by_the_conditional_write(self, track_event, interactions, monkeypatch):
+        post(track_event, at(0))
+        # A different container, with nothing cached
+        monkeypatch.setattr(track_event, "debouncer", interaction_store.Debouncer(30))
+
+        post(track_event, at(10))
+        post(track_event, at(20))
+
+        record = interactions.items[("user-1", "prod-1")]
+        assert record["viewCount"] == 1
+        assert len(interactions.calls) == 2  # the rejected write, then a cache hit
+
+    def test_views_outside_the_window_count(self, track_event, interactions):
+        post(track_event, [at(0), at(10), at(45)])
+
+        assert interactions.items[("user-1", "prod-1")]["viewCount"] == 2
+
+    def test_other_events_of_a_rejected_update_still_count(self, track_event, interactions, monkeypatch):
+        post(track_event, at(0))
+        monkeypatch.setattr(track_event, "debouncer", interaction_store.Debouncer(30))
+
+        post(track_event, [at(5), at(6, event_type="add-to-cart")])
+
+        record = interactions.items[("user-1", "prod-1")]
+        assert (record["viewCount"], record["cartCount"]) == (1, 1)
+
+    def test_late_event_outside_the_window_counts(self, track_event, interactions, monkeypatch):
+        post(track_event, at(100))
+        monkeypatch.setattr(track_event, "debouncer", interaction_store.Debouncer(30))
+
+        status, _ = post(track_event, at(0))
+
+        record = interactions.items[("user-1", "prod-1")]
+        assert status == 200 and record["viewCount"] == 2
+        assert record["lastViewAt"] == BASE + 100
+
+    def test_repeats_leave_cached_recommendations_valid(self, track_event, fake_dynamodb, monkeypatch):
+        monkeypatch.setenv("RECOMMENDATION_STATE_TABLE", "state")
+        state = fake_dynamodb.tables["state"] = FakeTable("state", ["userId"])
+        post(track_event, at(0))
+
+        post(track_event, at(10))
+        # A different container, whose conditional write is rejected
+        monkeypatch.setattr(track_event, "debouncer", interaction_store.Debouncer(30))
+        post(track_event, at(20))
+
+        assert state.items[("user-1",)]["interactionVersion"] == 1
+        assert len(state.calls) == 1
+
+    def test_purchases_are_not_debounced_by_default(self, track_event, interactions):
+        post(track_event, [at(0, event_type="purchase"), at(1, event_type="purchase")])
+
+        assert interactions.items[("user-1", "prod-1")]["purchaseCount"] == 2
+
+    def test_saved_writes_reported(self, track_event, capsys):
+        post(track_event, at(0))
+        capsys.readouterr()
+
+        post(track_event, [at(1), at(2)])
+
+        [line] = [line for line in emf_lines(capsys) if "SuppressedEvents" in line]
+        assert (line["SuppressedEvents"], line["SkippedWrites"]) == (2, 1)
+
+
+class TestQueueMode:
+    """EVENT_INGEST_MODE=queue validates and enqueues without writing"""
+
+    def test_batch_enqueued_as_one_message(self, track_event, interactions, monkeypatch):
+        monkeypatch.setattr(track_event, "EVENT_INGEST_MODE", "queue")
+        monkeypatch.setenv("EVENTS_QUEUE_URL", "https://sqs.local/events")
+
+        status, body = post(track_event, [view(product_id=f"prod-{i}") for i in range(3)])
+
+        assert status == 202 and body["count"] == 3
+        assert interactions.items == {}
+        [message] = track_event.sqs.messages
+        assert message["QueueUrl"] == "https://sqs.local/events"
+        assert [event["productId"] for event in json.loads(message["MessageBody"])["events"]] == \
+            ["prod-0", "prod-1", "prod-2"]
+
+    def test_invalid_events_are_not_enqueued(self, track_event, monkeypatch):
+        monkeypatch.setattr(track_event, "EVENT_INGEST_MODE", "queue")
+        monkeypatch.setenv("EVENTS_QUEUE_URL", "https://sqs.local/events")
+
+        status, _ = post(track_event, [view(event_type="hover")])
+
+        assert status == 400
+        assert track_event.sqs.messages == []
+
+    def test_direct_mode_forwards_stored_events_for_archiving(self, track_event, interactions, monkeypatch):
+        monkeypatch.setattr(track_event, "ARCHIVE_EVENTS", True)
+        monkeypatch.setenv("EVENTS_QUEUE_URL", "https://sqs.local/events")
+
+        status, _ = post(track_event, view())
+
+        assert status == 200 and ("user-1", "prod-1") in interactions.items
+        [message] = track_event.sqs.messages
+        assert json.loads(message["MessageBody"])["stored"] is True
+
+    def test_only_stored_events_forwarded_after_a_partial_failure(self, track_event, interactions, monkeypatch):
+        monkeypatch.setattr(track_event, "ARCHIVE_EVENTS", True)
+        monkeypatch.setenv("EVENTS_QUEUE_URL", "https://sqs.local/events")
+        update_item = interactions.update_item
+
+        def throttle_prod_1(Key, **kwargs):
+            if Key["productId"] == "prod-1":
+                raise throttling_error("UpdateItem")
+            return update_item(Key=Key, **kwargs)
+
+        monkeypatch.setattr(interactions, "update_item", throttle_prod_1)
+
+        status, body = post(track_event, [view(), view(product_id="prod-2")])
+
+        assert status == 503 and body["unprocessedEvents"] == [0]
+        [message] = track_event.sqs.messages
+        assert [event["productId"] for event in json.loads(message["MessageBody"])["events"]] == ["prod-2"]
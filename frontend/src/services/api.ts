@@ -29,7 +29,7 @@ export interface Order {
   userId: string
   items: CartItem[]
   total: number
-  status: 'PENDING' | 'PROCESSED' | 'SHIPPED' | 'DELIVERED'
+  status: 'PENDING' | 'PROCESSING' | 'PROCESSED' | 'PAYMENT_FAILED' | 'SHIPPED' | 'DELIVERED'
   createdAt: string
   shippingInfo: {
     name: string
@@ -48,12 +48,114 @@ export interface UserInteraction {
   timestamp: string
 }
 
+// Interaction events are buffered and sent in batches: every few seconds,
+// as soon as the buffer is full, and when the page is hidden or unloaded
+const EVENT_FLUSH_INTERVAL_MS = 5000
+const EVENT_BUFFER_LIMIT = 25
+// Events that could not be sent are put back and retried with a doubling
+// delay. The buffer is capped at what one request may carry (100 events),
+// dropping the oldest first.
+const EVENT_BUFFER_CAP = 100
+const EVENT_RETRY_MAX_DELAY_MS = 60000
+
+class EventBeacon {
+  private url: string
+  private buffer: UserInteraction[] = []
+  private timer: ReturnType<typeof setTimeout> | null = null
+  private retryDelay = 0
+
+  constructor(url: string) {
+    this.url = url
+
+    if (typeof window !== 'undefined') {
+      window.addEventListener('pagehide', () => this.flush())
+      document.addEventListener('visibilitychange', () => {
+        if (document.visibilityState === 'hidden') {
+          this.flush()
+        }
+      })
+    }
+  }
+
+  push(event: UserInteraction): void {
+    this.buffer.push(event)
+    if (this.buffer.length > EVENT_BUFFER_CAP) {
+      this.buffer.shift()
+    }
+
+    // While backing off, a full buffer waits for the retry timer
+    if (this.buffer.length >= EVENT_BUFFER_LIMIT && this.retryDelay === 0) {
+      this.flush()
+    } else if (this.timer === null) {
+      this.timer = setTimeout(() => this.flush(), EVENT_FLUSH_INTERVAL_MS)
+    }
+  }
+
+  flush(): void {
+    if (this.timer !== null) {
+      clearTimeout(this.timer)
+      this.timer = null
+    }
+    if (this.buffer.length === 0) {
+      return
+    }
+
+    const events = this.buffer
+    this.buffer = []
+
+    // keepalive lets the request outlive the page, like navigator.sendBeacon,
+    // while still sending a JSON content type
+    fetch(this.url, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ events }),
+      keepalive: true,
+    })
+      .then(async (response) => {
+        if (response.ok) {
+          this.retryDelay = 0
+          return
+        }
+        if (response.status === 503) {
+          // The other events were stored, and resending them would count
+          // them twice: only the listed ones are retried
+          const body = await response.json().catch(() => null)
+          if (Array.isArray(body?.unprocessedEvents)) {
+            this.retry(body.unprocessedEvents.map((index: number) => events[index]).filter(Boolean))
+            return
+          }
+        }
+        if (response.status >= 500 || response.status === 429) {
+          this.retry(events)
+          return
+        }
+        // An invalid batch would be rejected again
+        console.error(`Tracked events rejected: status ${response.status}`)
+      })
+      .catch((error) => {
+        console.error('Failed to send tracked events:', error)
+        this.retry(events)
+      })
+  }
+
+  private retry(events: UserInteraction[]): void {
+    this.buffer = [...events, ...this.buffer].slice(-EVENT_BUFFER_CAP)
+    this.retryDelay = Math.min(this.retryDelay * 2 || EVENT_FLUSH_INTERVAL_MS, EVENT_RETRY_MAX_DELAY_MS)
+    if (this.timer !== null) {
+      clearTimeout(this.timer)
+    }
+    this.timer = setTimeout(() => this.flush(), this.retryDelay)
+  }
+}
+
 // API Service Class
 class ApiService {
   private baseUrl: string
+  private events: EventBeacon
 
   constructor(baseUrl: string = API_BASE_URL) {
     this.baseUrl = baseUrl
+    this.events = new EventBeacon(`${baseUrl}/events`)
   }
 
   private async request<T>(
@@ -137,13 +239,11 @@ class ApiService {
   }
 
   // User Interaction APIs (for recommendations)
+  // Events are queued and sent in batches, so this resolves immediately
   async trackEvent(interaction: Omit<UserInteraction, 'timestamp'>): Promise<void> {
-    return this.request<void>('/events', {
-      method: 'POST',
-      body: JSON.stringify({
-        ...interaction,
-        timestamp: new Date().toISOString(),
-      }),
+    this.events.push({
+      ...interaction,
+      timestamp: new Date().toISOString(),
     })
   }
 